@@ -35,26 +35,1039 @@
 
 ####################################################################################################################################
 
+#Pipeline stages and checkpoints
+#The pipeline is run as a chain of named stages: import, flag0, cal0, flag1, cal1, polcal, split, selfcal-p0 ... selfcal-pN,
+#selfcal-ap1 ... selfcal-apN and QUV. Each stage stores a hash of its inputs (parameters, upstream caltables and the flag state
+#left by the previous stage) and of its output caltables/images in stagefile. A rerun skips every stage whose hash is unchanged
+#and starts from the first invalid stage, after restoring the flags saved at the end of the last good stage.
+import os, json, hashlib, shutil, glob, time, fcntl
+
+resume = True                        # False runs every stage again, ignoring stagefile
+stagefile = 'pipeline_stages.json'   # stage records
+paramfile = 'pipeline_params.json'   # optional {"name": value} file overriding the parameters of this script (used by benchmark_uGMRT_POL.py)
+
+overrides = {}
+if os.path.exists(paramfile):
+	with open(paramfile) as fpa:
+		overrides = json.load(fpa)
+	print ("Parameters overridden from "+paramfile+": "+", ".join(sorted(overrides)))
+
+def apply_overrides():
+	# called after each parameter block; sets the parameters defined so far that paramfile overrides
+	for name in overrides:
+		if name in globals():
+			globals()[name] = overrides[name]
+
+apply_overrides()
+
+def path_digest(path, maxsize=64*1024**2):
+	# Content hash of a file or of a table directory (caltables, images, fits).
+	# Files larger than maxsize (MS data columns) only contribute their size and modification time.
+	h = hashlib.sha1()
+	if os.path.isdir(path):
+		files = []
+		for root, dirs, fns in os.walk(path):
+			files += [os.path.join(root, fn) for fn in fns if fn != 'table.lock']
+	else:
+		files = [path]
+	for fp in sorted(files):
+		st = os.stat(fp)
+		h.update(os.path.relpath(fp, path).encode())
+		if st.st_size > maxsize:
+			h.update(('%d %d' % (st.st_size, st.st_mtime)).encode())
+		else:
+			with open(fp, 'rb') as fin:
+				for block in iter(lambda: fin.read(1024**2), b''):
+					h.update(block)
+	return h.hexdigest()
+
+def to_json(o):
+	# numpy arrays and scalars in stage parameters
+	return o.tolist() if hasattr(o, 'tolist') else str(o)
+
+def flagversion_path(vis, name):
+	return vis+'.flagversions/flags.stage_'+name
+
+def clear_products(*names):
+	# remove what an interrupted run of a stage left behind (images, ms, caltables) before running it again
+	for name in names:
+		for p in glob.glob(name)+glob.glob(name+'.*'):
+			if os.path.isdir(p):
+				shutil.rmtree(p)
+			else:
+				os.remove(p)
+
+stages = {}
+if resume == True and os.path.exists(stagefile):
+	with open(stagefile) as fst:
+		stages = json.load(fst)
+stage_order = []         # stages met so far in this run
+stage_rerun = False      # set at the first invalid stage; every later stage runs as well
+resumed_at = ''          # first stage that runs after one or more stages were skipped
+current_stage = ''
+stage_inputs = ''
+stage_t0 = 0.0
+
+def stage_start(name, vis, params, caltables=[]):
+	# Returns True if the stage has to run, False if its checkpoint is still valid
+	global stage_rerun, resumed_at, current_stage, stage_inputs, stage_t0
+	h = hashlib.sha1(json.dumps(params, sort_keys=True, default=to_json).encode())
+	for c in caltables:
+		h.update(path_digest(c).encode())
+	if len(stage_order) > 0:
+		h.update(stages[stage_order[-1]]['flags'].encode())
+	inputs = h.hexdigest()
+	rec = stages.get(name)
+	stage_order.append(name)
+	if (stage_rerun == False and rec is not None and rec['inputs'] == inputs and flagversion_exists(rec['vis'], name)
+	    and all(os.path.exists(o) and (d is None or path_digest(o) == d) for o,d in rec['outputs'].items())):
+		print ("Stage "+name+" is up to date, skipping")
+		return False
+	if stage_rerun == False and len(stage_order) > 1:
+		resumed_at = name
+		last = stage_order[-2]
+		casalog.post("Resuming at stage "+name)
+		if stages[last]['vis'] == vis:
+			print ("Resuming at stage "+name+", restoring the flags saved after stage "+last)
+			if deltaflags == True:
+				restore_flags(vis, 'stage_'+last)
+			else:
+				flagmanager(vis=vis, mode='restore', versionname='stage_'+last, merge='replace')
+		else:
+			print ("Resuming at stage "+name)
+	stage_rerun = True
+	current_stage = name
+	stage_inputs = inputs
+	stage_t0 = time.time()
+	print ("Starting stage "+name)
+	return True
+
+def stage_end(name, vis, outputs=[], info={}, products=[]):
+	# Save the flag state of vis and record the stage, with the results later stages need in info. products are outputs that
+	# later stages modify (the split target MSs): they are only checked to exist, not to be unchanged.
+	if deltaflags == True:
+		save_flags(vis, 'stage_'+name, base=True)
+	else:
+		if os.path.exists(flagversion_path(vis, name)):
+			flagmanager(vis=vis, mode='delete', versionname='stage_'+name)
+		flagmanager(vis=vis, mode='save', versionname='stage_'+name, comment='end of pipeline stage '+name)
+	stages[name] = {'inputs': stage_inputs, 'vis': vis, 'flags': flagversion_digest(vis, name),
+	                'outputs': dict([(o, path_digest(o)) for o in outputs]+[(p, None) for p in products]), 'info': info,
+	                'wall': time.time()-stage_t0, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+	# concurrent target chains write their own records: merge this one into the file under a lock
+	with open(stagefile+'.lock', 'w') as flk:
+		fcntl.flock(flk, fcntl.LOCK_EX)
+		ondisk = {}
+		if os.path.exists(stagefile):
+			with open(stagefile) as fst:
+				ondisk = json.load(fst)
+		ondisk[name] = stages[name]
+		with open(stagefile+'.tmp', 'w') as fst:
+			json.dump(ondisk, fst, indent=1, sort_keys=True)
+		os.rename(stagefile+'.tmp', stagefile)
+	print ("Completed stage "+name+" in %.1f s" % stages[name]['wall'])
+	prof_report()
+
+####################################################################################################################################
+
+#Local process pool, used to run independent CASA tasks at the same time on one node
+#The workers are spawned, not forked from the CASA session: each one imports the CASA tasks and tools itself, loads the imports
+#and functions of the pipeline script (not its top-level statements) and takes over the parameters and state of the parent.
+import multiprocessing, resource, re, sys, pickle
+
+pool_bootstrap = """
+import sys, ast
+main = sys.modules['__main__'].__dict__
+main.update(state)
+with open(script) as f:
+	tree = ast.parse(f.read(), script)
+tree.body = [n for n in tree.body if isinstance(n, (ast.Import, ast.ImportFrom, ast.FunctionDef))]
+exec(compile(tree, script, 'exec'), main)
+main['pool_setup']()
+"""
+
+def wrapper_chain(task):
+	# the profiled/versioned wrappers around a task, outermost first
+	chain = []
+	while hasattr(task, 'wrapper'):
+		chain.append((task.wrapper, task.__name__))
+		task = task.task
+	return chain
+
+def pool_state():
+	# the globals a spawned worker starts from: everything that pickles without referring to __main__ (modules, functions,
+	# tools and the profiling records are left out), and the wrappers to put around its own tasks
+	state = {}
+	for name, value in list(globals().items()):
+		if name.startswith('_') or name == 'prof_records' or callable(value) or type(value) is type(sys):
+			continue
+		try:
+			if b'__main__' not in pickle.dumps(value, 2):
+				state[name] = value
+		except Exception:   # tools and other objects that do not pickle
+			pass
+	state['pool_wrappers'] = dict((name, wrapper_chain(value)) for name, value in list(globals().items()) if hasattr(value, 'wrapper'))
+	return state
+
+def pool_setup():
+	# runs first in every spawned worker, after pool_bootstrap: the CASA tasks and tools, wrapped as in the parent
+	import casatools
+	exec('from casatasks import *', globals())
+	from casatasks import casalog
+	globals().update(casalog=casalog, tb=casatools.table(), msmd=casatools.msmetadata(), prof_records=[])
+	for name, chain in pool_wrappers.items():
+		task = globals()[name]
+		for wrapper, taskname in reversed(chain):
+			task = {'profiled': profiled, 'versioned': versioned}[wrapper](taskname, task)
+		globals()[name] = task
+
+def pool_call(fj):
+	# runs in a pool worker: the result, and the task profiling records made there
+	n0 = len(prof_records)
+	result = globals()[fj[0]](fj[1])
+	return result, prof_records[n0:]
+
+def run_pool(func, jobs, workers, fresh=True):
+	# func(job) for every job, in at most 'workers' spawned processes; with fresh, a new one per job, so that its memory is
+	# returned. With workers <= 1, or when already inside a pool worker, the jobs run one after another in this process.
+	workers = min(workers, len(jobs))
+	if workers <= 1 or multiprocessing.current_process().daemon:
+		return [func(job) for job in jobs]
+	# without a __file__ or __spec__ of __main__ the workers do not run the pipeline script again as their main module
+	main = sys.modules['__main__']
+	hidden = dict((k, getattr(main, k)) for k in ('__file__', '__spec__') if hasattr(main, k))
+	main.__spec__ = None
+	if '__file__' in hidden:
+		del main.__file__
+	try:
+		pool = multiprocessing.get_context('spawn').Pool(processes=workers, maxtasksperchild=1 if fresh == True else None,
+		                                                 initializer=exec, initargs=(pool_bootstrap,
+		                                                 {'script': os.path.abspath(func.__code__.co_filename), 'state': pool_state()}))
+		try:
+			out = pool.map(pool_call, [(func.__name__, job) for job in jobs], chunksize=1)
+		finally:
+			pool.close()
+			pool.join()
+	finally:
+		del main.__spec__
+		for k in hidden:
+			setattr(main, k, hidden[k])
+	for result, records in out:
+		prof_records.extend(records)
+	return [result for result, records in out]
+
+def mem_available():
+	# free memory in bytes from /proc (Linux only), 0 if unknown
+	try:
+		with open('/proc/meminfo') as fm:
+			for line in fm:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1])*1024
+	except (IOError, OSError):
+		pass
+	return 0
+
+def tclean_memory(imsize, nterms, nstokes, wprojplanes):
+	# Rough memory in bytes of one mtmfs tclean run: float planes for image/residual/model (nterms each), psf (2*nterms-1),
+	# pb, weight and mask, the padded complex gridding planes, and ~1 GB for the w-projection convolution functions
+	npix = imsize[0]*imsize[1]*nstokes
+	floats = 4*npix*(3*nterms + 2*nterms-1 + 3)
+	grids = 8*1.44*npix*(2*nterms-1)
+	return floats + grids + (1e9 if wprojplanes != 1 else 0)
+
+####################################################################################################################################
+
+#Task profiling
+#Every CASA task called by the pipeline is wrapped to record its wall time, CPU time, peak memory, bytes read and written,
+#and the size of the MS it works on and of the products it writes. The records go to profreport.json/.csv with a summary
+#ranked by wall time, which is also printed at the end of the run.
+
+profile=True                  # wrap the CASA tasks and write the run report
+profreport='pipeline_profile' # report file names, without extension
+proftasks=['importgmrt', 'listobs', 'partition', 'flagdata', 'flagmanager', 'setjy', 'gaincal', 'bandpass', 'fluxscale',
+           'polcal', 'applycal', 'clearcal', 'split', 'mstransform', 'tclean', 'exportfits', 'imsubimage', 'imstat']
+prof_records=[]
+prof_peaks=[]                 # peak RSS so far of the profiled calls in progress, outermost first
+prof_t0=time.time()
+apply_overrides()
+
+def io_counters():
+	# bytes read and written so far by this process (from /proc, Linux only) and by its finished pool workers
+	children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	try:
+		with open('/proc/self/io') as fio:
+			io = dict(line.split(':') for line in fio if ':' in line)
+		return int(io['read_bytes'])+512*children.ru_inblock, int(io['write_bytes'])+512*children.ru_oublock
+	except (IOError, OSError, KeyError, ValueError):
+		return 512*children.ru_inblock, 512*children.ru_oublock
+
+def rss_reset():
+	# start a new peak RSS (VmHWM) for this process (Linux only)
+	try:
+		with open('/proc/self/clear_refs', 'w') as fcr:
+			fcr.write('5')
+	except (IOError, OSError):
+		pass
+
+def rss_peak():
+	# peak RSS in bytes since the last rss_reset (from /proc, Linux only), or the lifetime peak where that is not available
+	try:
+		with open('/proc/self/status') as fst:
+			for line in fst:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1])*1024
+	except (IOError, OSError, ValueError):
+		pass
+	return 1024*resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def disk_usage(path):
+	# bytes used by a file or a table/image directory
+	if os.path.isfile(path):
+		return os.path.getsize(path)
+	total = 0
+	for root, dirs, fns in os.walk(path):
+		total += sum(os.path.getsize(os.path.join(root, fn)) for fn in fns if os.path.isfile(os.path.join(root, fn)))
+	return total
+
+def profiled(name, task):
+	def run(*args, **kwargs):
+		t0 = time.time()
+		c0 = os.times()
+		io0 = io_counters()
+		# a call made inside another profiled call hands the peak so far to it before resetting the high-water mark
+		if len(prof_peaks) > 0:
+			prof_peaks[-1] = max(prof_peaks[-1], rss_peak())
+		prof_peaks.append(0)
+		rss_reset()
+		try:
+			return task(*args, **kwargs)
+		finally:
+			c1 = os.times()
+			io1 = io_counters()
+			peak = max(prof_peaks.pop(), rss_peak())
+			if len(prof_peaks) > 0:
+				prof_peaks[-1] = max(prof_peaks[-1], peak)
+			vis = kwargs.get('vis', args[0] if len(args) > 0 else '')
+			vis = vis if isinstance(vis, str) else ''
+			outputs = [kwargs[k] for k in ('caltable', 'fluxtable', 'outputvis', 'fitsimage', 'outfile') if kwargs.get(k, '') != '']
+			if name == 'tclean' and kwargs.get('imagename', '') != '':
+				outputs += glob.glob(kwargs['imagename']+'.*')
+			prof_records.append({'task': name, 'stage': current_stage, 'pid': os.getpid(),
+			                     'start': t0, 'wall': time.time()-t0, 'cpu': sum(c1[:4])-sum(c0[:4]),
+			                     'peak_rss': peak,
+			                     'read': io1[0]-io0[0], 'written': io1[1]-io0[1],
+			                     'vis': vis, 'vis_size': disk_usage(vis) if vis != '' and os.path.exists(vis) else 0,
+			                     'output_size': sum(disk_usage(o) for o in outputs if os.path.exists(o))})
+	run.__name__ = name
+	run.__doc__ = task.__doc__
+	run.wrapper, run.task = 'profiled', task
+	return run
+
+def prof_report():
+	# write the records as JSON and CSV and print the tasks ranked by total wall time; pool workers leave it to the main process
+	if profile != True or multiprocessing.current_process().daemon:
+		return
+	fields = ['task', 'stage', 'pid', 'start', 'wall', 'cpu', 'peak_rss', 'read', 'written', 'vis', 'vis_size', 'output_size']
+	summary = {}
+	for r in prof_records:
+		s = summary.setdefault(r['task'], {'task': r['task'], 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'read': 0, 'written': 0, 'peak_rss': 0})
+		s['calls'] += 1
+		for k in ('wall', 'cpu', 'read', 'written'):
+			s[k] += r[k]
+		s['peak_rss'] = max(s['peak_rss'], r['peak_rss'])
+	ranked = sorted(summary.values(), key=lambda s: -s['wall'])
+	with open(profreport+'.json', 'w') as fpr:
+		json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(prof_t0)), 'wall': time.time()-prof_t0,
+		           'tasks': prof_records, 'summary': ranked}, fpr, indent=1)
+	with open(profreport+'.csv', 'w') as fpr:
+		fpr.write(','.join(fields)+'\n')
+		for r in prof_records:
+			fpr.write(','.join(str(r[k]) for k in fields)+'\n')
+	print ("Task            calls     wall(s)      cpu(s)   read(GB)  written(GB)  peak RSS(GB)")
+	for s in ranked:
+		print ("%-14s %6d %11.1f %11.1f %10.2f %12.2f %13.2f" % (s['task'], s['calls'], s['wall'], s['cpu'], s['read']/1e9, s['written']/1e9, s['peak_rss']/1e9))
+
+if profile == True:
+	for t in proftasks:
+		if t in globals():
+			globals()[t] = profiled(t, globals()[t])
+
+####################################################################################################################################
+
+#Flag versions
+#flagdata and applycal back up the whole FLAG column into <vis>.flagversions on every call. With deltaflags=True they run with
+#flagbackup=False instead, and the flags they leave are stored in <vis>.flagdeltas as a compressed XOR delta against the version
+#before (a bitmap that is almost all zeros, so it compresses to a small fraction of a full copy). The end of every stage is a full
+#(packed and compressed) base that the steps of the next stage chain from. Any version restores by decompressing its chain from the
+#base, chunk by chunk. The step versions of all but the last flagkeepstages stages are dropped; the stage versions are always kept.
+#The index of each store (index.json) lists its versions, named stage_<stage> and step_<stage>_<n>_<task> (flags after that call).
+import zlib
+import numpy as np
+
+deltaflags=True        # store flag versions as compressed deltas instead of flagmanager/flagbackup copies
+flagkeepstages=2       # stages whose step versions are kept
+flagchunk=64*1024**2   # bytes of FLAG read at a time
+flag_steps=0
+apply_overrides()
+
+def flag_tables(vis):
+	# the tables that hold the flags of vis: its sub-MSs for a multi-MS
+	return subms_list(vis) if is_mms(vis) else [vis]
+
+def flag_index(vis):
+	fn = vis+'.flagdeltas/index.json'
+	if os.path.exists(fn):
+		with open(fn) as fin:
+			return json.load(fin)
+	return {'nrow': 0, 'shape': [], 'versions': {}, 'stages': [], 'last': None}
+
+def flag_chain(index, name):
+	# versions from the base up to name
+	chain = []
+	while name is not None:
+		chain.insert(0, name)
+		name = index['versions'][name]['parent']
+	return chain
+
+def flag_blocks(vis, index, name):
+	# decompressed chunks of one version, in row order
+	with open(vis+'.flagdeltas/'+name+'.flags', 'rb') as fin:
+		for size in index['versions'][name]['sizes']:
+			yield np.frombuffer(zlib.decompress(fin.read(size)), np.uint8)
+
+def flag_state(vis, index, name):
+	# packed flags of each chunk at version name: its base XOR every delta after it
+	readers = [flag_blocks(vis, index, v) for v in flag_chain(index, name)]
+	while True:
+		try:
+			state = next(readers[0]).copy()
+		except StopIteration:
+			return
+		for r in readers[1:]:
+			state ^= next(r)
+		yield state
+
+def save_flags(vis, name, base=False):
+	for t in flag_tables(vis):
+		save_table_flags(t, name, base)
+
+def save_table_flags(vis, name, base):
+	store = vis+'.flagdeltas'
+	index = flag_index(vis)
+	tb.open(vis)
+	nrow = tb.nrows()
+	shape = list(tb.getcell('FLAG', 0).shape) if nrow > 0 else []
+	if nrow != index['nrow'] or shape != index['shape']:
+		# a new or rewritten MS: the old versions no longer fit its rows
+		if os.path.exists(store):
+			shutil.rmtree(store)
+		index = {'nrow': nrow, 'shape': shape, 'versions': {}, 'stages': [], 'last': None}
+	if not os.path.exists(store):
+		os.makedirs(store)
+	parent = None if base == True else index['last']
+	rows = max(1, flagchunk//max(1, int(np.prod(shape))))
+	prev = flag_state(vis, index, parent) if parent is not None else None
+	sizes = []
+	with open(store+'/'+name+'.tmp', 'wb') as fout:
+		for start in range(0, nrow, rows):
+			cur = np.packbits(tb.getcol('FLAG', startrow=start, nrow=min(rows, nrow-start)))
+			if prev is not None:
+				cur ^= next(prev)
+			blob = zlib.compress(cur.tobytes(), 1)
+			fout.write(blob)
+			sizes.append(len(blob))
+	tb.close()
+	# a version saved again invalidates the versions that chained from it
+	stale = [v for v in index['versions'] if v != name and name in flag_chain(index, v)]
+	for v in stale+[name]:
+		if v in index['versions']:
+			del index['versions'][v]
+			if v != name:
+				os.remove(store+'/'+v+'.flags')
+	os.rename(store+'/'+name+'.tmp', store+'/'+name+'.flags')
+	index['versions'][name] = {'parent': parent, 'sizes': sizes, 'stage': current_stage, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+	index['last'] = name
+	if base == True:
+		if current_stage in index['stages']:
+			index['stages'].remove(current_stage)
+		index['stages'].append(current_stage)
+		# retention: steps of older stages are leaves, nothing chains from them
+		keep = index['stages'][-flagkeepstages:] if flagkeepstages > 0 else []
+		for v in [v for v, rec in index['versions'].items() if v.startswith('step_') and rec['stage'] not in keep and rec['stage'] != current_stage]:
+			del index['versions'][v]
+			os.remove(store+'/'+v+'.flags')
+	with open(store+'/index.json', 'w') as fidx:
+		json.dump(index, fidx, indent=1)
+
+def restore_flags(vis, name):
+	# put the flags of version name back into vis; the next step version chains from it
+	for t in flag_tables(vis):
+		index = flag_index(t)
+		shape = index['shape']
+		rows = max(1, flagchunk//max(1, int(np.prod(shape))))
+		tb.open(t, nomodify=False)
+		start = 0
+		for state in flag_state(t, index, name):
+			n = min(rows, index['nrow']-start)
+			tb.putcol('FLAG', np.unpackbits(state, count=int(np.prod(shape))*n).reshape(shape+[n]).astype(bool), startrow=start, nrow=n)
+			start += n
+		tb.close()
+		index['last'] = name
+		with open(t+'.flagdeltas/index.json', 'w') as fidx:
+			json.dump(index, fidx, indent=1)
+
+def flagversion_exists(vis, name):
+	if deltaflags == True:
+		return all(os.path.exists(t+'.flagdeltas/stage_'+name+'.flags') for t in flag_tables(vis)) if os.path.exists(vis) else False
+	return os.path.exists(flagversion_path(vis, name))
+
+def flagversion_digest(vis, name):
+	if deltaflags == True:
+		return hashlib.sha1(''.join(path_digest(t+'.flagdeltas/stage_'+name+'.flags') for t in flag_tables(vis)).encode()).hexdigest()
+	return path_digest(flagversion_path(vis, name))
+
+def versioned(name, task):
+	# with deltaflags, the call runs without flagbackup and the flags it leaves are stored as a step version
+	def run(*args, **kwargs):
+		global flag_steps
+		backup = kwargs.get('flagbackup', True)
+		if deltaflags == True:
+			kwargs['flagbackup'] = False
+		result = task(*args, **kwargs)
+		if deltaflags == True and backup == True and kwargs.get('mode', '') != 'summary' and kwargs.get('action', 'apply') == 'apply':
+			flag_steps += 1
+			save_flags(kwargs.get('vis', args[0] if len(args) > 0 else ''), 'step_%s_%d_%s' % (current_stage, flag_steps, name))
+		return result
+	run.__name__ = name
+	run.__doc__ = task.__doc__
+	run.wrapper, run.task = 'versioned', task
+	return run
+
+for t in ['flagdata', 'applycal']:
+	if t in globals():
+		globals()[t] = versioned(t, globals()[t])
+
+####################################################################################################################################
+
+#Partitioned multi-MS
+#With usemms=True, multi.ms is partitioned after import into a multi-MS (multi.mms) with one sub-MS per scan or time chunk.
+#The flagging rounds and applycal then run on every sub-MS at the same time in the local process pool (partworkers=1 runs
+#them one after another in this process, as a stand-in for a cluster), while gaincal, bandpass, fluxscale and polcal read the
+#multi-MS as a whole, so their solutions still combine data across partitions.
+
+usemms=False           # Partition multi.ms into multi.mms and flag/apply per sub-MS
+mmsaxis='scan'         # separationaxis for partition: 'scan' (time chunks) or 'auto' (scan and spw)
+mmsnumsubms=8          # number of sub-MSs
+partworkers=4          # sub-MSs processed at the same time
+apply_overrides()
+
+def is_mms(vis):
+	return os.path.isdir(vis+'/SUBMSS')
+
+def subms_list(vis):
+	return sorted(glob.glob(vis+'/SUBMSS/*.ms'))
+
+def subms_fields(sub):
+	# field ids present in a sub-MS
+	tb.open(sub)
+	ids = np.unique(tb.getcol('FIELD_ID'))
+	tb.close()
+	return set(str(i) for i in ids)
+
+def subms_cmds(sub, cmds):
+	# the flagdata commands of a round whose field selection is present in the sub-MS
+	present = subms_fields(sub)
+	keep = []
+	for cmd in cmds:
+		sel = re.search(r"field='([^']*)'", cmd)
+		if sel is None or sel.group(1) == '' or len(present.intersection(sel.group(1).split(','))) > 0:
+			keep.append(cmd)
+	return keep
+
+####################################################################################################################################
+
+#SumThreshold flagging engine
+#A NumPy SumThreshold flagger (Offringa et al. 2010, MNRAS 405, 155) that can stand in for tfcrop or rflag in any step of the
+#flagging rounds (see flagengine in the flagging parameters). The selected rows are read in blocks of whole baselines of one scan,
+#at most stblock bytes of visibilities each, and turned into a baseline x time x channel x correlation cube of amplitudes. A
+#background (the median of tiles of stmedian timestamps x channels) is removed, and runs of 1, 2, 4 ... samples whose mean excess exceeds
+#cutoff/1.5**log2(run) times the robust noise of their baseline are flagged along both axes. The blocks are shared out among
+#stworkers processes, and their flags are OR-ed into FLAG with one putcol per block.
+import ast, warnings
+
+stblock=64*1024**2     # bytes of visibilities per block read by the SumThreshold engine
+stwindows=[1,2,4,8,16,32]  # SumThreshold run lengths (samples)
+stmedian=[15,31]       # timestamps and channels of the tiles whose medians make the background
+stworkers=4            # blocks flagged at the same time
+apply_overrides()
+
+def cmd_pars(cmd):
+	# the parameters of one flagdata command line (as written by flagcmd)
+	return dict((k, ast.literal_eval(v)) for k, v in re.findall(r"(\w+)=('[^']*'|\[[^\]]*\]|\S+)", cmd))
+
+def block_median(cube, wt, wf):
+	# median of every wt timestamps x wf channels of a baseline x time x channel x correlation cube, repeated over them.
+	# A line or a burst filling less than half of a tile does not move its median.
+	nbl, nt, nf, nc = cube.shape
+	bt, bf = -(-nt//wt), -(-nf//wf)
+	x = np.full((nbl, bt*wt, bf*wf, nc), np.nan, cube.dtype)
+	x[:,:nt,:nf] = cube
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)   # all-flagged tiles give nan, which stays flagged
+		med = np.nanmedian(x.reshape(nbl, bt, wt, bf, wf, nc), axis=(2,4))
+	return np.repeat(np.repeat(med, wt, axis=1), wf, axis=2)[:,:nt,:nf]
+
+def sumthreshold(dev, mask, axis, cutoff):
+	# SumThreshold along axis of dev (excess in units of the noise), with the samples in mask already flagged
+	x = np.ascontiguousarray(np.moveaxis(dev, axis, -1))
+	m0 = np.ascontiguousarray(np.moveaxis(mask, axis, -1))
+	n = x.shape[-1]
+	hits = np.zeros(x.shape, bool)
+	for m in stwindows:
+		if m > n:
+			break
+		chi = np.float32(cutoff/1.5**np.log2(m))
+		v = np.where(m0 | hits, chi, x)   # flagged samples count at the threshold
+		c = np.zeros(x.shape[:-1]+(n+1,), np.float32)
+		np.cumsum(v, axis=-1, out=c[...,1:])
+		start = np.zeros(x.shape[:-1]+(n+m,), np.int32)
+		start[...,m:n+1] = (c[...,m:]-c[...,:-m]) > m*chi
+		# sample j is covered by the runs starting at j-m+1 ... j
+		np.cumsum(start, axis=-1, out=start)
+		hits |= (start[...,m:]-start[...,:n]) > 0
+	return np.moveaxis(hits & ~m0, -1, axis)
+
+def sumthreshold_flags(amp, flag, bl, cutoff):
+	# new flags of one block: amp and flag are (correlation, channel, row) with the rows ordered by baseline, then time
+	bls, bi, counts = np.unique(bl, return_inverse=True, return_counts=True)
+	ti = np.arange(len(bl))-np.repeat(np.cumsum(counts)-counts, counts)
+	cube = np.full((len(bls), counts.max(), amp.shape[1], amp.shape[0]), np.nan, np.float32)
+	cube[bi,ti] = np.where(flag, np.nan, amp).transpose(2,1,0)
+	cube -= block_median(cube, stmedian[0], stmedian[1])
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		sigma = 1.4826*np.nanmedian(np.abs(cube), axis=(1,2), keepdims=True)   # per baseline and correlation
+	cube /= np.where(sigma > 0, sigma, np.nan)
+	mask = np.isnan(cube)
+	new = sumthreshold(cube, mask, 1, cutoff)
+	new |= sumthreshold(cube, mask | new, 2, cutoff)
+	return new[bi,ti].transpose(2,1,0)
+
+def sumthreshold_block(job):
+	# runs in a pool worker: the new flags of the rows of one block, as packed bits
+	vis, rows, columns, chans, cutoff = job
+	tb.open(vis)
+	sub = tb.selectrows(rows)
+	data = sub.getcol(columns[0])
+	for col in columns[1:]:
+		data -= sub.getcol(col)
+	flag = sub.getcol('FLAG')
+	bl = sub.getcol('ANTENNA1')*4096+sub.getcol('ANTENNA2')
+	sub.close()
+	tb.close()
+	new = sumthreshold_flags(np.abs(data[:,chans[0]:chans[1],:]), flag[:,chans[0]:chans[1],:], bl, cutoff)
+	return new.shape, np.packbits(new)
+
+def sumthreshold_flag(vis, cmd, flagbackup=True):
+	# Run one sumthreshold command (see rficmd) on vis and return the fraction of the selected visibilities it flagged
+	pars = cmd_pars(cmd)
+	field, spw, cutoff = pars.get('field', ''), pars.get('spw', ''), pars['cutoff']
+	tb.open(vis)
+	names = tb.colnames()
+	# RESIDUAL_DATA is corrected minus model, as in flagdata; a virtual (OTF) model cannot be read here and is left out
+	columns = {'DATA': ['DATA'], 'CORRECTED': ['CORRECTED_DATA'], 'RESIDUAL_DATA': ['CORRECTED_DATA', 'MODEL_DATA']}[pars['datacolumn'].upper()]
+	columns = [c for c in columns if c in names] if 'CORRECTED_DATA' in names else ['DATA']
+	taql = 'ANTENNA1 != ANTENNA2'
+	if field != '':
+		taql += ' AND FIELD_ID IN [%s]' % field
+	if spw.split(':')[0] != '':
+		taql += ' AND DATA_DESC_ID IN [%s]' % spw.split(':')[0]   # one spectral window per data description, as in uGMRT data
+	sel = tb.query(taql, sortlist='SCAN_NUMBER,ANTENNA1,ANTENNA2,TIME')
+	rows = sel.rownumbers()
+	ncorr, nchan = (sel.getcell('FLAG', 0).shape if sel.nrows() > 0 else (0, 0))
+	scan = sel.getcol('SCAN_NUMBER')
+	bl = sel.getcol('ANTENNA1')*4096+sel.getcol('ANTENNA2')
+	sel.close()
+	tb.close()
+	chans = [int(c) for c in spw.split(':')[1].split('~')] if ':' in spw else [0, nchan-1]
+	chans[1] += 1
+	if flagbackup == True:
+		flagmanager(vis=vis, mode='save', versionname='sumthreshold_%d' % len(flagmanager(vis=vis, mode='list')))
+	# blocks of whole baselines of one scan, each at most stblock bytes
+	runs = list(np.flatnonzero((np.diff(scan) != 0) | (np.diff(bl) != 0))+1)
+	blocks = []
+	for r0, r1 in zip([0]+runs, runs+[len(rows)]):
+		if len(blocks) > 0 and scan[blocks[-1][0]] == scan[r0] and (r1-blocks[-1][0])*8*ncorr*nchan <= stblock:
+			blocks[-1][1] = r1
+		else:
+			blocks.append([r0, r1])
+	nflag = 0
+	wave = max(1, stworkers)
+	for w in range(0, len(blocks), wave):
+		out = run_pool(sumthreshold_block, [(vis, rows[b0:b1], columns, chans, cutoff) for b0, b1 in blocks[w:w+wave]], stworkers, fresh=False)
+		tb.open(vis, nomodify=False)
+		for (b0, b1), (shape, packed) in zip(blocks[w:w+wave], out):
+			new = np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape).astype(bool)
+			sub = tb.selectrows(rows[b0:b1])
+			flag = sub.getcol('FLAG')
+			nflag += np.count_nonzero(new & ~flag[:,chans[0]:chans[1],:])
+			flag[:,chans[0]:chans[1],:] |= new
+			sub.putcol('FLAG', flag)
+			sub.close()
+		tb.close()
+	frac = nflag/float(max(1, len(rows)*ncorr*(chans[1]-chans[0])))
+	msg = ("SumThreshold on %s field '%s' %s: %d blocks, %.2f%% newly flagged" % (vis, field, pars['datacolumn'], len(blocks), 100*frac))
+	print (msg)
+	casalog.post(msg)
+	return frac
+
+####################################################################################################################################
+
+#Observation metadata
+#The MS is scanned once with msmd into the sidecar <vis>.meta.json (fields, scans, spectral windows, antennas, durations), which
+#later runs read instead of opening the MS again as long as its FIELD, SPECTRAL_WINDOW, ANTENNA and OBSERVATION tables are unchanged.
+#With autoconfig=True the field roles, the channel ranges and the clip limits of the known calibrators that are left empty
+#('' or []) in the parameters are derived from it. Values typed in, and those of pipeline_params.json, are never replaced.
+
+known_sources={'3C286': ['3C286', '1331+305', '1331+3030', 'J1331+3030'],
+               '3C48':  ['3C48', '0137+331', '0137+3309', 'J0137+3309'],
+               '3C138': ['3C138', '0521+166', '0521+1638', 'J0521+1638'],
+               '3C84':  ['3C84', '0319+415', '0319+4130', 'J0319+4130'],
+               'OQ208': ['OQ208', '1407+284', '1407+2827', 'J1407+2827']}
+
+def source_name(name):
+	# the name of a known calibrator (as in pol_<name>.txt) for any of its aliases, otherwise name itself
+	for source, aliases in known_sources.items():
+		if name.upper().replace(' ', '') in aliases:
+			return source
+	return name
+
+def ms_metadata(vis):
+	key = hashlib.sha1(''.join(path_digest(vis+'/'+t) for t in ['FIELD', 'SPECTRAL_WINDOW', 'ANTENNA', 'OBSERVATION']).encode()).hexdigest()
+	sidecar = vis+'.meta.json'
+	if os.path.exists(sidecar):
+		with open(sidecar) as fme:
+			meta = json.load(fme)
+		if meta['key'] == key:
+			return meta
+	print ("Scanning the metadata of "+vis)
+	msmd.open(vis)
+	meta = {'key': key, 'vis': vis, 'fields': [], 'scans': [], 'spws': [], 'antennas': list(msmd.antennanames())}
+	for s in msmd.scannumbers():
+		times = msmd.timesforscan(s)
+		exposure = msmd.exposuretime(scan=s)['value']
+		meta['scans'].append({'scan': int(s), 'field': int(msmd.fieldsforscan(s)[0]), 'start': float(times.min()),
+		                      'duration': float(times.max()-times.min()+exposure)})
+	for i, name in enumerate(msmd.fieldnames()):
+		d = msmd.phasecenter(i)
+		scans = [sc for sc in meta['scans'] if sc['field'] == i]
+		meta['fields'].append({'id': i, 'name': name, 'source': source_name(name), 'ra': d['m0']['value'], 'dec': d['m1']['value'],
+		                       'nscans': len(scans), 'time': sum(sc['duration'] for sc in scans)})
+	for i in range(msmd.nspw()):
+		freqs = msmd.chanfreqs(i)
+		meta['spws'].append({'id': i, 'nchan': len(freqs), 'reffreq': msmd.reffreq(i)['m0']['value'], 'minfreq': float(freqs.min()),
+		                     'maxfreq': float(freqs.max()), 'chanwidth': float(abs(msmd.chanwidths(i)).max())})
+	msmd.done()
+	meta['duration'] = max(sc['start']+sc['duration'] for sc in meta['scans'])-min(sc['start'] for sc in meta['scans'])
+	with open(sidecar, 'w') as fme:
+		json.dump(meta, fme, indent=1)
+	return meta
+
+def calibrator_flux(source, freq):
+	# Perley-Butler flux density (Jy) of a calibrator with a pol_<source>.txt table, at freq (Hz)
+	an = np.loadtxt("pol_"+source+".txt", skiprows=1, ndmin=2)[:,3]
+	return 10**np.polynomial.polynomial.polyval(np.log10(freq/1e9), an)
+
+def auto_config(meta):
+	# calibrator roles, channel ranges and calibrator clip limits derived from meta, for the ones left empty ('' or [])
+	conf = {}
+	def value(k):
+		return conf.get(k, globals()[k])
+	def fill(k, v):
+		if len(globals()[k]) == 0:
+			conf[k] = v
+	ids = dict((f['source'], str(f['id'])) for f in reversed(meta['fields']) if f['source'] in known_sources)
+	fluxcal = ([ids[s] for s in ['3C286', '3C48', '3C138'] if s in ids]+[None])[0]
+	if fluxcal is not None:
+		for k in ['fluxfield', 'bpassfield', 'kcorrfield']:
+			fill(k, fluxcal)
+	polcals = [ids[s] for s in ['3C286', '3C138', '3C48'] if s in ids]   # 3C286 first: recommended for leakage
+	if len(polcals) > 0:
+		fill('polcalib1', polcals[0])
+		fill('polcalib2', polcals[1] if len(polcals) > 1 else polcals[0])
+	unpol = [ids[s] for s in ['3C84', 'OQ208'] if s in ids]              # 3C84 first: OQ208 is too faint for leakage
+	if len(unpol) > 0:
+		fill('unpolcalib1', unpol[0])
+	# of the other fields not given a role, the phase calibrator has the most (and shortest) scans and the targets get the most time
+	given = [f.strip() for k in ['target', 'secondaryfield', 'anofield'] for f in globals()[k].split(',') if f.strip() != '']
+	others = [f for f in meta['fields'] if f['source'] not in known_sources and f['nscans'] > 0 and str(f['id']) not in given]
+	if secondaryfield == '' and len(others) >= (2 if target == '' else 1):
+		phasecal = max(others, key=lambda f: (f['nscans'], -f['time']/f['nscans']))
+		fill('secondaryfield', str(phasecal['id']))
+		others = [f for f in others if f is not phasecal]
+	others = sorted(others, key=lambda f: -f['time'])
+	if target == '' and len(others) > 0:
+		targets = [f for f in others if f['time'] >= 0.25*others[0]['time']]
+		fill('target', ','.join(str(f['id']) for f in targets))
+		others = [f for f in others if f not in targets]
+	if len(others) > 0:
+		fill('anofield', str(others[0]['id']))
+	cals = [value(k) for k in ['unpolcalib1', 'secondaryfield', 'fluxfield', 'polcalib2'] if value(k) != '']
+	fill('gaincals', ','.join(sorted(set(cals), key=cals.index)))
+	transfer = [value(k) for k in ['unpolcalib1', 'secondaryfield', 'polcalib2', 'anofield'] if value(k) != '']
+	fill('transferfield', ','.join(sorted(set(f for f in transfer if f != value('fluxfield')), key=transfer.index)))
+	# central 75% of the band for calibration, before and after the target averaging
+	nchan = meta['spws'][0]['nchan']
+	fill('gainspw', '0:%d~%d' % (nchan//8-1, nchan-nchan//8-1))
+	fill('gainspw2', '0:%d~%d' % (nchan//specave//8, nchan//specave-nchan//specave//8-1))
+	# clip limits of the calibrators with a flux model, at the top of the band where the model is brightest
+	freqs = [meta['spws'][0]['minfreq'], meta['spws'][0]['maxfreq']]
+	for field, clip in [(value('fluxfield'), 'clipfluxcal'), (value('polcalib2'), 'clippolcalib2')]:
+		if field == '':
+			continue
+		source = meta['fields'][int(field)]['source']
+		if os.path.exists("pol_"+source+".txt"):
+			fill(clip, [0.0, round(float(clipfactor*max(calibrator_flux(source, f) for f in freqs)), 1)])
+	return conf
+
+####################################################################################################################################
+
+#FITS files
+#Plain readers and writers for the FITS files the pipeline handles itself: the random-groups UV FITS written by gvfits, and the
+#images written by exportfits. Headers are kept as lists of 80-character cards, and data are read through numpy memory maps,
+#so that no file is ever loaded whole.
+
+fits_types={8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+def fits_cards(f):
+	# the header at the current position of f, as its cards up to END
+	cards = []
+	while True:
+		block = f.read(2880)
+		if len(block) < 2880:
+			raise IOError("FITS header without END in "+f.name)
+		for i in range(0, 2880, 80):
+			card = block[i:i+80].decode('ascii')
+			cards.append(card)
+			if card[:8].strip() == 'END':
+				return cards
+
+def fits_value(cards, key, default=None):
+	for card in cards:
+		if card[:8].strip() == key and card[8:10] == '= ':
+			v = card[10:].strip()
+			if v.startswith("'"):
+				return v[1:v.index("'", 1)].rstrip()
+			v = v.split('/')[0].strip()
+			if v in ('T', 'F'):
+				return v == 'T'
+			try:
+				return int(v)
+			except ValueError:
+				return float(v.replace('D', 'E'))
+	return default
+
+def fits_card(key, value, comment=''):
+	if isinstance(value, bool):
+		v = '%20s' % ('T' if value else 'F')
+	elif isinstance(value, str):
+		v = "%-20s" % ("'%-8s'" % value.replace("'", "''"))
+	elif isinstance(value, (int, np.integer)):
+		v = '%20d' % value
+	else:
+		v = '%20s' % repr(float(value)).upper()
+	return ('%-8s= %s%s' % (key, v, ' / '+comment if comment != '' else ''))[:80].ljust(80)
+
+def fits_set(cards, key, value, comment=''):
+	# cards with key set to value, added before END if it is not there yet
+	card = fits_card(key, value, comment)
+	for i in range(len(cards)):
+		if cards[i][:8].strip() == key:
+			return cards[:i]+[card]+cards[i+1:]
+	return cards[:-1]+[card, cards[-1]]
+
+def fits_header_bytes(cards):
+	head = ''.join(cards).encode('ascii')
+	return head+b' '*(-len(head) % 2880)
+
+def fits_data_size(cards):
+	# bytes of data after a header (random groups, images and tables alike), without the padding
+	naxis = [fits_value(cards, 'NAXIS%d' % i) for i in range(1, fits_value(cards, 'NAXIS')+1)]
+	if len(naxis) == 0:
+		return 0
+	n = int(np.prod(naxis[1:] if fits_value(cards, 'GROUPS', False) == True else naxis))
+	return abs(fits_value(cards, 'BITPIX'))//8*fits_value(cards, 'GCOUNT', 1)*(fits_value(cards, 'PCOUNT', 0)+n)
+
+def fits_hdus(fitsfile):
+	# (cards, offset of the data, size of the data) of every HDU of fitsfile
+	hdus = []
+	with open(fitsfile, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		while f.tell() < size:
+			cards = fits_cards(f)
+			start = f.tell()
+			nbytes = fits_data_size(cards)
+			hdus.append((cards, start, nbytes))
+			f.seek(start+nbytes+(-nbytes % 2880))
+	return hdus
+
+def fits_table_columns(cards):
+	# name -> (byte offset in a row, numpy type, repeat) of the columns of a binary table
+	sizes = {'L': 1, 'X': 1, 'B': 1, 'I': 2, 'J': 4, 'K': 8, 'A': 1, 'E': 4, 'D': 8, 'C': 8, 'M': 16}
+	types = {'L': 'u1', 'X': 'u1', 'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8', 'A': 'S1', 'E': '>f4', 'D': '>f8', 'C': '>c8', 'M': '>c16'}
+	cols = {}
+	offset = 0
+	for i in range(1, fits_value(cards, 'TFIELDS')+1):
+		form = re.match(r'(\d*)([A-Z])', fits_value(cards, 'TFORM%d' % i))
+		repeat = int(form.group(1) or 1)
+		cols[fits_value(cards, 'TTYPE%d' % i)] = (offset, types[form.group(2)], repeat)
+		offset += repeat*sizes[form.group(2)]
+	return cols
+
+def fits_table_column(fitsfile, hdu, name):
+	# one column of the binary table in hdu (from fits_hdus), one entry per row
+	cards, start, nbytes = hdu
+	offset, dtype, repeat = fits_table_columns(cards)[name]
+	rows = np.memmap(fitsfile, dtype='u1', mode='r', offset=start, shape=(fits_value(cards, 'NAXIS2'), fits_value(cards, 'NAXIS1')))
+	col = rows[:,offset:offset+repeat*np.dtype(dtype).itemsize].copy()
+	if dtype == 'S1':
+		return [bytes(r).decode('ascii').strip('\x00 ') for r in col]
+	col = col.view(dtype)
+	return col[:,0] if repeat == 1 else col
+
+def ingest_fits(fitsfile, outfile, record):
+	# Copy the random-groups file fitsfile to outfile in chunks of ingestchunk bytes, without the visibilities of the antennas
+	# in badants and the channels above maxfreq. What was dropped is returned and written to record.
+	t0 = time.time()
+	hdus = fits_hdus(fitsfile)
+	cards, start, nbytes = hdus[0]
+	if fits_value(cards, 'GROUPS', False) != True:
+		raise ValueError(fitsfile+" is not a random-groups UV FITS file")
+	naxis = [fits_value(cards, 'NAXIS%d' % i) for i in range(2, fits_value(cards, 'NAXIS')+1)]
+	ctype = [fits_value(cards, 'CTYPE%d' % i, '') for i in range(2, len(naxis)+2)]
+	pcount, gcount = fits_value(cards, 'PCOUNT'), fits_value(cards, 'GCOUNT')
+	dtype = np.dtype(fits_types[fits_value(cards, 'BITPIX')])
+	# channels above maxfreq are cut from the end of the frequency axis, so the channel numbers of the others do not change
+	k = ctype.index('FREQ')
+	nchan = naxis[k]
+	freqs = fits_value(cards, 'CRVAL%d' % (k+2))+(np.arange(nchan)+1-fits_value(cards, 'CRPIX%d' % (k+2)))*fits_value(cards, 'CDELT%d' % (k+2))
+	keep = nchan
+	above = freqs > maxfreq if maxfreq > 0 else np.zeros(nchan, bool)
+	if above.any() and above[-1] and not above[0]:
+		keep = int(np.argmax(above))
+	elif above.any():
+		print ("Channels above %.1f MHz are not at the end of the band in %s, keeping them" % (maxfreq/1e6, fitsfile))
+	# antenna numbers of badants, from the AN table
+	an = [h for h in hdus[1:] if fits_value(h[0], 'EXTNAME') == 'AIPS AN']
+	antennas = dict(zip(fits_table_column(fitsfile, an[0], 'ANNAME'), fits_table_column(fitsfile, an[0], 'NOSTA'))) if len(an) > 0 else {}
+	bad = [int(antennas[a]) for a in badants if a in antennas]
+	for a in badants:
+		if a not in antennas:
+			print ("Antenna "+a+" is not in "+fitsfile+", it is flagged after import instead")
+	ptype = [fits_value(cards, 'PTYPE%d' % i, '') for i in range(1, pcount+1)]
+	ib = ptype.index('BASELINE')
+	pscal, pzero = fits_value(cards, 'PSCAL%d' % (ib+1), 1.0), fits_value(cards, 'PZERO%d' % (ib+1), 0.0)
+	shape = tuple(naxis[::-1])
+	chanaxis = 1+len(naxis)-1-k   # of a chunk of groups, in C order
+	groupsize = pcount+int(np.prod(naxis))
+	groups = np.memmap(fitsfile, dtype=dtype, mode='r', offset=start, shape=(gcount, groupsize))
+	step = max(1, ingestchunk//(groupsize*dtype.itemsize))
+	outcards = fits_set(cards, 'NAXIS%d' % (k+2), keep)
+	ngood = 0
+	with open(outfile, 'wb') as fo, open(fitsfile, 'rb') as fi:
+		fo.write(fits_header_bytes(outcards))
+		for g0 in range(0, gcount, step):
+			chunk = np.asarray(groups[g0:g0+step])
+			baseline = np.floor(chunk[:,ib].astype(float)*pscal+pzero).astype(int)   # 256*ant1+ant2, the subarray in the fraction
+			good = ~(np.isin(baseline//256, bad) | np.isin(baseline % 256, bad))
+			data = chunk[good,pcount:].reshape((-1,)+shape)
+			sel = [slice(None)]*data.ndim
+			sel[chanaxis] = slice(0, keep)
+			data = data[tuple(sel)]
+			fo.write(np.concatenate([chunk[good,:pcount], data.reshape(len(data), -1)], axis=1).astype(dtype).tobytes())
+			ngood += int(good.sum())
+		fo.write(b'\0'*(-fo.tell() % 2880))
+		# the tables as they are, but for the total bandwidth of the frequency table
+		for hcards, hstart, hbytes in hdus[1:]:
+			fo.write(fits_header_bytes(hcards))
+			fi.seek(hstart)
+			raw = fi.read(hbytes+(-hbytes % 2880))
+			if fits_value(hcards, 'EXTNAME') == 'AIPS FQ' and keep < nchan:
+				cols = fits_table_columns(hcards)
+				if 'TOTAL BANDWIDTH' in cols:
+					offset, coltype, repeat = cols['TOTAL BANDWIDTH']
+					rows = np.frombuffer(raw[:hbytes], 'u1').copy().reshape(fits_value(hcards, 'NAXIS2'), fits_value(hcards, 'NAXIS1'))
+					n = repeat*np.dtype(coltype).itemsize
+					bw = rows[:,offset:offset+n].copy().view(coltype)*keep/float(nchan)
+					rows[:,offset:offset+n] = bw.astype(coltype).view('u1')
+					raw = rows.tobytes()+raw[hbytes:]
+			fo.write(raw)
+		fo.seek(0)
+		fo.write(fits_header_bytes(fits_set(outcards, 'GCOUNT', ngood)))
+	dropped = {'fitsfile': fitsfile, 'output': outfile, 'antennas': [a for a in badants if a in antennas],
+	           'channels': [keep, nchan-1] if keep < nchan else [], 'freqrange': [float(freqs[keep]), float(freqs[-1])] if keep < nchan else [],
+	           'groups': [gcount, ngood], 'bytes': [os.path.getsize(fitsfile), os.path.getsize(outfile)], 'wall': time.time()-t0}
+	with open(record, 'w') as frc:
+		json.dump(dropped, frc, indent=1)
+	print ("Ingested %s: %d of %d visibility records and %d of %d channels kept, %.2f GB of %.2f GB, in %.1f s"
+	       % (fitsfile, ngood, gcount, keep, nchan, dropped['bytes'][1]/1e9, dropped['bytes'][0]/1e9, dropped['wall']))
+	return dropped
+
+####################################################################################################################################
+
 #Initializing steps and conversions ---- Janhavi Baghel
-print ("Starting conversion of TEST.FITS to multi.ms")
-importgmrt(fitsfile='TEST.FITS', vis='multi.ms')
-#
+fitsfile='TEST.FITS'     # '' starts from an existing multi.ms (e.g. a simulated one)
 ms='multi.ms'
+badants=['C03']          # non-working antennas from the observer log
+maxfreq=820e6            # Hz, channels above it are not used (see README); 0 keeps all
+ingest=True              # stream fitsfile into a copy without badants and the channels above maxfreq before importgmrt
+ingestchunk=256*1024**2  # bytes read at a time when ingesting
+apply_overrides()
 #
-print ("List observations")  #A listobs step necessary to initialize parameters ---- Janhavi Baghel
-listobs(vis=ms)
-#  
-print ("Flagging bad antenna") #Flagging non-workin antenna as given in the observer log ---- Janhavi Baghel
-default(flagdata)
-flagdata(vis=ms, mode='manual', field ='', spw='', antenna='C03', timerange='', correlation='')
+importparams = {'fitsfile':fitsfile, 'usemms':usemms, 'mmsaxis':mmsaxis, 'mmsnumsubms':mmsnumsubms, 'badants':badants}
+if fitsfile != '' and ingest == True:
+	importparams.update({'ingest':ingest, 'maxfreq':maxfreq})
+if stage_start('import', ms, importparams):
+	flagants = badants   # bad antennas still in the MS
+	if fitsfile != '':
+		clear_products(ms, ms+'.flagversions', 'multi.mms')
+		source = fitsfile
+		if ingest == True:
+			# what was dropped is recorded in ms+'.ingest.json'
+			source = ms+'.ingest.fits'
+			print ("Streaming "+fitsfile+" into "+source)
+			dropped = ingest_fits(fitsfile, source, ms+'.ingest.json')
+			flagants = [a for a in badants if a not in dropped['antennas']]
+		print ("Starting conversion of "+source+" to "+ms)
+		importgmrt(fitsfile=source, vis=ms)
+		if ingest == True:
+			os.remove(source)
+	else:
+		clear_products('multi.mms')
+		print ("Using existing "+ms)
+	#
+	print ("List observations")  #A listobs step necessary to initialize parameters ---- Janhavi Baghel
+	listobs(vis=ms, listfile=ms+'.listobs', overwrite=True)
+	ms_metadata(ms)
+	#  
+	if len(flagants) > 0:
+		print ("Flagging bad antenna") #Flagging non-workin antenna as given in the observer log ---- Janhavi Baghel
+		flagdata(vis=ms, mode='manual', field ='', spw='', antenna=','.join(flagants), timerange='', correlation='')
+	if usemms == True:
+		print ("Partitioning "+ms+" into multi.mms")
+		partition(vis=ms, outputvis='multi.mms', separationaxis=mmsaxis, numsubms=mmsnumsubms, flagbackup=False)
+	stage_end('import', 'multi.mms' if usemms == True else ms)
 #
 
-#These steps can be put in a separate init.py file and the output of listobs() then read to fill in initializing parameters
+#With autoconfig=True, the field roles, gainspw/gainspw2 and clipfluxcal/clippolcalib2 below that are left empty ('' or [])
+#are filled in from the metadata sidecar written at import; the values typed in are always kept
 ####################################################################################################################################
 
 print ("Initializing parameters") 
 
 ms='multi.ms'
+if usemms == True:
+	ms='multi.mms'      # partitioned at import
 #
 flagspw = ''   # 
 gainspw = '0:255~1791 '   # central ~ 75% good channel range for calibration
@@ -63,6 +1076,12 @@ specave = 7              # number of channels to average; suggested post-average
                          # 1.5 MHz at band-5; 0.7 MHz at band-4; 0.4 MHz at band-3; 0.1 MHz at band-2
 timeave = '0s'           # time averaging
 gainspw2 = '0:36~256'   # central good channels after split for self-cal
+autoaverage=True         # Choose the channel and time averaging of the target split from smearloss instead of specave/timeave
+                         # (gainspw2 is given for specave channels and rescaled to the chosen averaging)
+smearloss=0.05           # largest peak loss from bandwidth plus time smearing at smearradius
+smearradius=0.51         # radius where smearloss applies, in lambda/D at the lowest frequency: 0.51 is the half power point
+                         # of the primary beam, 1.22 the null at the edge of the planned image (leaves little to average)
+bdaverage=False          # Baseline-dependent time averaging: short baselines are averaged longer, up to the self-cal solution interval
 #
 bpassfield     = '3'     # field number of the bandpass calibratorar, add phasecal if strong enough
 fluxfield      = '3'     # field number of the primary flux calibrator
@@ -71,8 +1090,8 @@ anofield       = '5'     # field number of another field in your ms file ------
 gaincals       ='0,2,3,4'    # All calibrators
 kcorrfield     = '3'     # field number of the antenna-based delay calibrator
 target         = '1'     # If more than one target, use target='2,3,4...', 
-                         # BUT modify the pipelines to name and split the targets correctly
-                         # GO TO LINE 149 and 620 to edit the target field ------ Janhavi Baghel
+                         # each target is split into <field name>.ms and self-calibrated and imaged on its own
+                         # ('' with autoconfig: the fields with the most time)
 refant='18'              # use only one option and refantmode 'strict' . 
 			 #With uGMRT's antenna configuration, it is better to use one of the outer antennas for reference, 
 			 #which provides longer baselines and more stable phase solutions.------ Janhavi Baghel
@@ -135,26 +1154,81 @@ startniter=2500        # start iterations (will double in each phase-selfcal and
 imagesize=[6000,6000]  # should cover alteast up to null at lower part of the band
 cellsize='0.8arcsec'   # should be atleast 3 pixels in minor axis
 wproj=-1               # w projection, default autocalculate
+autogeometry=True      # Plan imagesize, cellsize and wproj from the split target MS instead of using the three values above
+dishdiameter=45.0      # m, the planned image reaches the primary beam null (1.22 lambda/D) at the lowest frequency
+pixperbeam=4           # pixels across the resolution of the longest baseline at the highest frequency (at least 3)
 eachQUV=False	       # Create Stokes Q and U images for each self-cal iteration. ----- Janhavi Baghel
 dirtyQUV=True           # Create Stokes Q and U images for dirty image. ----- Janhavi Baghel
 createV=False		 # Create Stokes V image ----- Janhavi Baghel
+quvworkers=3           # Stokes products imaged at the same time (also limited by free memory); 1 images them one after another
+targetworkers=2        # targets self-calibrated at the same time (also limited by free memory); their Stokes products are then
+                       # imaged one after another
+jointQUV=False         # Image Q/U (and V) in one tclean run with a shared gridding pass and PSF instead of one run per product
+convergetol=0.02       # stop a self-cal loop once a cycle improves neither the dynamic range nor the residual rms by this fraction;
+                       # a cycle that lowers the dynamic range by more than it is discarded. Negative: always run all cycles
+maxsolflag=0.3         # stop a self-cal loop, discarding the cycle, when more than this fraction of its gain solutions is flagged
+reusepsf=True          # Reuse the PSF of an earlier tclean with the same geometry, weighting and uv sampling (flags and weights):
+                       # the Stokes images of a cycle share it, later cycles only where flagging changed nothing
+psfcache='psf_cache'   # directory of the cached PSF, sumwt, weight and pb images
+psfcachesize=4         # PSFs kept in psfcache, the least recently used are dropped first
+polmaps=True           # Maps of debiased P, PA and fractional polarization (and errors) from the final I/Q/U images (stage polmaps)
+polsnr=3.0             # PA and fractional polarization where the debiased P is above this many times the Q/U noise
+isnr=5.0               # fractional polarization where Stokes I is above this many times its noise
+polblock=64*1024**2    # bytes of the I/Q/U images and the maps per tile
+rmsynth=False          # Image Q/U cubes of the final self-cal image and run RM synthesis on them (stage RM)
+rmnchan=64             # channels of the Q/U cubes
+rmphimax=0.0           # rad/m^2, largest Faraday depth; 0 takes it from the channel width
+rmdphi=0.0             # rad/m^2, Faraday depth step; 0 takes a third of the RMSF width
+rmclean=False          # RM-CLEAN the Faraday spectra
+rmcleancutoff=5.0      # RM-CLEAN down to this many times the noise of the Faraday spectra
+rmcleaniter=100        # largest number of RM-CLEAN components per pixel
+rmblock=256*1024**2    # bytes of spectra per block of rows
+rmworkers=4            # blocks processed at the same time
+retain='prune'         # tclean products of the self-cal images the loop replaces or discards: 'all' keeps them, 'prune' deletes
+                       # them, 'compress' packs them into .tar.gz files; the adopted (final) image is always kept whole
+keepproducts=[]        # products of the replaced images kept all the same, e.g. ['model', 'mask']
+exportproducts=[]      # products exported as <image>.<product>.fits, e.g. ['residual.tt0', 'model.tt0']
+scratchdir=''          # fast local directory for the tclean products ('' keeps them next to the MS); must persist for resuming
+####################################################################################################################################
+#Polarization model parameters
+polorder=2             # order of the PF/PA polynomials in (f-f0)/f0; 3 adds the c3/d3 terms
+fluxstandard='Perley-Butler 2017'  # flux density standard setjy uses for the Stokes I of the polarized calibrators
+polcache='polmodel_cache.json'     # on-disk cache of the fitted calibrator models ('' disables it)
+polcachesize=32        # models kept in polcache, the least recently used are dropped first
+####################################################################################################################################
+#Flagging parameters
+batchflag=True         # Run all steps of a flagging round as one flagdata list-mode pass (False: one pass per step)
+flagreport=ms+'.flagreport.txt'  # Wall time and bytes read of each flagging round are appended here
+planapply=True         # Group fields with equivalent gainfield mappings into as few applycal calls as possible (False: one call per field)
+flagengine={}          # Engine of the tfcrop/rflag steps by step name, 'casa' or 'sumthreshold' (steps not listed use CASA). Steps: flag0-cal,
+                       # flag0-target, flag1-cal-tfcrop, flag1-cal-rflag, flag1-target-tfcrop, flag1-target-rflag, split-rflag, selfcal-rflag
+####################################################################################################################################
+#Automatic configuration
+autoconfig=True        # Derive the field roles, gainspw/gainspw2 and calibrator clip limits left empty from the metadata sidecar
+clipfactor=5.0         # clip limit of a calibrator with a flux model, in units of its brightest expected flux density
+apply_overrides()
+
+meta = ms_metadata(ms)
+if autoconfig == True:
+	conf = auto_config(meta)
+	for k in sorted(conf):
+		if conf[k] != globals()[k]:
+			print ("Configured %-15s %-24s (was %s)" % (k, conf[k], globals()[k]))
+	globals().update(conf)
+	apply_overrides()
 ####################################################################################################################################
 #For polarization calibration; ----- Janhavi Baghel
 #
 print ("Making polarization calibration models") 
 import numpy as np
-from scipy.optimize import curve_fit
+from math import factorial
 
 def refreq_function():
-	msmd.open(ms)
-	# get reference frequency
-	reffreq0 = msmd.reffreq(0)
-	# get list of field names in the ms
-	fieldnames = msmd.fieldnames()
-	msmd.done()
-	v = (reffreq0['m0']['value'])
-	u = (reffreq0['m0']['unit'])
+	# reference frequency and field names, from the metadata sidecar
+	v = meta['spws'][0]['reffreq']
+	u = 'Hz'
 	w = str(v)+u
+	fieldnames = [f['name'] for f in meta['fields']]
 	return v,u,w,fieldnames
 
 reffreqfull = refreq_function()
@@ -163,67 +1237,113 @@ reffrequnit = reffreqfull[1]
 reffreq = reffreqfull[2]
 fieldnames = reffreqfull[3]
 
-def pol_model(p): 
-	myset=setjy(vis=ms, field = p, spw = '', scalebychan=True)
-	i0 = (myset [p]['0']['fluxd'][0]) # Stokes I value from setjy
-	name = (myset [p]['fieldName']) #Name of the polarized calibrator
-	data = np.loadtxt("pol_"+name+".txt", skiprows=1) # data is stored in corresponding .txt file
-
-	f=data[:,0] #Frequency
-	pp=data[:,1] #Percent polarization
-	pf = pp/100 #Fraction polarization
-	pa=data[:,2] # Polarization angle
-	an=data[:,3] # Coefficients for Polynomial Expressions for the Flux Densities (Perley and Butler, 2017)
-
-	#Reference frequency in GHz
-	if reffrequnit =="Hz":
-		f0=reffreqval /(10**9)
-	elif reffrequnit =="MHz":
-		f0=reffreqval/(10**3)
-	elif reffrequnit =="GHz":
-		f0=reffreqval 
-
-	# For polindices c0, c1 are the coefficients in the polynomial expansion of fractional polarization as function of frequency
-	def PF(f, c0, c1, c2): #add c3 if needed
-		return c0 + c1*((f-f0)/f0)+ c2*((f-f0)/f0)**2 # + c3*((f-f0)/f0)**3
-
-	coeffs1, cov1 = curve_fit(PF,f,pf)
-	polindices = (coeffs1)
-
-	# For polangles d0, d1 are the coefficients in the polynomial expansion of polarization angle as function of frequency
-	def PA(f, d0, d1, d2): #add d3 if needed
-       	 return d0 + d1*((f-f0)/f0) + d2*((f-f0)/f0)**2 # + d3*((f-f0)/f0)**3
-
-	coeffs2, cov2 = curve_fit(PA,f,pa)
-	polangles = (coeffs2*pi/180)
-	# For alphabeta, alpha is spectral index and beta is curvature
-	def F(f, *an):
-        	return an[0] + an[1]*np.log10(f) + an[2]*(np.log10(f))**2 # + an[3]*(np.log10(f))**3
-
-	S=10**(F(f,*an))
-		
-	def fr(i):
-    		return 0.00128/(2**i)
-
-	f3 = (f0-fr(np.arange(0,50))).tolist()+[f0]+(f0+fr(np.arange(0,50))).tolist()
-	S3 = 10**(F(f3,*an))
-	def Sa(f,Sa,alpha,beta):
-       	 return Sa*(f/f0)**(alpha+beta*np.log10(f/f0))
-
-	popt, pcov = curve_fit(Sa, f3, S3)
-	alphabeta= (popt)
-	
-	return i0,name,polindices,polangles,alphabeta
+#Reference frequency in GHz
+if reffrequnit =="Hz":
+	f0=reffreqval /(10**9)
+elif reffrequnit =="MHz":
+	f0=reffreqval/(10**3)
+elif reffrequnit =="GHz":
+	f0=reffreqval 
+
+def fit_pol_models(names, f0, order=2):
+	# Fits the pol_<name>.txt tables of all calibrators in names in one vectorized call.
+	# PF and PA are polynomials in (f-f0)/f0 that are linear in their coefficients (c0, c1, c2[, c3] and d0, d1, d2[, d3]),
+	# so they are solved as a batch of weighted linear least-squares problems; tables with fewer rows are padded with zero weight.
+	# Returns polindices, polangles (radians), alphabeta ([Sa, alpha, beta]) and the covariances of each, one row per calibrator.
+	tables = [np.loadtxt("pol_"+name+".txt", skiprows=1, ndmin=2) for name in names] # data is stored in corresponding .txt file
+	ncal = len(tables)
+	nrow = max(len(t) for t in tables)
+	f = np.ones((ncal, nrow))    # Frequency
+	pf = np.zeros((ncal, nrow))  # Fraction polarization
+	pa = np.zeros((ncal, nrow))  # Polarization angle
+	an = np.zeros((ncal, nrow))  # Coefficients for Polynomial Expressions for the Flux Densities (Perley and Butler, 2017)
+	w = np.zeros((ncal, nrow))
+	for i in range(ncal):
+		n = len(tables[i])
+		f[i,:n] = tables[i][:,0]
+		pf[i,:n] = tables[i][:,1]/100
+		pa[i,:n] = tables[i][:,2]
+		an[i,:n] = tables[i][:,3]
+		w[i,:n] = 1.0
+
+	k = order+1
+	A = ((f-f0)/f0)[:,:,None]**np.arange(k)          # (ncal, nrow, k)
+	y = np.stack([pf, pa], axis=-1)                   # (ncal, nrow, 2)
+	ATA = np.einsum('cnk,cn,cnl->ckl', A, w, A)
+	ATAinv = np.linalg.pinv(ATA)
+	coeffs = np.einsum('ckl,cnl,cn,cnm->ckm', ATAinv, A, w, y)
+	resid = y - np.einsum('cnk,ckm->cnm', A, coeffs)
+	# residual variance as in curve_fit (absolute_sigma=False); infinite when there are no degrees of freedom left
+	dof = w.sum(axis=1) - k
+	chi2 = np.einsum('cn,cnm->cm', w, resid**2)
+	s2 = np.where(dof[:,None] > 0, chi2/np.maximum(dof, 1)[:,None], np.inf)
+	cov = ATAinv[:,None,:,:]*s2[:,:,None,None]      # (ncal, 2, k, k)
+
+	polindices = coeffs[:,:,0]
+	polangles = coeffs[:,:,1]*np.pi/180
+	covpolindices = cov[:,0]
+	covpolangles = cov[:,1]*(np.pi/180)**2
+
+	# For alphabeta, alpha is spectral index and beta is curvature of S = Sa*(f/f0)**(alpha+beta*log10(f/f0)).
+	# With log10(f) = log10(f0) + x, the Perley-Butler polynomial sum(a_j*log10(f)**j) expands exactly to
+	# sum_k x**k * sum_j binom(j,k)*a_j*log10(f0)**(j-k), so log10(Sa), alpha and beta are its first three coefficients.
+	L0 = np.log10(f0)
+	T = np.zeros((nrow, 3))
+	for j in range(nrow):
+		for m in range(min(j, 2)+1):
+			T[j,m] = factorial(j)/(factorial(m)*factorial(j-m))*L0**(j-m)
+	b = an.dot(T)
+	alphabeta = np.stack([10**b[:,0], b[:,1], b[:,2]], axis=-1)
+	covalphabeta = np.zeros((ncal, 3, 3))   # exact expansion of the tabulated coefficients
+
+	return polindices, polangles, alphabeta, covpolindices, covpolangles, covalphabeta
+
+def pol_models(fields): 
+	# Models of the polarized calibrators in fields. They are read from polcache when the calibrator, the reference frequency,
+	# its pol_<name>.txt table, the flux standard and polorder are unchanged; the others get i0 from setjy and are fitted together.
+	names = [source_name(fieldnames[int(p)]) for p in fields] #Name of the polarized calibrator
+	keys = [json.dumps([name, reffreq, path_digest("pol_"+name+".txt"), fluxstandard, polorder]) for name in names]
+	cache = {}
+	if polcache != '' and os.path.exists(polcache):
+		with open(polcache) as fpc:
+			cache = json.load(fpc)
+	miss = [i for i in range(len(fields)) if keys[i] not in cache]
+	if len(miss) > 0:
+		fits = fit_pol_models([names[i] for i in miss], f0, polorder)
+		for n in range(len(miss)):
+			p = fields[miss[n]]
+			myset=setjy(vis=ms, field = p, spw = '', scalebychan=True, standard=fluxstandard)
+			cache[keys[miss[n]]] = {'i0': myset [p]['0']['fluxd'][0], # Stokes I value from setjy
+			                        'polindices': fits[0][n].tolist(), 'polangles': fits[1][n].tolist(), 'alphabeta': fits[2][n].tolist(),
+			                        'cov': [fits[3][n].tolist(), fits[4][n].tolist(), fits[5][n].tolist()]}
+	for i in range(len(fields)):
+		if i not in miss:
+			print ("Polarization model of "+names[i]+" taken from "+polcache)
+		cache[keys[i]]['used'] = time.time()
+	models = []
+	for i in range(len(fields)):
+		c = cache[keys[i]]
+		models.append((c['i0'], names[i], np.array(c['polindices']), np.array(c['polangles']), np.array(c['alphabeta']),
+		               tuple(np.array(x) for x in c['cov'])))
+	if polcache != '':
+		# least recently used entries are dropped first
+		for k in sorted(cache, key=lambda k: cache[k]['used'])[:max(0, len(cache)-polcachesize)]:
+			del cache[k]
+		with open(polcache, 'w') as fpc:
+			json.dump(cache, fpc, indent=1)
+	return models
 #
+polmodels = pol_models([polcalib1, polcalib2])
+
 #For polarized calibrator 1
-polmodel_1 = pol_model(polcalib)
-i0_1 = polmodel[0]
-polindices_1 = polmodel[2]
-polangles_1 = polmodel[3]
-alphabeta_1 =polmodel[4][1:3]
+polmodel_1 = polmodels[0]
+i0_1 = polmodel_1[0]
+polindices_1 = polmodel_1[2]
+polangles_1 = polmodel_1[3]
+alphabeta_1 =polmodel_1[4][1:3]
 
 #For polarized calibrator 2
-polmodel2 = pol_model(polcalib2)
+polmodel2 = polmodels[1]
 i0_2 = polmodel2[0]
 polindices_2 = polmodel2[2]
 polangles_2 = polmodel2[3]
@@ -231,10 +1351,9 @@ alphabeta_2 = polmodel2[4][1:3]
 
 ###################################################################################################################################
 print ("Measurement set contains :")
-print ("Target : " + fieldnames[int(target)]) # If more than one target, use target1='1', target2 ='6', ... 
-# target1 = '1'
-# target2 = '6'
-#print ("Target : " + fieldnames[int(target1)] + ', ' + fieldnames[int(target2)])
+targets = [t.strip() for t in target.split(',')]
+for t in targets:
+	print ("Target : " + fieldnames[int(t)])
 print ("\n")
 print ("Reference frequency : " + reffreq)
 print ("\n")
@@ -256,572 +1375,1433 @@ print ("Polarization Calibrator 3 (unpolarized): " + fieldnames[int(unpolcalib1)
 ####################################################################################################################################
 print ("First Round of Flagging") 
 
-default(flagdata)
-#Flag using 'clip' option to remove high points for calibrators
-print ("Flagging Step 1/11") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=fluxfield, clipminmax=clipfluxcal,
-        datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-print ("Flagging Step 2/11") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=secondaryfield, clipminmax=clipphasecal,
-        datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-print ("Flagging Step 3/11") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=anofield, clipminmax=clipanofield,
-        datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-print ("Flagging Step 4/11") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=polcalib2, clipminmax=clippolcalib2,
-        datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-print ("Flagging Step 5/11") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=unpolcalib1, clipminmax=clipunpolcalib1,
-        datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-# After clip, now flag using 'tfcrop' option for calibrator tight flagging
-print ("Flagging Step 6/11") 
-flagdata(vis=ms,mode="tfcrop", datacolumn="DATA", field=gaincals, ntime="scan",
-        timecutoff=3.0, freqcutoff=3.0, timefit="line",freqfit="line",flagdimension="freqtime", 
-        extendflags=False, timedevscale=4.0,freqdevscale=4.0, extendpols=False,growaround=False,
-        action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now extend the flags (80% more means full flag, change if required)
-print ("Flagging Step 7/11") 
-flagdata(vis=ms,mode="extend",spw=flagspw,field=gaincals,datacolumn="DATA",clipzeros=True,
-         ntime="scan", extendflags=False, extendpols=True,growtime=80.0, growfreq=80.0,growaround=False,
-         flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now flag for target - moderate flagging, more flagging in self-cal cycles
-#Flag using 'clip' option to remove high points for target
-print ("Flagging Step 8/11") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=target, clipminmax=cliptarget,
-        datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-# After clip, now flag using 'tfcrop' option for target
-print ("Flagging Step 9/11") 
-flagdata(vis=ms,mode="tfcrop", datacolumn="DATA", field=target, ntime="scan",
-        timecutoff=4.0, freqcutoff=4.0, timefit="poly",freqfit="poly",flagdimension="freqtime", 
-        extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-        action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now extend the flags (80% more means full flag, change if required)
-print ("Flagging Step 10/11") 
-flagdata(vis=ms,mode="extend",spw=flagspw,field=target,datacolumn="DATA",clipzeros=True,
-         ntime="scan", extendflags=False, extendpols=True,growtime=80.0, growfreq=80.0,growaround=False,
-         flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now summary
-print ("Flagging Step 11/11") 
-flagdata(vis=ms,mode="summary",datacolumn="DATA", extendflags=True, 
-         name=ms+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)
+def flagcmd(**pars):
+	# one flagdata command line, as used by mode='list'
+	def fmt(v):
+		if isinstance(v, (list, tuple)):
+			return '['+','.join(repr(x) for x in v)+']'
+		return repr(v)
+	return ' '.join(k+'='+fmt(v) for k,v in pars.items())
+
+def rficmd(step, **pars):
+	# a tfcrop or rflag command, or the sumthreshold command taking its place when flagengine selects that engine for step
+	if flagengine.get(step, 'casa') != 'sumthreshold':
+		return flagcmd(**pars)
+	cutoff = pars['timedevscale'] if pars['mode'] == 'rflag' else pars['timecutoff']
+	return flagcmd(mode='sumthreshold', field=pars.get('field', ''), spw=pars.get('spw', ''), datacolumn=pars['datacolumn'], cutoff=cutoff)
+
+if profile == True:
+	sumthreshold_flag = profiled('sumthreshold', sumthreshold_flag)
+sumthreshold_flag = versioned('sumthreshold', sumthreshold_flag)
+
+def flag_passes(cmds):
+	# cmds in passes over the data, in their order: runs of flagdata commands, and every sumthreshold command on its own
+	passes = []
+	for cmd in cmds:
+		if cmd_pars(cmd)['mode'] == 'sumthreshold' or len(passes) == 0 or cmd_pars(passes[-1][0])['mode'] == 'sumthreshold':
+			passes.append([cmd])
+		else:
+			passes[-1].append(cmd)
+	return passes
+
+def flag_pass(vis, cmds):
+	# one pass over vis: a single list-mode flagdata call, or the SumThreshold engine. Returns what they return.
+	if cmd_pars(cmds[0])['mode'] == 'sumthreshold':
+		return sumthreshold_flag(vis=vis, cmd=cmds[0], flagbackup=True)
+	return flagdata(vis=vis, mode='list', inpfile=cmds, action="apply", flagbackup=True, savepars=False)
+
+def flag_cmds(job):
+	# Run a list of flagdata commands on vis, either with as few passes over the data as possible (batchflag=True: one
+	# list-mode pass, split only around sumthreshold steps) or one pass per command as before. Returns the number of passes.
+	vis, cmds = job
+	if batchflag == True:
+		passes = flag_passes(cmds)
+		print ("Flagging Steps 1-%d/%d of %s in %d pass(es)" % (len(cmds), len(cmds)+1, vis, len(passes)))
+		for p in passes:
+			flag_pass(vis, p)
+		return len(passes)
+	for i in range(len(cmds)):
+		print ("Flagging Step %d/%d" % (i+1, len(cmds)+1))
+		flag_pass(vis, [cmds[i]])
+	return len(cmds)
+
+def flag_round(vis, label, cmds, datacolumn):
+	# Run a flagging round on vis (on each of its sub-MSs at the same time if it is a multi-MS) and report wall time and bytes read
+	t0 = time.time()
+	r0 = io_counters()[0]
+	if is_mms(vis):
+		jobs = [(sub, subms_cmds(sub, cmds)) for sub in subms_list(vis)]
+		npass = max([0]+run_pool(flag_cmds, [j for j in jobs if len(j[1]) > 0], partworkers))
+	else:
+		npass = flag_cmds((vis, cmds))
+	wall = time.time()-t0
+	nread = io_counters()[0]-r0
+	# Now summary
+	print ("Flagging Step %d/%d" % (len(cmds)+1, len(cmds)+1))
+	flagdata(vis=vis,mode="summary",datacolumn=datacolumn, extendflags=True, 
+	         name=vis+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)
+	msg = ("%s: %d commands in %d pass(es), %.1f s, %.3f GB read from disk"
+	       % (label, len(cmds), npass, wall, nread/1e9))
+	# Estimate only, scaled by passes: every command of the sequential path reads the data again, and data already in the
+	# page cache is not read from disk. Run with batchflag=False (or benchmark_uGMRT_POL.py) for the measured figure.
+	if batchflag == True and npass > 0 and npass < len(cmds):
+		msg += " (sequential path estimate: %d passes, ~%.3f GB)" % (len(cmds), nread*len(cmds)/float(npass)/1e9)
+	print (msg)
+	casalog.post(msg)
+	with open(flagreport, 'a') as frep:
+		frep.write(time.strftime('%Y-%m-%d %H:%M:%S')+'  '+('batch' if batchflag == True else 'sequential')+'  '+msg+'\n')
+
+flagcmds0 = [
+	#Flag using 'clip' option to remove high points for calibrators
+	flagcmd(mode="clip", spw=flagspw, field=fluxfield, clipminmax=clipfluxcal,
+	        datacolumn="DATA", clipoutside=True, clipzeros=True, extendpols=False),
+	flagcmd(mode="clip", spw=flagspw, field=secondaryfield, clipminmax=clipphasecal,
+	        datacolumn="DATA", clipoutside=True, clipzeros=True, extendpols=False),
+	flagcmd(mode="clip", spw=flagspw, field=anofield, clipminmax=clipanofield,
+	        datacolumn="DATA", clipoutside=True, clipzeros=True, extendpols=False),
+	flagcmd(mode="clip", spw=flagspw, field=polcalib2, clipminmax=clippolcalib2,
+	        datacolumn="DATA", clipoutside=True, clipzeros=True, extendpols=False),
+	flagcmd(mode="clip", spw=flagspw, field=unpolcalib1, clipminmax=clipunpolcalib1,
+	        datacolumn="DATA", clipoutside=True, clipzeros=True, extendpols=False),
+	# After clip, now flag using 'tfcrop' option for calibrator tight flagging
+	rficmd("flag0-cal", mode="tfcrop", datacolumn="DATA", field=gaincals, ntime="scan",
+	        timecutoff=3.0, freqcutoff=3.0, timefit="line", freqfit="line", flagdimension="freqtime", 
+	        extendflags=False, timedevscale=4.0, freqdevscale=4.0, extendpols=False, growaround=False),
+	# Now extend the flags (80% more means full flag, change if required)
+	flagcmd(mode="extend", spw=flagspw, field=gaincals, datacolumn="DATA", clipzeros=True,
+	        ntime="scan", extendpols=True, growtime=80.0, growfreq=80.0, growaround=False,
+	        flagneartime=False, flagnearfreq=False),
+	# Now flag for target - moderate flagging, more flagging in self-cal cycles
+	#Flag using 'clip' option to remove high points for target
+	flagcmd(mode="clip", spw=flagspw, field=target, clipminmax=cliptarget,
+	        datacolumn="DATA", clipoutside=True, clipzeros=True, extendpols=False),
+	# After clip, now flag using 'tfcrop' option for target
+	rficmd("flag0-target", mode="tfcrop", datacolumn="DATA", field=target, ntime="scan",
+	        timecutoff=4.0, freqcutoff=4.0, timefit="poly", freqfit="poly", flagdimension="freqtime", 
+	        extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False),
+	# Now extend the flags (80% more means full flag, change if required)
+	flagcmd(mode="extend", spw=flagspw, field=target, datacolumn="DATA", clipzeros=True,
+	        ntime="scan", extendpols=True, growtime=80.0, growfreq=80.0, growaround=False,
+	        flagneartime=False, flagnearfreq=False)]
+# In list mode, extend acts on the flags raised by the commands before it in the same pass
+
+if stage_start('flag0', ms, {'flagcmds0':flagcmds0, 'batchflag':batchflag}):
+	flag_round(ms, "First Round of Flagging", flagcmds0, "DATA")
+	stage_end('flag0', ms)
 
 #####################################################################################################################################
 
-print ("Calibrating measurement set %s" % ms)
-
-print ("stating initial flux density scaling")
-setjy(vis=ms, field = fluxfield, spw = flagspw, scalebychan=True)
-
-# Phase only calibration added - suggested and tested by Silpa Sasikumar
-#
-print ("starting initial phase only gaincal -> %s" % gainfilep0)
-gaincal(vis=ms,caltable=gainfilep0,field=gaincals,spw=gainspw,intent="",
-         selectdata=True,timerange="",uvrange="",antenna="",scan="",
-         observation="",msselect="",solint="int",combine="",preavg=-1.0,
-         refant=refant,refantmode="strict",minblperant=5,minsnr=1.0,solnorm=False,
-         gaintype="G",smodel=[],calmode="p",append=False,splinetime=3600.0,
-         npointaver=3,phasewrap=180.0,docallib=False,callib="",gaintable=[''],
-         gainfield=[''],interp=[],spwmap=[],parang=True)
-
-
-print ("starting initial gaincal -> %s" % gainfile0)
-gaincal(vis=ms, caltable = kcorrfile0, field = kcorrfield, spw = flagspw, 
-        refant = refant,  minblperant = 6, solnorm = True,  gaintype = 'K', 
-        gaintable =[gainfilep0], gainfield=gaincals, solint = '10min', combine = 'scan', minsnr=1.0,
-        parang = True, append = False)
+cal0params = {'flagspw':flagspw, 'gainspw':gainspw, 'refant':refant, 'gaincals':gaincals, 'kcorrfield':kcorrfield, 'bpassfield':bpassfield,
+              'fluxfield':fluxfield, 'transferfield':transferfield, 'uvracal':uvracal}
+if stage_start('cal0', ms, cal0params):
+	print ("Calibrating measurement set %s" % ms)
+
+	print ("stating initial flux density scaling")
+	setjy(vis=ms, field = fluxfield, spw = flagspw, scalebychan=True)
+
+	# Phase only calibration added - suggested and tested by Silpa Sasikumar
+	#
+	print ("starting initial phase only gaincal -> %s" % gainfilep0)
+	gaincal(vis=ms,caltable=gainfilep0,field=gaincals,spw=gainspw,intent="",
+	         selectdata=True,timerange="",uvrange="",antenna="",scan="",
+	         observation="",msselect="",solint="int",combine="",preavg=-1.0,
+	         refant=refant,refantmode="strict",minblperant=5,minsnr=1.0,solnorm=False,
+	         gaintype="G",smodel=[],calmode="p",append=False,splinetime=3600.0,
+	         npointaver=3,phasewrap=180.0,docallib=False,callib="",gaintable=[''],
+	         gainfield=[''],interp=[],spwmap=[],parang=True)
+
+
+	print ("starting initial gaincal -> %s" % gainfile0)
+	gaincal(vis=ms, caltable = kcorrfile0, field = kcorrfield, spw = flagspw, 
+	        refant = refant,  minblperant = 6, solnorm = True,  gaintype = 'K', 
+	        gaintable =[gainfilep0], gainfield=gaincals, solint = '10min', combine = 'scan', minsnr=1.0,
+	        parang = True, append = False)
   
-print ("starting bandpass -> %s" % bpassfile0)
-bandpass(vis=ms, caltable = bpassfile0, field = bpassfield, spw = flagspw, minsnr=1.0,
-         refant = refant, minblperant = 6, solnorm = True,  solint = 'inf', 
-         bandtype = 'B', fillgaps = 8, gaintable = [gainfilep0, kcorrfile0], gainfield=[gaincals,kcorrfield], 
-         parang = True, append = False)
-print ("starting gaincal -> %s" % gainfile0)
-gaincal(vis=ms, caltable = gainfile0, field = gaincals, spw = gainspw, 
-        refant = refant, solint = '1.0min', minblperant = 5, solnorm = False,  
-        gaintype = 'G', combine = '', calmode = 'ap', minsnr=1.0, uvrange=uvracal,
-        gaintable = [kcorrfile0,bpassfile0], gainfield = [kcorrfield,bpassfield],
-        append = False, parang = True)
-
-print ("starting fluxscale -> %s" % fluxfile0) 
-fluxscale(vis=ms, caltable = gainfile0, reference = [fluxfield], 
-          transfer = [transferfield], fluxtable = fluxfile0, 
-          listfile = ms+'.fluxscale.txt0',
-          append = False)               
+	print ("starting bandpass -> %s" % bpassfile0)
+	bandpass(vis=ms, caltable = bpassfile0, field = bpassfield, spw = flagspw, minsnr=1.0,
+	         refant = refant, minblperant = 6, solnorm = True,  solint = 'inf', 
+	         bandtype = 'B', fillgaps = 8, gaintable = [gainfilep0, kcorrfile0], gainfield=[gaincals,kcorrfield], 
+	         parang = True, append = False)
+	print ("starting gaincal -> %s" % gainfile0)
+	gaincal(vis=ms, caltable = gainfile0, field = gaincals, spw = gainspw, 
+	        refant = refant, solint = '1.0min', minblperant = 5, solnorm = False,  
+	        gaintype = 'G', combine = '', calmode = 'ap', minsnr=1.0, uvrange=uvracal,
+	        gaintable = [kcorrfile0,bpassfile0], gainfield = [kcorrfield,bpassfield],
+	        append = False, parang = True)
+
+	print ("starting fluxscale -> %s" % fluxfile0) 
+	fluxscale(vis=ms, caltable = gainfile0, reference = [fluxfield], 
+	          transfer = [transferfield], fluxtable = fluxfile0, 
+	          listfile = ms+'.fluxscale.txt0',
+	          append = False)               
           
-#####################################################################################################################################
-
-print ("Applying Calibrations:")
-
-print ("applying calibrations: primary calibrator")
-applycal(vis=ms, field = fluxfield, spw = flagspw, selectdata=False, calwt = False,
-    gaintable = [kcorrfile0,bpassfile0, fluxfile0],
-    gainfield = [kcorrfield,bpassfield,fluxfield],
-    parang = True)
+	stage_end('cal0', ms, [gainfilep0, kcorrfile0, bpassfile0, gainfile0, fluxfile0])
 
-print ("applying calibrations: secondary calibrators")
-applycal(vis=ms, field = secondaryfield, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile0, bpassfile0, fluxfile0],
-    gainfield = [kcorrfield, bpassfield,secondaryfield],
-    parang= True)
-
-print ("applying calibrations: polarized calibrator 2")
-applycal(vis=ms, field = polcalib, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile0, bpassfile0, fluxfile0],
-    gainfield = [kcorrfield, bpassfield,polcalib2],
-    parang= True)
+#####################################################################################################################################
 
-print ("applying calibrations: unpolarized calibrator 1")
-applycal(vis=ms, field = unpolcalib, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile0, bpassfile0, fluxfile0],
-    gainfield = [kcorrfield, bpassfield,unpolcalib1],
-    parang= True)
+####################################################################################################################################
+#applycal planner
+#Every applycal call reads and rewrites CORRECTED_DATA over multi.ms, and the per-field calls below only differ in their gainfield
+#mapping. The planner replaces a per-field mapping by 'nearest' where that picks the same solutions (the field itself, or the field
+#that is nearest on the sky among those with solutions in the table), then applies all fields with the same mapping in one call.
+
+def field_separation(vis, f1, f2):
+	# angular distance in radians between the phase centres of two fields
+	msmd.open(vis)
+	d1 = msmd.phasecenter(int(f1))
+	d2 = msmd.phasecenter(int(f2))
+	msmd.done()
+	ra1, dec1 = d1['m0']['value'], d1['m1']['value']
+	ra2, dec2 = d2['m0']['value'], d2['m1']['value']
+	return np.arccos(np.clip(np.sin(dec1)*np.sin(dec2)+np.cos(dec1)*np.cos(dec2)*np.cos(ra1-ra2), -1.0, 1.0))
+
+def caltable_fields(caltable):
+	# field ids with solutions in a caltable
+	tb.open(caltable)
+	ids = np.unique(tb.getcol('FIELD_ID'))
+	tb.close()
+	return [str(i) for i in ids]
+
+def applycal_plan(vis, fieldmaps, gaintable):
+	# fieldmaps: (field, gainfield list) in the order they would be applied one by one.
+	# Returns a list of (fields, gainfield list), one per applycal pass.
+	solved = [caltable_fields(c) for c in gaintable]
+	mapping = {}
+	for field, gainfield in fieldmaps:
+		for f in field.split(','):
+			mapping[f] = gainfield     # a field applied twice keeps its last mapping, as with the separate calls
+	plan = []
+	for f in mapping:
+		canon = []
+		for i in range(len(gaintable)):
+			gf = mapping[f][i]
+			if gf in solved[i] and len(solved[i]) > 1 and (gf == f or min(solved[i], key=lambda s: field_separation(vis, f, s)) == gf):
+				gf = 'nearest'
+			canon.append(gf)
+		for p in plan:
+			if p[1] == canon:
+				p[0].append(f)
+				break
+		else:
+			plan.append(([f], canon))
+	return [(','.join(p[0]), p[1]) for p in plan]
+
+def applycal_subms(job):
+	# the applycal passes of a plan, on one MS or sub-MS; fields it does not contain are left out of each pass
+	vis, plan, gaintable = job
+	present = subms_fields(vis) if is_mms(os.path.dirname(os.path.dirname(vis))) else None
+	npass = 0
+	for field, gainfield in plan:
+		if present is not None:
+			field = ','.join(f for f in field.split(',') if f in present)
+			if field == '':
+				continue
+		print ("applying calibrations: field(s) "+field+" of "+vis+" with gainfield "+str(gainfield))
+		applycal(vis=vis, field = field, spw = flagspw, selectdata = False, calwt = False,
+		    gaintable = gaintable, gainfield = gainfield, parang = True)
+		npass += 1
+	if present is not None and npass == 0:
+		# a sub-MS with none of the fields still needs the CORRECTED_DATA column the other sub-MSs get
+		clearcal(vis=vis, addmodel=False)
+
+def run_applycal(vis, label, fieldmaps, gaintable):
+	# apply gaintable to every field of fieldmaps, in as few passes as planapply allows
+	if planapply == True:
+		plan = applycal_plan(vis, fieldmaps, gaintable)
+	else:
+		plan = fieldmaps
+	if is_mms(vis):
+		run_pool(applycal_subms, [(sub, plan, gaintable) for sub in subms_list(vis)], partworkers)
+	else:
+		applycal_subms((vis, plan, gaintable))
+	msg = "%s: %d applycal pass(es) for %d field mappings, %d saved" % (label, len(plan), len(fieldmaps), len(fieldmaps)-len(plan))
+	print (msg)
+	casalog.post(msg)
 
-print ("applying calibrations: another field") 
-applycal(vis=ms, field = anofield, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile0, bpassfile0, fluxfile0],
-    gainfield = [kcorrfield, bpassfield, anofield],
-    parang= True)
+####################################################################################################################################
 
-print ("applying calibrations: target fields")
-applycal(vis=ms, field = target, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile0, bpassfile0, fluxfile0],
-    gainfield = [kcorrfield, bpassfield,secondaryfield],
-    parang= True)
+#Scratch columns
+#clearcal and applycal add CORRECTED_DATA (and MODEL_DATA) to multi.ms, which roughly doubles or triples its size, and every
+#self-cal tclean rewrites MODEL_DATA of the target MS. With scratchcols='lean' the columns only live while they are read: stage
+#cal1 drops them instead of resetting them with clearcal (the solves read DATA and the virtual setjy models), the final applycal
+#of stage split calibrates the target fields only, and the columns are dropped again once split has written the target MSs, and
+#from each target MS at the end of its chain (a resumed stage applies the self-cal table again). selfcalmodel='virtual' keeps the
+#self-cal models as virtual models in the SOURCE table instead of predicting them into MODEL_DATA; flagdata derives
+#RESIDUAL_DATA from them, but the SumThreshold engine reads MODEL_DATA, so with flagengine selfcal-rflag='sumthreshold' the
+#models stay in MODEL_DATA.
+
+scratchcols='full'     # 'full': CORRECTED_DATA/MODEL_DATA stay on every MS; 'lean': only while they are needed (see above)
+selfcalmodel='modelcolumn'  # where tclean saves the self-cal models: 'modelcolumn' (MODEL_DATA) or 'virtual'
+apply_overrides()
+
+def drop_columns(vis, columns=['MODEL_DATA', 'CORRECTED_DATA']):
+	# remove the scratch columns from vis (from every sub-MS of a multi-MS)
+	parts = subms_list(vis) if is_mms(vis) else [vis]
+	size = sum(disk_usage(p) for p in parts)
+	dropped = []
+	for p in parts:
+		tb.open(p, nomodify=False)
+		present = [c for c in columns if c in tb.colnames()]
+		if len(present) > 0:
+			tb.removecols(present)
+		tb.close()
+		dropped += [c for c in present if c not in dropped]
+	if len(dropped) > 0:
+		msg = "Dropped %s from %s: %.2f GB freed" % (', '.join(dropped), vis, (size-sum(disk_usage(p) for p in parts))/1e9)
+		print (msg)
+		casalog.post(msg)
 
 ####################################################################################################################################
 
 # Change clipmax as required
+flagcmds1 = [
+	#Flag using 'clip' option to remove high points for calibrators
+	flagcmd(mode="clip", spw=flagspw, field=fluxfield, clipminmax=clipfluxcal,
+	        datacolumn="corrected", clipoutside=True, clipzeros=True, extendpols=False),
+	flagcmd(mode="clip", spw=flagspw, field=secondaryfield, clipminmax=clipphasecal,
+	        datacolumn="corrected", clipoutside=True, clipzeros=True, extendpols=False),
+	flagcmd(mode="clip", spw=flagspw, field=anofield, clipminmax=clipanofield,
+	        datacolumn="corrected", clipoutside=True, clipzeros=True, extendpols=False),
+	flagcmd(mode="clip", spw=flagspw, field=polcalib2, clipminmax=clippolcalib2,
+	        datacolumn="corrected", clipoutside=True, clipzeros=True, extendpols=False),
+	flagcmd(mode="clip", spw=flagspw, field=unpolcalib1, clipminmax=clipunpolcalib1,
+	        datacolumn="corrected", clipoutside=True, clipzeros=True, extendpols=False),
+	# After clip, now flag using 'tfcrop' option for calibrator tight flagging
+	rficmd("flag1-cal-tfcrop", mode="tfcrop", datacolumn="corrected", field=gaincals, ntime="scan",
+	        timecutoff=3.0, freqcutoff=3.0, timefit="line", freqfit="line", flagdimension="freqtime", 
+	        extendflags=False, timedevscale=4.0, freqdevscale=4.0, extendpols=False, growaround=False),
+	# Now flag using 'rflag' option for calibrator tight flagging
+	rficmd("flag1-cal-rflag", mode="rflag", datacolumn="corrected", field=gaincals, timecutoff=3.0, 
+	        freqcutoff=3.0, timefit="poly", freqfit="line", flagdimension="freqtime", extendflags=False,
+	        timedevscale=4.0, freqdevscale=4.0, spectralmax=500.0, extendpols=False, growaround=False,
+	        flagneartime=False, flagnearfreq=False),
+	# Now extend the flags (70% more means full flag, change if required)
+	flagcmd(mode="extend", spw=flagspw, field=gaincals, datacolumn="corrected", clipzeros=True,
+	        ntime="scan", extendpols=False, growtime=90.0, growfreq=90.0, growaround=False,
+	        flagneartime=False, flagnearfreq=False),
+	# Now flag for target - moderate flagging, more flagging in self-cal cycles
+	#Flag using 'clip' option to remove high points for target
+	flagcmd(mode="clip", spw=flagspw, field=target, clipminmax=cliptarget,
+	        datacolumn="corrected", clipoutside=True, clipzeros=True, extendpols=False),
+	# After clip, now flag using 'tfcrop' option for target
+	rficmd("flag1-target-tfcrop", mode="tfcrop", datacolumn="corrected", field=target, ntime="scan",
+	        timecutoff=4.0, freqcutoff=4.0, timefit="poly", freqfit="line", flagdimension="freqtime", 
+	        extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False),
+	# Now flag using 'rflag' option for target
+	rficmd("flag1-target-rflag", mode="rflag", datacolumn="corrected", field=target, timecutoff=4.0, 
+	        freqcutoff=4.0, timefit="poly", freqfit="poly", flagdimension="freqtime", extendflags=False,
+	        timedevscale=5.0, freqdevscale=5.0, spectralmax=500.0, extendpols=False, growaround=False,
+	        flagneartime=False, flagnearfreq=False)]
+
+flag1params = {'flagcmds1':flagcmds1, 'batchflag':batchflag, 'planapply':planapply, 'fields':[fluxfield, secondaryfield, polcalib2, unpolcalib1, anofield, target]}
+if stage_start('flag1', ms, flag1params, [kcorrfile0, bpassfile0, fluxfile0]):
+	print ("Applying Calibrations:")
+	run_applycal(ms, "Applying initial calibrations", [
+	    (fluxfield,      [kcorrfield, bpassfield, fluxfield]),        # primary calibrator
+	    (secondaryfield, [kcorrfield, bpassfield, secondaryfield]),   # secondary calibrators
+	    (polcalib2,      [kcorrfield, bpassfield, polcalib2]),        # polarized calibrator 2
+	    (unpolcalib1,    [kcorrfield, bpassfield, unpolcalib1]),      # unpolarized calibrator 1
+	    (anofield,       [kcorrfield, bpassfield, anofield]),         # another field
+	    (target,         [kcorrfield, bpassfield, secondaryfield])],  # target fields
+	    [kcorrfile0, bpassfile0, fluxfile0])
+
+####################################################################################################################################
 
-print ("Second Round of Flagging") 
-
-default(flagdata)
-#Flag using 'clip' option to remove high points for calibrators
-print ("Flagging Step 1/12") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=fluxfield, clipminmax=clipfluxcal,
-        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-print ("Flagging Step 2/12") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=secondaryfield, clipminmax=clipphasecal,
-        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-print ("Flagging Step 3/12")
-flagdata(vis=ms,mode="clip", spw=flagspw,field=anofield, clipminmax=clipanofield,
-        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-print ("Flagging Step 4/12") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=polcalib, clipminmax=clippolcalib,
-        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-print ("Flagging Step 5/12") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=unpolcalib, clipminmax=clipunpolcalib,
-        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-# After clip, now flag using 'tfcrop' option for calibrator tight flagging
-print ("Flagging Step 6/12") 
-flagdata(vis=ms,mode="tfcrop", datacolumn="corrected", field=gaincals, ntime="scan",
-        timecutoff=3.0, freqcutoff=3.0, timefit="line",freqfit="line",flagdimension="freqtime", 
-        extendflags=False, timedevscale=4.0,freqdevscale=4.0, extendpols=False,growaround=False,
-        action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now flag using 'rflag' option for calibrator tight flagging
-print ("Flagging Step 7/12") 
-flagdata(vis=ms,mode="rflag",datacolumn="corrected",field=gaincals, timecutoff=3.0, 
-        freqcutoff=3.0,timefit="poly",freqfit="line",flagdimension="freqtime", extendflags=False,
-        timedevscale=4.0,freqdevscale=4.0,spectralmax=500.0,extendpols=False, growaround=False,
-        flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
-# Now extend the flags (70% more means full flag, change if required)
-print ("Flagging Step 8/12") 
-flagdata(vis=ms,mode="extend",spw=flagspw,field=gaincals,datacolumn="corrected",clipzeros=True,
-         ntime="scan", extendflags=False, extendpols=False,growtime=90.0, growfreq=90.0,growaround=False,
-         flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now flag for target - moderate flagging, more flagging in self-cal cycles
-#Flag using 'clip' option to remove high points for target
-print ("Flagging Step 9/12") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=target, clipminmax=cliptarget,
-        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-# After clip, now flag using 'tfcrop' option for target
-print ("Flagging Step 10/12") 
-flagdata(vis=ms,mode="tfcrop", datacolumn="corrected", field=target, ntime="scan",
-        timecutoff=4.0, freqcutoff=4.0, timefit="poly",freqfit="line",flagdimension="freqtime", 
-        extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-        action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now flag using 'rflag' option for target
-print ("Flagging Step 11/12") 
-flagdata(vis=ms,mode="rflag",datacolumn="corrected",field=target, timecutoff=4.0, 
-        freqcutoff=4.0,timefit="poly",freqfit="poly",flagdimension="freqtime", extendflags=False,
-        timedevscale=5.0,freqdevscale=5.0,spectralmax=500.0,extendpols=False, growaround=False,
-        flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
-# Now summary
-print ("Flagging Step 12/12") 
-flagdata(vis=ms,mode="summary",datacolumn="corrected", extendflags=True, 
-         name=ms+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)
+	print ("Second Round of Flagging") 
+	flag_round(ms, "Second Round of Flagging", flagcmds1, "corrected")
+	stage_end('flag1', ms)
 #
 ####################################################################################################################################
 #
-print ("Deleting existing model column")
-clearcal(ms)
+if stage_start('cal1', ms, cal0params):
+	if scratchcols == 'lean':
+		print ("Dropping the scratch columns")
+		drop_columns(ms)
+	else:
+		print ("Deleting existing model column")
+		clearcal(ms)
 
 ####################################################################################################################################
-#
-print ("Calibrating measurement set %s" % ms)
-
-print ("starting initial flux density scaling")
-setjy(vis=ms, field = fluxfield, spw = flagspw, scalebychan=True)
-
-print ("starting initial phase only gaincal -> %s" % gainfilep)
-gaincal(vis=ms,caltable=gainfilep,field=gaincals,spw=gainspw,intent="",
-         selectdata=True,timerange="",uvrange="",antenna="",scan="",
-         observation="",msselect="",solint="int",combine="",preavg=-1.0,
-         refant=refant,refantmode="strict",minblperant=5,minsnr=1.0,solnorm=False,
-         gaintype="G",smodel=[],calmode="p",append=False,splinetime=3600.0,
-         npointaver=3,phasewrap=180.0,docallib=False,callib="",gaintable=[''],
-         gainfield=[''],interp=[],spwmap=[],parang=True)
-
-print ("starting initial gaincal -> %s" % kcorrfile)
-gaincal(vis=ms, caltable = kcorrfile, field = kcorrfield, spw = flagspw, 
-        refant = refant,  minblperant = 6, solnorm = True,  gaintype = 'K', 
-        gaintable =[gainfilep], gainfield=gaincals, solint = '10min', combine = 'scan', minsnr=1.0,
-        parang = True, append = False)
+	#
+	print ("Calibrating measurement set %s" % ms)
+
+	print ("starting initial flux density scaling")
+	setjy(vis=ms, field = fluxfield, spw = flagspw, scalebychan=True)
+
+	print ("starting initial phase only gaincal -> %s" % gainfilep)
+	gaincal(vis=ms,caltable=gainfilep,field=gaincals,spw=gainspw,intent="",
+	         selectdata=True,timerange="",uvrange="",antenna="",scan="",
+	         observation="",msselect="",solint="int",combine="",preavg=-1.0,
+	         refant=refant,refantmode="strict",minblperant=5,minsnr=1.0,solnorm=False,
+	         gaintype="G",smodel=[],calmode="p",append=False,splinetime=3600.0,
+	         npointaver=3,phasewrap=180.0,docallib=False,callib="",gaintable=[''],
+	         gainfield=[''],interp=[],spwmap=[],parang=True)
+
+	print ("starting initial gaincal -> %s" % kcorrfile)
+	gaincal(vis=ms, caltable = kcorrfile, field = kcorrfield, spw = flagspw, 
+	        refant = refant,  minblperant = 6, solnorm = True,  gaintype = 'K', 
+	        gaintable =[gainfilep], gainfield=gaincals, solint = '10min', combine = 'scan', minsnr=1.0,
+	        parang = True, append = False)
   
-print ("starting bandpass -> %s" % bpassfile)
-bandpass(vis=ms, caltable = bpassfile, field = bpassfield, spw = flagspw, minsnr=1.0,
-         refant = refant, minblperant = 6, solnorm = True,  solint = 'inf', 
-         bandtype = 'B', fillgaps = 8, gaintable = [gainfilep, kcorrfile], gainfield=[gaincals, kcorrfield], 
-         parang = True, append = False)
+	print ("starting bandpass -> %s" % bpassfile)
+	bandpass(vis=ms, caltable = bpassfile, field = bpassfield, spw = flagspw, minsnr=1.0,
+	         refant = refant, minblperant = 6, solnorm = True,  solint = 'inf', 
+	         bandtype = 'B', fillgaps = 8, gaintable = [gainfilep, kcorrfile], gainfield=[gaincals, kcorrfield], 
+	         parang = True, append = False)
      
-print ("starting gaincal -> %s" % gainfile)
-gaincal(vis=ms, caltable = gainfile, field = gaincals, spw = gainspw, 
-        refant = refant, solint = '1.0min', minblperant = 5, solnorm = False,  
-        gaintype = 'G', combine = '', calmode = 'ap', minsnr=1.0, uvrange=uvracal,
-        gaintable = [kcorrfile,bpassfile], gainfield = [kcorrfield,bpassfield],
-        append = False, parang = True)
-print ("starting fluxscale -> %s" % fluxfile)
-fluxscale(vis=ms, caltable = gainfile, reference = [fluxfield], 
-          transfer = [transferfield], fluxtable = fluxfile, 
-          listfile = ms+'.fluxscale.txt2',
-          append = False)               
-####################################################################################################################################
-print ("starting Polarization calibration -> ")
-#
-print ("setting the polarization calibrator models")
-setjy(vis=ms, field = polcalib1, spw = flagspw, scalebychan=True, standard='manual', 
-      fluxdensity=[i0_1,0,0,0], spix=alphabeta_1, reffreq=reffreq, polindex=polindices_1, polangle=polangles_1)
-setjy(vis=ms, field = polcalib2, spw = flagspw, scalebychan=True, standard='manual', 
-      fluxdensity=[i0_2,0,0,0], spix=alphabeta_2, reffreq=reffreq, polindex=polindices_2, polangle=polangles_2)
-
-
-print ("starting cross-hand delay calibration -> %s" % kcross1)
-gaincal(vis=ms, caltable = kcross1, field = polcalib1, spw = flagspw, 
-        refant = refant, solint = 'inf', gaintype = 'KCROSS', combine = 'scan',
-        gaintable = [kcorrfile, bpassfile, gainfile], gainfield = [kcorrfield,bpassfield,polcalib1],
-        parang = True) 
-print ("starting cross-hand delay calibration -> %s" % kcross2)
-gaincal(vis=ms, caltable = kcross2, field = polcalib2, spw = flagspw, 
-        refant = refant, solint = 'inf', gaintype = 'KCROSS', combine = 'scan',
-        gaintable = [kcorrfile, bpassfile, gainfile], gainfield = [kcorrfield,bpassfield,polcalib2],
-        parang = True) 
+	print ("starting gaincal -> %s" % gainfile)
+	gaincal(vis=ms, caltable = gainfile, field = gaincals, spw = gainspw, 
+	        refant = refant, solint = '1.0min', minblperant = 5, solnorm = False,  
+	        gaintype = 'G', combine = '', calmode = 'ap', minsnr=1.0, uvrange=uvracal,
+	        gaintable = [kcorrfile,bpassfile], gainfield = [kcorrfield,bpassfield],
+	        append = False, parang = True)
+	print ("starting fluxscale -> %s" % fluxfile)
+	fluxscale(vis=ms, caltable = gainfile, reference = [fluxfield], 
+	          transfer = [transferfield], fluxtable = fluxfile, 
+	          listfile = ms+'.fluxscale.txt2',
+	          append = False)               
+	stage_end('cal1', ms, [gainfilep, kcorrfile, bpassfile, gainfile, fluxfile])
+
 ####################################################################################################################################
 #Analyse the various tables and choose the correct ones to apply
-
+#(kcross1/2, leakage1/2/unpolleakage1 and polang1/2 are all solved in stage polcal; changing a choice here reruns polcal and what follows)
+#With autoselect=True the choice is made in stage polcal from the solutions themselves: after each kind of table is solved, the
+#candidates are compared (flagged fraction, SNR, scatter between neighbouring channels per antenna and per channel, agreement
+#between calibrators) and the least noisy one left is used for the solves that follow and for the target. The choice is kept
+#in the stage record and the analysis is written to polreport.
 kcross = kcross1 #or kcross2
 kcrosscalib = polcalib1 #or polcalib2
+leakage = leakage1 #or leakage2 or unpolleakage1
+leakagecalib = polcalib1 #or polcalib2 or unpolcalib1
+polang = polang1 #or polang2
+polangcalib = polcalib1 #or polcalib2
+autoselect=True        # Choose kcross, leakage and polang from their solutions instead of the choice above
+maxpolflag=0.5         # a table with more of its solutions flagged is only chosen when every candidate has
+polreport=ms+'.polcal_report.json'  # analysis of the candidate tables
+polworkers=3           # polarization solves of different calibrators run at the same time (1: one after another)
+apply_overrides()
+
+def caltable_arrays(caltable):
+	# solutions of a calibration table as (row, correlation, channel) arrays: parameter, SNR and FLAG, with the antenna of each row
+	tb.open(caltable)
+	par = tb.getcol('CPARAM' if 'CPARAM' in tb.colnames() else 'FPARAM').transpose(2,0,1)
+	snr = tb.getcol('SNR').transpose(2,0,1)
+	flag = tb.getcol('FLAG').transpose(2,0,1)
+	ant = tb.getcol('ANTENNA1')
+	tb.close()
+	# combine='scan' and solint='inf' leave one solution per antenna; of several, the last one is kept
+	rows = np.array(sorted(dict((a, i) for i, a in enumerate(ant)).values()), dtype=int)
+	return par[rows], snr[rows], flag[rows], ant[rows]
+
+def robust_std(x, axis=None):
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		return 1.4826*np.nanmedian(np.abs(x-np.nanmedian(x, axis=axis, keepdims=True)), axis=axis)
+
+def caltable_values(kind, par):
+	# the quantity compared: cross-hand delay (ns), complex leakage, or cross-hand phase (deg)
+	if kind == 'polang':
+		return np.degrees(np.angle(par))
+	return par
+
+def caltable_metrics(kind, caltable):
+	par, snr, flag, ant = caltable_arrays(caltable)
+	val = np.where(flag, np.nan, caltable_values(kind, par))
+	m = {'table': caltable, 'flagged': round(float(flag.mean()), 4),
+	     'snr': round(float(np.median(snr[~flag])), 1) if (~flag).any() else 0.0}
+	if par.shape[2] > 1:
+		# channel-to-channel scatter (the rms of a solution, for a smooth spectrum), per antenna and per channel
+		d = np.diff(val, axis=2)
+		if kind == 'polang':
+			d = (d+180.0) % 360.0-180.0
+		d = 1.4826*np.abs(d)/np.sqrt(2)
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', RuntimeWarning)   # fully flagged antennas and channels
+			perant = np.nanmedian(d, axis=(1,2))
+			perchan = np.nanmedian(d.transpose(2,0,1).reshape(d.shape[2], -1), axis=1)
+		m['scatter'] = float(np.nanmedian(perant))
+		m['noisy_antennas'] = [int(a) for a in ant[perant > 3*m['scatter']]]
+		m['noisy_channels'] = [int(c) for c in np.flatnonzero(perchan > 3*np.nanmedian(perchan))]
+	else:
+		# one delay per antenna: its spread over the antennas
+		m['scatter'] = float(np.nanmedian(robust_std(val, axis=0)))
+		m['noisy_antennas'] = []
+		m['noisy_channels'] = []
+	m['scatter'] = round(m['scatter'], 6) if np.isfinite(m['scatter']) else float('inf')
+	v = np.abs(val) if kind == 'leakage' else val
+	m['median'] = round(float(np.nanmedian(v)), 6) if np.isfinite(v).any() else None
+	return m, ant, val
+
+def caltable_agreement(kind, a, b):
+	# median difference of two tables of the same kind over the antennas and channels both solved
+	common, ia, ib = np.intersect1d(a[0], b[0], return_indices=True)
+	if len(common) == 0 or a[1].shape[1:] != b[1].shape[1:]:
+		return None
+	d = a[1][ia]-b[1][ib]
+	if kind == 'polang':
+		d = (d+180.0) % 360.0-180.0
+	d = np.abs(d)
+	return round(float(np.nanmedian(d)), 6) if np.isfinite(d).any() else None
+
+polcal_report = {}
+
+def pol_solve(job):
+	# one gaincal or polcal solve, and the wall time it took
+	task, pars = job
+	t0 = time.time()
+	print ("starting %s -> %s" % (task, pars['caltable']))
+	globals()[task](**pars)
+	return pars['caltable'], time.time()-t0
+
+def pol_wave(label, jobs):
+	# independent solves, as many at the same time as polworkers allows
+	t0 = time.time()
+	print ("starting %s: %d solves with %d worker(s)" % (label, len(jobs), min(polworkers, len(jobs))))
+	for caltable, wall in run_pool(pol_solve, jobs, polworkers):
+		print ("%s: %.1f s" % (caltable, wall))
+	msg = "%s: %d solves in %.1f s" % (label, len(jobs), time.time()-t0)
+	print (msg)
+	casalog.post(msg)
+
+def choose_caltable(kind, candidates):
+	# the (caltable, field) of candidates with the least noisy solutions, among those not mostly flagged, not disagreeing with
+	# all the others and, for leakage, not from 3C138 or OQ208 (see the notes in README); the analysis goes to polcal_report
+	tables = []
+	sols = []
+	for caltable, field in candidates:
+		m, ant, val = caltable_metrics(kind, caltable)
+		m['field'] = field
+		m['source'] = source_name(fieldnames[int(field)])
+		tables.append(m)
+		sols.append((ant, val))
+	agreement = {}
+	for i in range(len(tables)):
+		for j in range(i+1, len(tables)):
+			agreement[tables[i]['field']+'-'+tables[j]['field']] = caltable_agreement(kind, sols[i], sols[j])
+	ok = [i for i in range(len(tables)) if tables[i]['flagged'] <= maxpolflag] or list(range(len(tables)))
+	if kind == 'leakage':
+		ok = [i for i in ok if tables[i]['source'] not in ['3C138', 'OQ208']] or ok
+	dist = lambda i, j: agreement[tables[min(i,j)]['field']+'-'+tables[max(i,j)]['field']]
+	pairs = [dist(i, j) for i in range(len(tables)) for j in range(i+1, len(tables)) if dist(i, j) is not None]
+	if len(tables) >= 3 and len(pairs) > 0:
+		# an outlier: further from every other candidate than 3 times the closest two are from each other
+		ok = [i for i in ok if not all(dist(i, j) is not None and dist(i, j) > 3*min(pairs) for j in range(len(tables)) if j != i)] or ok
+	best = min(ok, key=lambda i: (tables[i]['scatter']*(1+tables[i]['flagged']), -tables[i]['snr']))
+	polcal_report[kind] = {'chosen': tables[best]['table'], 'field': tables[best]['field'], 'candidates': tables,
+	                       'eligible': [tables[i]['table'] for i in ok], 'agreement': agreement}
+	print ("Chose %s for %s: %s (field %s, scatter %.4g, %.1f%% flagged, SNR %.1f)" % (tables[best]['table'], kind,
+	       tables[best]['source'], tables[best]['field'], tables[best]['scatter'], 100*tables[best]['flagged'], tables[best]['snr']))
+	return tables[best]['table'], tables[best]['field']
 ####################################################################################################################################
+polcalparams = {'flagspw':flagspw, 'refant':refant, 'kcorrfield':kcorrfield, 'bpassfield':bpassfield, 'reffreq':reffreq,
+                'polcalib1':polcalib1, 'polcalib2':polcalib2, 'unpolcalib1':unpolcalib1,
+                'models':[i0_1, alphabeta_1, polindices_1, polangles_1, i0_2, alphabeta_2, polindices_2, polangles_2],
+                'kcrosscalib':kcrosscalib, 'kcross':kcross, 'leakagecalib':leakagecalib, 'leakage':leakage}
+if autoselect == True:
+	# the tables used inside the stage are chosen there
+	for k in ['kcrosscalib', 'kcross', 'leakagecalib', 'leakage']:
+		del polcalparams[k]
+	polcalparams.update({'autoselect':autoselect, 'maxpolflag':maxpolflag})
+if stage_start('polcal', ms, polcalparams, [kcorrfile, bpassfile, gainfile]):
+	print ("starting Polarization calibration -> ")
+	#
+	print ("setting the polarization calibrator models")
+	setjy(vis=ms, field = polcalib1, spw = flagspw, scalebychan=True, standard='manual', 
+	      fluxdensity=[i0_1,0,0,0], spix=alphabeta_1, reffreq=reffreq, polindex=polindices_1, polangle=polangles_1)
+	setjy(vis=ms, field = polcalib2, spw = flagspw, scalebychan=True, standard='manual', 
+	      fluxdensity=[i0_2,0,0,0], spix=alphabeta_2, reffreq=reffreq, polindex=polindices_2, polangle=polangles_2)
+
+
+	# The solves of each kind use different calibrators and only read ms, so they run at the same time, in three waves:
+	# cross-hand delays, then leakages (after kcross) and angles (after kcross and leakage)
+	pol_wave("cross-hand delay calibration", [
+	    ('gaincal', dict(vis=ms, caltable = kcross1, field = polcalib1, spw = flagspw, 
+	                     refant = refant, solint = 'inf', gaintype = 'KCROSS', combine = 'scan',
+	                     gaintable = [kcorrfile, bpassfile, gainfile], gainfield = [kcorrfield,bpassfield,polcalib1],
+	                     parang = True)),
+	    ('gaincal', dict(vis=ms, caltable = kcross2, field = polcalib2, spw = flagspw, 
+	                     refant = refant, solint = 'inf', gaintype = 'KCROSS', combine = 'scan',
+	                     gaintable = [kcorrfile, bpassfile, gainfile], gainfield = [kcorrfield,bpassfield,polcalib2],
+	                     parang = True))])
+	if autoselect == True:
+		kcross, kcrosscalib = choose_caltable('kcross', [(kcross1, polcalib1), (kcross2, polcalib2)])
+
+	pol_wave("leakage calibration", [
+	    ('polcal', dict(vis=ms, caltable = leakage1, field = polcalib1, spw = flagspw, 
+	                    refant = refant, solint = 'inf', poltype = 'Df+QU', combine = 'scan',
+	                    gaintable = [kcorrfile, bpassfile, gainfile, kcross], gainfield = [kcorrfield, bpassfield, polcalib1, kcrosscalib])),
+	    ('polcal', dict(vis=ms, caltable = leakage2, field = polcalib2, spw = flagspw, 
+	                    refant = refant, solint = 'inf', poltype = 'Df+QU', combine = 'scan',
+	                    gaintable = [kcorrfile, bpassfile, gainfile, kcross], gainfield = [kcorrfield, bpassfield, polcalib2, kcrosscalib])),
+	    # unpolarized calibrator
+	    ('polcal', dict(vis=ms, caltable = unpolleakage1, field = unpolcalib1, spw = flagspw, refant = refant, solint = 'inf', poltype = 'Df', combine = 'scan',
+	                    gaintable = [kcorrfile, bpassfile, gainfile, kcross], gainfield = [kcorrfield,bpassfield,unpolcalib1,kcrosscalib]))])
+	if autoselect == True:
+		leakage, leakagecalib = choose_caltable('leakage', [(leakage1, polcalib1), (leakage2, polcalib2), (unpolleakage1, unpolcalib1)])
+
+	pol_wave("polarization angle calibration", [
+	    ('polcal', dict(vis=ms, caltable = polang1, field = polcalib1, refant = refant, solint = 'inf', poltype = 'Xf',combine = 'scan', gaintable = [kcorrfile, bpassfile, gainfile, kcross, leakage], 
+	                    gainfield = [kcorrfield,bpassfield,polcalib1,kcrosscalib,leakagecalib])),
+	    ('polcal', dict(vis=ms, caltable = polang2, field = polcalib2, refant = refant, solint = 'inf', poltype = 'Xf',combine = 'scan', gaintable = [kcorrfile, bpassfile, gainfile, kcross, leakage], 
+	                    gainfield = [kcorrfield,bpassfield,polcalib2,kcrosscalib,leakagecalib]))])
+	choice = {}
+	if autoselect == True:
+		polang, polangcalib = choose_caltable('polang', [(polang1, polcalib1), (polang2, polcalib2)])
+		choice = {'kcross': [kcross, kcrosscalib], 'leakage': [leakage, leakagecalib], 'polang': [polang, polangcalib]}
+		with open(polreport, 'w') as fpr:
+			json.dump(polcal_report, fpr, indent=1)
+	stage_end('polcal', ms, [kcross1, kcross2, leakage1, leakage2, unpolleakage1, polang1, polang2], info={'choice': choice})
+if autoselect == True:
+	# the choice made when the stage last ran
+	choice = stages['polcal']['info']['choice']
+	kcross, kcrosscalib = choice['kcross']
+	leakage, leakagecalib = choice['leakage']
+	polang, polangcalib = choice['polang']
+	print ("Applying %s, %s and %s (see %s)" % (kcross, leakage, polang, polreport))
+
+splitparams = {'flagspw':flagspw, 'kcorrfield':kcorrfield, 'bpassfield':bpassfield, 'fields':[fluxfield, secondaryfield, polcalib2, unpolcalib1, anofield, target],
+               'calibs':[kcrosscalib, leakagecalib, polangcalib], 'cliptarget':cliptarget, 'splitspw':splitspw, 'specave':specave,
+               'timeave':timeave, 'autoaverage':autoaverage, 'smearloss':smearloss, 'smearradius':smearradius, 'bdaverage':bdaverage,
+               'flagengine':flagengine.get('split-rflag', 'casa')}
+
+def smearing_plan(vis, field):
+	# Largest channel and time averaging of field that keeps the peak loss at radius r (smearradius) within
+	# smearloss, half of it for each effect (Bridle & Schwab 1999, Gaussian beam of width lambda/B):
+	#   bandwidth: R = 1.0645*erf(0.8326*b)/b with b = dnu*r*B/c, the same at every frequency
+	#   time:      R = 1 - 1.22e-9*(dt*r*B*nu/c)**2, worst at the highest frequency
+	# The time average is kept below half the shortest self-cal solution interval. With bdaverage the time bin is that limit,
+	# and maxuvwdistance, the uv distance the longest baseline moves in the smearing-limited time, sets the bin of each baseline.
+	from math import erf
+	c = 299792458.0
+	tb.open(vis+'/SPECTRAL_WINDOW')
+	freqs = np.concatenate([tb.getcell('CHAN_FREQ', i) for i in range(tb.nrows())])
+	chanwidth = max(abs(tb.getcell('CHAN_WIDTH', i)).max() for i in range(tb.nrows()))
+	tb.close()
+	tb.open(vis)
+	sub = tb.query('FIELD_ID IN [%s]' % field, columns='UVW,INTERVAL')
+	uvw = sub.getcol('UVW')
+	interval = float(np.median(sub.getcol('INTERVAL')))
+	sub.close()
+	tb.close()
+	bmax = float(np.hypot(uvw[0], uvw[1]).max())
+	r = smearradius*c/(freqs.min()*dishdiameter)
+	width = 1
+	while width < len(freqs):
+		b = (width+1)*chanwidth*r*bmax/c
+		if 1.0645*erf(0.8326*b)/b < 1-smearloss/2:
+			break
+		width += 1
+	dt = np.sqrt(smearloss/2/1.22e-9)/(r*bmax*freqs.max()/c)
+	dtmax = 60.0*min(solint/2**pcycles, apsolint/2**min(apcycles, 4))/2
+	plan = {'width': width, 'interval': interval}
+	if bdaverage == True:
+		plan['timebin'] = max(interval, float(np.floor(dtmax/interval))*interval)
+		plan['maxuvwdistance'] = 7.2921e-5*min(dt, dtmax)*bmax
+	else:
+		plan['timebin'] = max(interval, float(np.floor(min(dt, dtmax)/interval))*interval)
+	return plan
+
+def scale_channels(spwsel, factor):
+	# the channel ranges of a 'spw:lo~hi;lo~hi,...' selection multiplied by factor
+	return ','.join(s.split(':')[0]+':'+re.sub(r'\d+', lambda m: str(int(int(m.group(0))*factor)), s.split(':')[1]) if ':' in s else s
+	                for s in spwsel.split(','))
+
+if stage_start('split', ms, splitparams, [kcorrfile, bpassfile, fluxfile, kcross, leakage, polang]):
+	#
+	print  ("Applying Calibrations:") 
+	fieldmaps = [
+	    (fluxfield,      [kcorrfield, bpassfield, fluxfield, kcrosscalib, leakagecalib, polangcalib]),        # primary calibrator
+	    (secondaryfield, [kcorrfield, bpassfield, secondaryfield, kcrosscalib, leakagecalib, polangcalib]),   # secondary calibrators
+	    (polcalib2,      [kcorrfield, bpassfield, polcalib2, kcrosscalib, leakagecalib, polangcalib]),        # polarized calibrator
+	    (unpolcalib1,    [kcorrfield, bpassfield, unpolcalib1, kcrosscalib, leakagecalib, polangcalib]),      # unpolarized calibrator
+	    (target,         [kcorrfield, bpassfield, secondaryfield, kcrosscalib, leakagecalib, polangcalib]),   # target fields
+	    (anofield,       [kcorrfield, bpassfield, anofield, kcrosscalib, leakagecalib, polangcalib])]        # another field
+	if scratchcols == 'lean':
+		fieldmaps = [m for m in fieldmaps if m[0] == target]   # only the targets are split
+	run_applycal(ms, "Applying final calibrations", fieldmaps, [kcorrfile, bpassfile, fluxfile, kcross, leakage, polang])
 
-print ("starting leakage calibration -> %s" % leakage1)
-polcal(vis=ms, caltable = leakage1, field = polcalib1, spw = flagspw, 
-       refant = refant, solint = 'inf', poltype = 'Df+QU', combine = 'scan',
-       gaintable = [kcorrfile, bpassfile, gainfile, kcross], gainfield = [kcorrfield, bpassfield, polcalib1, kcrosscalib])
-print ("starting leakage calibration -> %s" % leakage2)
-polcal(vis=ms, caltable = leakage2, field = polcalib2, spw = flagspw, 
-       refant = refant, solint = 'inf', poltype = 'Df+QU', combine = 'scan',
-       gaintable = [kcorrfile, bpassfile, gainfile, kcross], gainfield = [kcorrfield, bpassfield, polcalib2, kcrosscalib])
+####################################################################################################################################
 
-print ("starting leakage calibration :unpolarized -> %s" % unpolleakage1)
-polcal(vis=ms, caltable = unpolleakage1, field = unpolcalib1, spw = flagspw, refant = refant, solint = 'inf', poltype = 'Df', combine = 'scan', gaintable = [kcorrfile, bpassfile, gainfile, kcross], gainfield = [kcorrfield,bpassfield,unpolcalib1,kcrosscalib])
+	print ("Flagging Target")
+	# Now flag for target - moderate flagging
+	print ("Flagging Step 1/3") 
+	flagdata(vis=ms,mode="clip", spw=flagspw,field=target, clipminmax=cliptarget,
+	        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
+	        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+	# now flag using 'rflag' option 
+	print ("Flagging Step 2/3")
+	flag_pass(ms, [rficmd("split-rflag", mode="rflag",datacolumn="corrected",field=target, timecutoff=4.0, 
+	        freqcutoff=4.0,timefit="poly",freqfit="poly",flagdimension="freqtime", extendflags=False,
+	        timedevscale=5.0,freqdevscale=5.0,spectralmax=500.0,extendpols=False, growaround=False,
+	        flagneartime=False,flagnearfreq=False)])
+	print ("Flagging Step 3/3")
+	# Now summary
+	flagdata(vis=ms,mode="summary",datacolumn="corrected", extendflags=True, 
+	         name=ms+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)
 
 ####################################################################################################################################
 
-leakage = leakage1 #or leakage2 or unpolleakage1
-leakagecalib = polcalib1 #or polcalib2 or unpolcalib1
+	avgs = {}
+	for t in targets:
+		print ("Splitting target field "+fieldnames[int(t)])
+		clear_products(fieldnames[int(t)]+'.ms')
+		if autoaverage == True:
+			avg = smearing_plan(ms, t)
+			msg = "Averaging "+fieldnames[int(t)]+" by %d channels and %.0f s" % (avg['width'], avg['timebin'])
+			if 'maxuvwdistance' in avg:
+				msg += ", baselines moving less than %.0f m" % avg['maxuvwdistance']
+			print (msg)
+			casalog.post(msg)
+			mstransform(vis=ms, outputvis = fieldnames[int(t)]+'.ms', datacolumn='corrected', field = t, spw = splitspw,
+			            keepflags=False, chanaverage=True, chanbin=avg['width'], timeaverage=avg['timebin'] > avg['interval'],
+			            timebin=str(avg['timebin'])+'s', maxuvwdistance=avg.get('maxuvwdistance', 0.0))
+		else:
+			avg = {'width': specave, 'timebin': timeave}
+			split(vis=ms, outputvis = fieldnames[int(t)]+'.ms', datacolumn='corrected', 
+			          field = t, spw = splitspw, keepflags=False, width = specave, timebin = timeave, keepmms=False)
+		avgs[t] = avg
+	if scratchcols == 'lean':
+		drop_columns(ms)
+	stage_end('split', ms, info=avgs, products=[fieldnames[int(t)]+'.ms' for t in targets])
+split_rerun = stage_rerun      # every target chain starts from here
 
 ####################################################################################################################################
 
-print ("starting polarization angle calibration -> %s" % polang1)
-polcal(vis=ms, caltable = polang1, field = polcalib1, refant = refant, solint = 'inf', poltype = 'Xf',combine = 'scan', gaintable = [kcorrfile, bpassfile, gainfile, kcross, leakage], 
-        gainfield = [kcorrfield,bpassfield,polcalib1,kcrosscalib,leakagecalib])
-print ("starting polarization angle calibration -> %s" % polang2)
-polcal(vis=ms, caltable = polang2, field = polcalib2, refant = refant, solint = 'inf', poltype = 'Xf',combine = 'scan', gaintable = [kcorrfile, bpassfile, gainfile, kcross, leakage], 
-        gainfield = [kcorrfield,bpassfield,polcalib2,kcrosscalib,leakagecalib])
+print ("\n Cleaning up. Starting imaging...")  
+
+def fft_size(n):
+	# smallest even size >= n with no prime factors other than 2, 3, 5 and 7
+	while True:
+		m = n
+		for p in (2, 3, 5, 7):
+			while m % p == 0:
+				m //= p
+		if m == 1 and n % 2 == 0:
+			return n
+		n += 1
+
+def image_geometry(vis, chunk=1000000):
+	# imagesize, cellsize and wprojplanes for vis: the image reaches the primary beam null at the lowest frequency with
+	# pixperbeam pixels across lambda/B of the longest baseline at the highest frequency, and the number of w-planes keeps
+	# the w-term phase (pi*w*r**2 at the image corner) below one radian per plane
+	c = 299792458.0
+	tb.open(vis+'/SPECTRAL_WINDOW')
+	freqs = np.concatenate([tb.getcell('CHAN_FREQ', i) for i in range(tb.nrows())])
+	tb.close()
+	uvmax = 0.0
+	wmax = 0.0
+	tb.open(vis)
+	for start in range(0, tb.nrows(), chunk):
+		uvw = tb.getcol('UVW', startrow=start, nrow=min(chunk, tb.nrows()-start))
+		uvmax = max(uvmax, np.hypot(uvw[0], uvw[1]).max())
+		wmax = max(wmax, np.abs(uvw[2]).max())
+	tb.close()
+	cell = c/(freqs.max()*uvmax)/pixperbeam
+	null = 1.22*c/(freqs.min()*dishdiameter)
+	size = fft_size(int(np.ceil(2*null/cell)))
+	corner = size*cell/np.sqrt(2)
+	planes = max(1, int(np.ceil(np.pi*wmax*freqs.max()/c*corner**2)))
+	return [size, size], '%.3farcsec' % (cell*180/np.pi*3600), planes
+
+psf_images=['.psf', '.sumwt', '.weight', '.pb']   # tclean products that only depend on the uv sampling, not on the visibilities
+psf_pars={'selectdata':True, 'field':'', 'spw':'', 'timerange':'', 'uvrange':'', 'antenna':'', 'scan':'', 'observation':'',
+          'imsize':[], 'cell':[], 'phasecenter':'', 'projection':'SIN', 'specmode':'mfs', 'reffreq':'', 'nchan':-1,
+          'gridder':'standard', 'facets':1, 'wprojplanes':1, 'vptable':'', 'mosweight':True, 'aterm':True, 'psterm':False,
+          'wbawp':True, 'pblimit':0.2, 'normtype':'flatnoise', 'deconvolver':'hogbom', 'nterms':2, 'weighting':'natural',
+          'robust':0.5, 'npixels':0, 'uvtaper':[], 'perchanweightdensity':True}   # tclean parameters the PSF depends on, with their defaults
+
+def psf_stokes(stokes):
+	# what the PSF of a Stokes product depends on: the correlations it is made from (parallel hands for I and V, cross hands
+	# for Q and U) and the number of planes, so Q and U share a PSF
+	return [sorted(set('parallel' if s in 'IV' else 'cross' for s in stokes)), len(stokes)]
+
+def uv_fingerprint(vis, chunk=200000):
+	# hash of the uv sampling of vis: its FLAG and WEIGHT (or WEIGHT_SPECTRUM) columns, read in chunks of rows. This reads
+	# both columns in full, so it is made once per cycle (after its flagging and applycal) and passed to every tclean of it.
+	h = hashlib.sha1()
+	tb.open(vis)
+	cols = ['FLAG', 'WEIGHT_SPECTRUM' if 'WEIGHT_SPECTRUM' in tb.colnames() and tb.iscelldefined('WEIGHT_SPECTRUM', 0) else 'WEIGHT']
+	nrow = tb.nrows()
+	h.update(('%s %d' % (os.path.abspath(vis), nrow)).encode())
+	for start in range(0, nrow, chunk):
+		for col in cols:
+			h.update(tb.getcol(col, startrow=start, nrow=min(chunk, nrow-start)).tobytes())
+	tb.close()
+	return h.hexdigest()
+
+def cached_tclean(fingerprint='', **pars):
+	# tclean that copies the PSF from psfcache and runs with calcpsf=False when an earlier run had the same geometry, weighting
+	# and uv sampling, and otherwise stores the PSF it makes there
+	if reusepsf != True or pars.get('niter', 0) == 0 and pars.get('calcpsf', True) == False:
+		return tclean(**pars)
+	if fingerprint == '':
+		fingerprint = uv_fingerprint(pars['vis'])
+	key = [fingerprint, psf_stokes(pars.get('stokes', 'I'))]+[pars.get(k, v) for k, v in sorted(psf_pars.items())]
+	key = hashlib.sha1(json.dumps(key, default=to_json).encode()).hexdigest()
+	entry = os.path.join(psfcache, key)
+	imagename = pars['imagename']
+	if os.path.isdir(entry):
+		print ("Reusing the PSF cached in "+entry)
+		for p in os.listdir(entry):
+			shutil.copytree(os.path.join(entry, p), imagename+p)
+		os.utime(entry, None)
+		pars['calcpsf'] = False
+		return tclean(**pars)
+	result = tclean(**pars)
+	tmp = entry+'.%d.tmp' % os.getpid()
+	os.makedirs(tmp)
+	for ext in psf_images:
+		for p in glob.glob(imagename+ext)+glob.glob(imagename+ext+'.*'):
+			shutil.copytree(p, os.path.join(tmp, p[len(imagename):]))
+	try:
+		os.rename(tmp, entry)
+	except OSError:   # stored by a concurrent QUV worker in the meantime
+		shutil.rmtree(tmp)
+	entries = sorted([os.path.join(psfcache, e) for e in os.listdir(psfcache) if not e.endswith('.tmp')], key=os.path.getmtime)
+	for e in entries[:max(0, len(entries)-psfcachesize)]:
+		shutil.rmtree(e)
+	return result
+
+def quv_products(imagename):
+	# image name prefixes written by QUVimg for imagename
+	return [imagename+'_Q', imagename+'_U', imagename+'_V', imagename+'_QU', imagename+'_IQUV']
+
+def quv_tclean_pars(imagename, stokes, dc):
+	return dict(vis=ms,selectdata=True,field="",spw="",timerange="",uvrange="", antenna="",scan="",observation="",intent="", datacolumn= dc , imagename=imagename,imsize=imagesize,cell=cellsize,phasecenter="",
+	       stokes=stokes,projection="SIN",startmodel="",specmode="mfs",reffreq="",
+	       nchan=-1,start="",width="",outframe="LSRK",veltype="radio",
+	       restfreq=[],interpolation="linear",perchanweightdensity=False,gridder="widefield",facets=1,
+	       psfphasecenter="",wprojplanes=wproj,vptable="",usepointing=False,
+	       mosweight=True,aterm=True,psterm=False,wbawp=True,conjbeams=False,
+	       cfcache="",computepastep=360.0,rotatepastep=360.0,pblimit=-1,normtype="flatnoise",
+	       deconvolver="mtmfs",scales=[],nterms=2,smallscalebias=0.6,restoration=True,
+	       restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0.0,
+	       noise="1.0Jy",npixels=0,uvtaper=[],niter=160000,gain=0.1,
+	       threshold="0.01mJy",nsigma=0.0,cycleniter=-1,cyclefactor=1.3,minpsffraction=0.05,
+	       maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,
+	       sidelobethreshold=2.0,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,
+	       minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,
+	       verbose=False,fastnoise=True,restart=True,savemodel="none",calcres=True,
+	       calcpsf=True,parallel=False)
+
+def quv_job(job):
+	# One Stokes product (or the joint Q/U/V product): tclean, exportfits, and the wall time and peak memory it took
+	imagename, stokes, dc, fingerprint = job
+	t0 = time.time()
+	if len(stokes) == 1:
+		print ("Creating Stokes "+stokes+" image")
+		cached_tclean(fingerprint, **quv_tclean_pars(scratch(imagename+'_'+stokes), stokes, dc))
+		exportfits(imagename=scratch(imagename+'_'+stokes)+'.image.tt0', fitsimage=imagename+'_'+stokes+'.fits', velocity=False,optical=False,bitpix=-32,
+		           minpix=0,maxpix=-1,overwrite=True,dropstokes=False,stokeslast=True,history=True,dropdeg=False)
+	else:
+		# joint mode: one gridding pass and one PSF for all Stokes planes, each plane deconvolved on its own
+		print ("Creating Stokes "+stokes+" image")
+		cached_tclean(fingerprint, **quv_tclean_pars(scratch(imagename+'_'+stokes), stokes, dc))
+		for s in [s for s in stokes if s != 'I']:
+			imsubimage(imagename=scratch(imagename+'_'+stokes)+'.image.tt0', outfile=scratch(imagename+'_'+s)+'.image.tt0', stokes=s, overwrite=True)
+			exportfits(imagename=scratch(imagename+'_'+s)+'.image.tt0', fitsimage=imagename+'_'+s+'.fits', velocity=False,optical=False,bitpix=-32,
+			           minpix=0,maxpix=-1,overwrite=True,dropstokes=False,stokeslast=True,history=True,dropdeg=False)
+	return stokes, time.time()-t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def QUVimg(imagename, dc, fingerprint=''):
+	# Stokes Q, U (and V) images of imagename, from datacolumn dc. The products are independent and only read ms,
+	# so they are imaged at the same time, as many as quvworkers and the free memory allow.
+	if reusepsf == True and fingerprint == '':
+		fingerprint = uv_fingerprint(ms)
+	if jointQUV == True:
+		jobs = [(imagename, 'IQUV' if createV == True else 'QU', dc, fingerprint)]
+	else:
+		jobs = [(imagename, 'Q', dc, fingerprint), (imagename, 'U', dc, fingerprint)]
+		if createV == True:
+			jobs.append((imagename, 'V', dc, fingerprint))
+	need = tclean_memory(imagesize, 2, len(jobs[0][1]), wproj)
+	free = mem_available()
+	workers = quvworkers
+	if free > 0:
+		workers = max(1, min(workers, int(0.8*free//need)))
+	print ("Imaging Stokes %s of %s with %d worker(s), ~%.1f GB each, %.1f GB free" % (','.join(j[1] for j in jobs), imagename, min(workers, len(jobs)), need/1e9, free/1e9))
+	for stokes, wall, peak in run_pool(quv_job, jobs, workers):
+		msg = "Stokes %s of %s: %.1f s, peak memory %.2f GB (estimated %.2f GB)" % (stokes, imagename, wall, peak/1e9, need/1e9)
+		print (msg)
+		casalog.post(msg)
 
 ####################################################################################################################################
-polang = polang1 #or polang2
-polangcalib = polcalib1 #or polcalib2
+
+#RM synthesis
+#The MFS Q and U images average Faraday rotation out over the band. With rmsynth=True the final self-cal image of each target
+#also gets Q/U cubes of rmnchan channels (common restoring beam), and RM synthesis (Brentjens & de Bruyn 2005) turns them into
+#the Faraday dispersion function at every pixel, optionally RM-CLEANed (Heald et al. 2009). The exported cube is read through a
+#memory map in blocks of rows (rmblock bytes of spectra each), the blocks are processed at the same time in the process pool,
+#and every block writes its rows of the outputs straight into their FITS files, so a 6000x6000 cube is never held in memory.
+
+def fits_data(fitsfile, mode='r'):
+	# header and memory map (last FITS axis first) of the primary image of fitsfile
+	cards, start, nbytes = fits_hdus(fitsfile)[0]
+	naxis = [fits_value(cards, 'NAXIS%d' % i) for i in range(1, fits_value(cards, 'NAXIS')+1)]
+	return cards, np.memmap(fitsfile, dtype=fits_types[fits_value(cards, 'BITPIX')], mode=mode, offset=start, shape=tuple(naxis[::-1]))
+
+def fits_axis(cards, i):
+	# world coordinates along FITS axis i (1-based)
+	n = fits_value(cards, 'NAXIS%d' % i)
+	return fits_value(cards, 'CRVAL%d' % i)+(np.arange(n)+1-fits_value(cards, 'CRPIX%d' % i))*fits_value(cards, 'CDELT%d' % i)
+
+def fits_image(fitsfile, cards, axes, bunit):
+	# Create a float32 image with the sky axes of cards (an exported image) and the further axes in axes, a list of
+	# (ctype, crval, cdelt, cunit, n). Returns it as a writable memory map, last axis first.
+	def sky(card):
+		key = card[:8].strip()
+		m = re.match(r'(NAXIS|CTYPE|CRVAL|CDELT|CRPIX|CUNIT|CROTA)(\d+)$', key)
+		pc = re.match(r'PC0*(\d+)_0*(\d+)$', key)
+		return (key not in ('SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'BUNIT', 'BSCALE', 'BZERO', 'DATAMIN', 'DATAMAX', 'END')
+		        and not (m is not None and int(m.group(2)) > 2) and not (pc is not None and max(int(pc.group(1)), int(pc.group(2))) > 2))
+	shape = [fits_value(cards, 'NAXIS1'), fits_value(cards, 'NAXIS2')]+[a[4] for a in axes]
+	head = [fits_card('SIMPLE', True), fits_card('BITPIX', -32), fits_card('NAXIS', len(shape))]
+	head += [fits_card('NAXIS%d' % (i+1), shape[i]) for i in range(len(shape))]
+	head += [c for c in cards if sky(c) and not c[:8].strip().startswith('NAXIS')]
+	for i, (ctype, crval, cdelt, cunit, n) in enumerate(axes):
+		head += [fits_card('CTYPE%d' % (i+3), ctype), fits_card('CRVAL%d' % (i+3), crval), fits_card('CDELT%d' % (i+3), cdelt),
+		         fits_card('CRPIX%d' % (i+3), 1.0), fits_card('CUNIT%d' % (i+3), cunit)]
+	head += [fits_card('BUNIT', bunit), 'END'.ljust(80)]
+	head = fits_header_bytes(head)
+	nbytes = 4*int(np.prod(shape))
+	with open(fitsfile, 'wb') as fo:
+		fo.write(head)
+		fo.truncate(len(head)+nbytes+(-nbytes % 2880))
+	return np.memmap(fitsfile, dtype='>f4', mode='r+', offset=len(head), shape=tuple(shape[::-1]))
+
+def rm_block(job):
+	# runs in a pool worker: RM synthesis (and RM-CLEAN) of rows y0:y1 of the cube, written into the outputs of prefix
+	cubefile, prefix, y0, y1, phis, lam2, l0, w, rmsf, noise = job
+	cards, cube = fits_data(cubefile)
+	iq, iu = rm_stokes(cards)
+	cube = rm_order(cards, cube)
+	nchan, ny, nx = cube.shape[1:]
+	p = (np.asarray(cube[iq,:,y0:y1,:], np.float64)+1j*np.asarray(cube[iu,:,y0:y1,:], np.float64)).reshape(nchan, -1)
+	valid = np.isfinite(p)
+	p[~valid] = 0.0
+	norm = np.dot(w, valid)
+	kernel = np.exp(-2j*np.outer(phis, lam2-l0))
+	fdf = np.dot(kernel, w[:,None]*p)/np.where(norm > 0, norm, np.nan)
+	out = {'FDF': fdf}
+	if rmclean == True:
+		# Hogbom CLEAN along Faraday depth, every pixel at once
+		nphi = len(phis)
+		res = fdf.copy()
+		model = np.zeros(fdf.shape, complex)
+		pix = np.arange(fdf.shape[1])
+		for it in range(rmcleaniter):
+			k = np.argmax(np.abs(np.nan_to_num(res)), axis=0)
+			peak = res[k,pix]
+			comp = np.where(np.abs(peak) > rmcleancutoff*noise, 0.1*peak, 0.0)
+			if not comp.any():
+				break
+			model[k,pix] += comp
+			res -= comp[None,:]*rmsf[np.arange(nphi)[:,None]-k[None,:]+nphi-1]
+		# restored with a Gaussian of the RMSF width
+		fwhm = 2*np.sqrt(3)/(lam2[w > 0].max()-lam2[w > 0].min())
+		beam = np.exp(-4*np.log(2)*np.subtract.outer(phis, phis)**2/fwhm**2)
+		out['FDFclean'] = res+np.dot(beam, model)
+	amp = np.abs(out['FDFclean' if rmclean == True else 'FDF'])
+	nphi = len(phis)
+	k = np.argmax(np.nan_to_num(amp), axis=0)
+	pix = np.arange(amp.shape[1])
+	# peak Faraday depth refined by a parabola through the peak and its neighbours
+	a, b, c = amp[np.maximum(k-1, 0),pix], amp[k,pix], amp[np.minimum(k+1, nphi-1),pix]
+	with np.errstate(invalid='ignore', divide='ignore'):
+		shift = np.where((k > 0) & (k < nphi-1), 0.5*(a-c)/(a-2*b+c), 0.0)
+	out['peakP'] = b
+	out['peakRM'] = phis[k]+np.nan_to_num(shift)*(phis[1]-phis[0] if nphi > 1 else 0.0)
+	out['peakRM'][~np.isfinite(b)] = np.nan
+	for name, values in out.items():
+		ocards, image = fits_data(prefix+'.'+name+'.fits', 'r+')
+		if values.ndim == 1:
+			image[y0:y1,:] = values.reshape(y1-y0, nx)
+		else:
+			image[:,y0:y1,:] = np.abs(values).reshape(len(phis), y1-y0, nx)
+		image.flush()
+		del image
+	return y1-y0
+
+def rm_stokes(cards):
+	# planes of Q and U along the Stokes axis
+	i = [fits_value(cards, 'CTYPE%d' % n, '') for n in range(1, fits_value(cards, 'NAXIS')+1)].index('STOKES')+1
+	stokes = list(np.rint(fits_axis(cards, i)).astype(int))
+	return stokes.index(2), stokes.index(3)
+
+def rm_order(cards, data):
+	# an exported cube as Stokes x frequency x y x x, whatever the order of its axes
+	ctype = [fits_value(cards, 'CTYPE%d' % n, '') for n in range(1, fits_value(cards, 'NAXIS')+1)]
+	n = len(ctype)
+	return data.transpose(n-1-ctype.index('STOKES'), n-1-ctype.index('FREQ'), n-2, n-1)
+
+def rm_cube(cubefile, prefix):
+	# RM synthesis of the exported Q/U cube; returns the FITS files written
+	t0 = time.time()
+	cards, cube = fits_data(cubefile)
+	iq, iu = rm_stokes(cards)
+	cube = rm_order(cards, cube)
+	nchan, ny, nx = cube.shape[1:]
+	freqs = fits_axis(cards, [fits_value(cards, 'CTYPE%d' % n, '') for n in range(1, fits_value(cards, 'NAXIS')+1)].index('FREQ')+1)
+	lam2 = (299792458.0/freqs)**2
+	# channel weights from the noise of every 16th row of the Q and U planes
+	sigma = np.array([robust_std(np.asarray(cube[[iq,iu],c,::16,:]).ravel()) for c in range(nchan)])
+	w = np.where(np.isfinite(sigma) & (sigma > 0), 1/np.where(sigma > 0, sigma, 1.0)**2, 0.0)
+	l0 = np.sum(w*lam2)/np.sum(w)
+	fwhm = 2*np.sqrt(3)/(lam2[w > 0].max()-lam2[w > 0].min())
+	phimax = rmphimax if rmphimax > 0 else np.sqrt(3)/np.abs(np.diff(lam2)).max()
+	dphi = rmdphi if rmdphi > 0 else fwhm/3
+	n = int(phimax/dphi)
+	phis = dphi*np.arange(-n, n+1)
+	noise = np.sqrt(np.sum((w*np.nan_to_num(sigma))**2))/np.sum(w)
+	rmsf = np.dot(np.exp(-2j*np.outer(dphi*np.arange(-2*n, 2*n+1), lam2-l0)), w)/np.sum(w)
+	names = ['FDF', 'peakP', 'peakRM']+(['FDFclean'] if rmclean == True else [])
+	for name in names:
+		axes = [('FDEP', phis[0], dphi, 'rad/m2', len(phis))] if name.startswith('FDF') else []
+		fits_image(prefix+'.'+name+'.fits', cards, axes, 'rad/m2' if name == 'peakRM' else 'Jy/beam')
+	rows = max(1, rmblock//(16*nx*(nchan+len(phis)*(4 if rmclean == True else 2))))
+	jobs = [(cubefile, prefix, y0, min(ny, y0+rows), phis, lam2, l0, w, rmsf, noise) for y0 in range(0, ny, rows)]
+	run_pool(rm_block, jobs, rmworkers, fresh=False)
+	with open(prefix+'.json', 'w') as frm:
+		json.dump({'cube': cubefile, 'rmsf_fwhm': float(fwhm), 'phimax': float(phis[-1]), 'dphi': float(dphi), 'lambda2_0': float(l0),
+		           'noise': float(noise), 'channel_noise': [float(s) for s in sigma], 'blocks': len(jobs), 'wall': time.time()-t0}, frm, indent=1)
+	msg = ("RM synthesis of %s: %d channels, %d Faraday depths (+-%.0f rad/m2, RMSF %.1f rad/m2), %d blocks, %.1f s"
+	       % (cubefile, nchan, len(phis), phis[-1], fwhm, len(jobs), time.time()-t0))
+	print (msg)
+	casalog.post(msg)
+	return [prefix+'.'+name+'.fits' for name in names]+[prefix+'.json']
+
+def rm_synthesis(imagename):
+	# Q/U cubes of imagename from the corrected data of ms, exported and run through rm_cube
+	cubename = imagename+'_RM.QU'
+	tb.open(ms+'/SPECTRAL_WINDOW')
+	nchan = len(tb.getcell('CHAN_FREQ', 0))
+	tb.close()
+	width = max(1, nchan//rmnchan)
+	pars = quv_tclean_pars(scratch(cubename), 'QU', 'corrected')
+	pars.update(specmode='cube', nchan=nchan//width, start=0, width=width, deconvolver='hogbom', nterms=1, restoringbeam='common')
+	print ("Creating Stokes QU cube of %d channels" % (nchan//width))
+	tclean(**pars)
+	exportfits(imagename=scratch(cubename)+'.image', fitsimage=cubename+'.fits', velocity=False,optical=False,bitpix=-32,
+	           minpix=0,maxpix=-1,overwrite=True,dropstokes=False,stokeslast=True,history=True,dropdeg=False)
+	return rm_cube(cubename+'.fits', imagename+'_RM')
+
 ####################################################################################################################################
 
-#
-print  ("Applying Calibrations:") 
-
-print ("applying calibrations: primary calibrator")
-applycal(vis=ms, field = fluxfield, spw = flagspw, selectdata=False, calwt = False,
-    gaintable = [kcorrfile,bpassfile, fluxfile, kcross, leakage, polang],
-    gainfield = [kcorrfield,bpassfield,fluxfield, kcrosscalib, leakagecalib, polangcalib],
-    parang = True)
-
-print ("applying calibrations: secondary calibrators")
-applycal(vis=ms, field = secondaryfield, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile, bpassfile, fluxfile, kcross, leakage, polang],
-    gainfield = [kcorrfield, bpassfield,secondaryfield, kcrosscalib, leakagecalib, polangcalib],
-    parang= True)
-
-print ("applying calibrations: polarized calibrator")
-applycal(vis=ms, field = polcalib2, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile, bpassfile, fluxfile, kcross, leakage, polang],
-    gainfield = [kcorrfield, bpassfield,polcalib2, kcrosscalib, leakagecalib, polangcalib],
-    parang= True)
-
-print ("applying calibrations: unpolarized calibrator")
-applycal(vis=ms, field = unpolcalib1, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile, bpassfile, fluxfile, kcross, leakage, polang],
-    gainfield = [kcorrfield, bpassfield,unpolcalib1, kcrosscalib, leakagecalib, polangcalib],
-    parang= True)
-
-print ("applying calibrations: target fields")
-applycal(vis=ms, field = target, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile, bpassfile, fluxfile, kcross, leakage, polang],
-    gainfield = [kcorrfield, bpassfield,secondaryfield, kcrosscalib, leakagecalib, polangcalib],
-    parang= True)
-    
-print ("applying calibrations: Another field")
-applycal(vis=ms, field = anofield, spw = flagspw, selectdata = False, calwt = False,
-    gaintable = [kcorrfile, bpassfile, fluxfile, kcross, leakage, polang],
-    gainfield = [kcorrfield, bpassfield,anofield, kcrosscalib, leakagecalib, polangcalib],
-    parang= True)
-
-####################################################################################################################################
-
-print ("Flagging Target")
-# Now flag for target - moderate flagging
-print ("Flagging Step 1/3") 
-flagdata(vis=ms,mode="clip", spw=flagspw,field=target, clipminmax=cliptarget,
-        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-# now flag using 'rflag' option 
-print ("Flagging Step 2/3")
-flagdata(vis=ms,mode="rflag",datacolumn="corrected",field=target, timecutoff=4.0, 
-        freqcutoff=4.0,timefit="poly",freqfit="poly",flagdimension="freqtime", extendflags=False,
-        timedevscale=5.0,freqdevscale=5.0,spectralmax=500.0,extendpols=False, growaround=False,
-        flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
-print ("Flagging Step 3/3")
-# Now summary
-flagdata(vis=ms,mode="summary",datacolumn="corrected", extendflags=True, 
-         name=vis+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)
-
-####################################################################################################################################
-
-print ("Splitting target field")
-split(vis=ms, outputvis = fieldnames[int(target)]+'.ms', datacolumn='corrected', 
-          field = target, spw = splitspw, keepflags=False, width = specave)
-#
-# For more targets, add with target1, target2, ... 
-#split(vis=ms, outputvis = fieldnames[int(target1)]+'.ms', datacolumn='corrected', 
-#          field = target1, spw = splitspw, keepflags=False, width = specave)
-#split(vis=ms, outputvis = fieldnames[int(target2)]+'.ms', datacolumn='corrected', 
-#          field = target2, spw = splitspw, keepflags=False, width = specave)
+#Polarization maps
+#Stage polmaps turns the exported Stokes I, Q and U images of the final self-cal image into maps of the debiased polarized
+#intensity, the polarization angle and the fractional polarization, with their errors. The noise of each image is the robust rms
+#of its tclean residual. The FITS files are read and written through memory maps, a tile of rows at a time (polblock bytes of
+#all images), so the memory used does not depend on the image size.
+
+def image_noise(residual, fitsfile):
+	# rms of an image: the MAD of its tclean residual (or of its FITS export), or of every 16th row of its FITS file when there
+	# is no residual
+	for r in [scratch(residual), residual+'.fits']:
+		if os.path.exists(r):
+			return 1.4826*float(imstat(imagename=r)['medabsdevmed'][0])
+	cards, data = fits_data(fitsfile)
+	return float(robust_std(np.asarray(data.reshape((-1,)+data.shape[-2:])[0,::16,:], np.float64).ravel()))
+
+def pol_maps(imagename):
+	# P, PA and fractional polarization maps (and errors) of imagename; returns the FITS files written
+	t0 = time.time()
+	inputs = {'I': (imagename+'.fits', imagename+'.residual.tt0'),
+	          'Q': (imagename+'_Q.fits', imagename+'_Q.residual.tt0'), 'U': (imagename+'_U.fits', imagename+'_U.residual.tt0')}
+	noise = dict((s, image_noise(inputs[s][1], inputs[s][0])) for s in inputs)
+	squ = 0.5*(noise['Q']+noise['U'])
+	images = {}
+	for s in inputs:
+		cards, data = fits_data(inputs[s][0])
+		images[s] = data.reshape((-1,)+data.shape[-2:])[0]   # the first (only) frequency and Stokes plane
+	ny, nx = images['I'].shape
+	names = [('P', 'Jy/beam'), ('Perr', 'Jy/beam'), ('PA', 'deg'), ('PAerr', 'deg'), ('FP', ''), ('FPerr', '')]
+	outputs = dict((name, fits_image(imagename+'_'+name+'.fits', cards, [], unit)) for name, unit in names)
+	rows = max(1, polblock//(4*nx*(len(inputs)+len(names))))
+	for y0 in range(0, ny, rows):
+		y1 = min(ny, y0+rows)
+		i, q, u = [np.asarray(images[s][y0:y1], np.float64) for s in 'IQU']
+		p = np.hypot(q, u)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			pdb = np.sqrt(np.maximum(p**2-squ**2, 0.0))   # debiased (Wardle & Kronberg 1974)
+			det = pdb > polsnr*squ
+			pa = np.where(det, 0.5*np.degrees(np.arctan2(u, q)), np.nan)
+			paerr = np.where(det, 0.5*np.degrees(squ/pdb), np.nan)
+			fdet = det & (i > isnr*noise['I'])
+			fp = np.where(fdet, pdb/i, np.nan)
+			fperr = np.where(fdet, fp*np.sqrt((squ/pdb)**2+(noise['I']/i)**2), np.nan)
+		tile = {'P': pdb, 'Perr': np.full(pdb.shape, squ), 'PA': pa, 'PAerr': paerr, 'FP': fp, 'FPerr': fperr}
+		for name in tile:
+			outputs[name][y0:y1] = tile[name]
+	for name in outputs:
+		outputs[name].flush()
+	msg = ("Polarization maps of %s: noise I %.3g, Q %.3g, U %.3g Jy/beam, %d tiles, %.1f s"
+	       % (imagename, noise['I'], noise['Q'], noise['U'], -(-ny//rows), time.time()-t0))
+	print (msg)
+	casalog.post(msg)
+	return [imagename+'_'+name+'.fits' for name, unit in names]
 
 ####################################################################################################################################
 
-print ("\n Cleaning up. Starting imaging...")  
+#Image products
+#Every self-cal cycle leaves a full set of tclean products (image, residual, model, psf, pb, mask, sumwt, tt0 and tt1) and, with
+#eachQUV=True, one for each Stokes product too. Only the image the loop has adopted is needed later (its model and mask to
+#predict MODEL_DATA again when resuming or discarding a cycle, and the whole set once it is the final image), so it is kept
+#whole. With retain='prune' the products of the images it replaces or discards are deleted; retain='compress' packs them into
+#<product>.tar.gz instead. The tclean products can be kept in a fast scratchdir; the FITS files are always written next to the MS.
+
+import tarfile
+
+def scratch(name):
+	# where the tclean products of image name are kept
+	if scratchdir == '':
+		return name
+	return os.path.join(scratchdir, os.path.basename(name))
+
+def image_sets(imagename):
+	# prefixes of the tclean products made for a self-cal image: Stokes I, the Stokes products and the RM cube
+	return [imagename]+quv_products(imagename)+[imagename+'_RM.QU']
+
+def clear_images(*names):
+	# clear_products for image prefixes, in the scratch directory as well
+	clear_products(*names)
+	if scratchdir != '':
+		clear_products(*[scratch(n) for n in names])
+
+def export_products(imagename):
+	# Export the exportproducts of imagename's product sets that are not exported yet
+	for prefix in image_sets(imagename):
+		for product in exportproducts:
+			p = scratch(prefix)+'.'+product
+			if os.path.isdir(p) and not os.path.exists(prefix+'.'+product+'.fits'):
+				exportfits(imagename=p, fitsimage=prefix+'.'+product+'.fits', overwrite=True)
+
+def prune_images(imagename, keep=[]):
+	# Export the exportproducts of an image the loop no longer needs, then apply retain to the products whose kind
+	# (image, model, mask, ...) is not in keep
+	export_products(imagename)
+	freed = 0
+	for prefix in image_sets(imagename):
+		for p in sorted(glob.glob(scratch(prefix)+'.*')):
+			product = p[len(scratch(prefix))+1:]
+			if not os.path.isdir(p):
+				continue
+			if retain == 'all' or product.split('.')[0] in keep:
+				continue
+			freed += disk_usage(p)
+			if retain == 'compress':
+				with tarfile.open(prefix+'.'+product+'.tar.gz', 'w:gz') as tar:
+					tar.add(p, arcname=os.path.basename(p))
+			shutil.rmtree(p)
+	if freed > 0:
+		msg = "Image products of %s: %.2f GB %s" % (imagename, freed/1e9, 'compressed' if retain == 'compress' else 'deleted')
+		print (msg)
+		casalog.post(msg)
 
-ms=fieldnames[int(target)]+'.ms'
-
-def QUVimg():
-	print ("Creating Stokes Q image")
-
-	tclean(vis=ms,selectdata=True,field="",spw="",timerange="",uvrange="", antenna="",scan="",observation="",intent="", datacolumn= dc , imagename=ms+'.'+scmode+str(count-1)+'_Q',imsize=imagesize,cell=cellsize,phasecenter="",
-       stokes="Q",projection="SIN",startmodel="",specmode="mfs",reffreq="",
-       nchan=-1,start="",width="",outframe="LSRK",veltype="radio",
-       restfreq=[],interpolation="linear",perchanweightdensity=False,gridder="widefield",facets=1,
-       psfphasecenter="",wprojplanes=wproj,vptable="",usepointing=False,
-       mosweight=True,aterm=True,psterm=False,wbawp=True,conjbeams=False,
-       cfcache="",computepastep=360.0,rotatepastep=360.0,pblimit=-1,normtype="flatnoise",
-       deconvolver="mtmfs",scales=[],nterms=2,smallscalebias=0.6,restoration=True,
-       restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0.0,
-       noise="1.0Jy",npixels=0,uvtaper=[],niter=160000,gain=0.1,
-       threshold="0.01mJy",nsigma=0.0,cycleniter=-1,cyclefactor=1.3,minpsffraction=0.05,
-       maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,
-       sidelobethreshold=2.0,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,
-       minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,
-       verbose=False,fastnoise=True,restart=True,savemodel="none",calcres=True,
-       calcpsf=True,parallel=False)
-
-	exportfits(imagename=ms+'.'+scmode+str(count-1)+'_Q'+'.image.tt0', fitsimage=ms+'.'+scmode+str(count-1)+'_Q'+'.fits', velocity=False,optical=False,bitpix=-32, minpix=0, maxpix=-1, overwrite=False, dropstokes=False, stokeslast=True, history=True, dropdeg=False)
-
-	print ("Creating Stokes U image")
-
-	tclean(vis=ms,selectdata=True,field="",spw="",timerange="", uvrange="",antenna="",scan="",observation="",intent="",  datacolumn= dc , imagename=ms+'.'+scmode+str(count-1)+'_U',imsize=imagesize,cell=cellsize,phasecenter="",
-       stokes="U",projection="SIN",startmodel="",specmode="mfs",reffreq="",
-       nchan=-1,start="",width="",outframe="LSRK",veltype="radio",
-       restfreq=[],interpolation="linear",perchanweightdensity=False,gridder="widefield",facets=1,
-       psfphasecenter="",wprojplanes=wproj,vptable="",usepointing=False,
-       mosweight=True,aterm=True,psterm=False,wbawp=True,conjbeams=False,
-       cfcache="",computepastep=360.0,rotatepastep=360.0,pblimit=-1,normtype="flatnoise",
-       deconvolver="mtmfs",scales=[],nterms=2,smallscalebias=0.6,restoration=True,
-       restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0.0,
-       noise="1.0Jy",npixels=0,uvtaper=[],niter=160000,gain=0.1,
-       threshold="0.01mJy",nsigma=0.0,cycleniter=-1,cyclefactor=1.3,minpsffraction=0.05,
-       maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,
-       sidelobethreshold=2.0,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,
-       minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,
-       verbose=False,fastnoise=True,restart=True,savemodel="none",calcres=True,
-       calcpsf=True,parallel=False)
-
-	exportfits(imagename=ms+'.'+scmode+str(count-1)+'_U'+'.image.tt0' , fitsimage=ms+'.'+scmode+str(count-1)+'_U'+'.fits', velocity=False, optical=False, bitpix=-32, minpix=0, maxpix=-1, overwrite=False, dropstokes=False, stokeslast=True, history=True, dropdeg=False)
-	
-	if createV == True:
-		print ("Creating Stokes V image")
-
-		tclean(vis=ms,selectdata=True,field="",spw="",timerange="",
-		       uvrange="",antenna="",scan="",observation="",intent="",datacolumn="corrected",imagename=ms+'.'+scmode+str(count-1)+'_V',imsize=imagesize,cell=cellsize,phasecenter="",
-		       stokes="V",projection="SIN",startmodel="",specmode="mfs",reffreq="",
-		       nchan=-1,start="",width="",outframe="LSRK",veltype="radio",
-		       restfreq=[],interpolation="linear",perchanweightdensity=False,gridder="widefield",facets=1,
-		       psfphasecenter="",wprojplanes=wproj,vptable="",usepointing=False,
-		       mosweight=True,aterm=True,psterm=False,wbawp=True,conjbeams=False,
-		       cfcache="",computepastep=360.0,rotatepastep=360.0,pblimit=-1,normtype="flatnoise",
-		       deconvolver="mtmfs",scales=[],nterms=2,smallscalebias=0.6,restoration=True,
-		       restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0.0,
-		       noise="1.0Jy",npixels=0,uvtaper=[],niter=160000,gain=0.1,
-		       threshold="0.01mJy",nsigma=0.0,cycleniter=-1,cyclefactor=1.3,minpsffraction=0.05,
-		      maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,
-		       sidelobethreshold=2.0,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,
-		       minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,
- 		      verbose=False,fastnoise=True,restart=True,savemodel="none",calcres=True,
- 		      calcpsf=True,parallel=False)
-
-		exportfits(imagename=ms+'.'+scmode+str(count-1)+'_V'+'.image.tt0' , fitsimage=ms+'.'+scmode+str(count-1)+'_V'+'.fits',velocity=False,optical=False,bitpix=-32,
-		           minpix=0,maxpix=-1,overwrite=False,dropstokes=False,stokeslast=True,
- 		          history=True,dropdeg=False)	
-	
-print ("\n Cleaning up. Starting imaging...")
-#start self-calibration cycles    
-count=1
-scmode='p'
-#
+####################################################################################################################################
 
-print ("Prepaing dirty image")
-tclean(vis=ms, imagename=ms+'.'+scmode+str(count-1),imsize=imagesize,cell=cellsize, selectdata=True, datacolumn="data", 
-       phasecenter="",stokes="I",projection="SIN", specmode="mfs",nchan=-1,gridder="widefield",wprojplanes=wproj,
-       aterm=True,pblimit=-1, deconvolver="mtmfs",nterms=2,smallscalebias=0.6,restoration=True,pbcor=False,
-       weighting="briggs",robust=0.0,uvtaper=[],niter=int(0.5*startniter*2**count),gain=0.1,
-       threshold=str(startthreshold/(count))+'mJy',cyclefactor=1.3,
-       minpsffraction=0.05,maxpsffraction=0.8,usemask="auto-multithresh",pbmask=0.0,sidelobethreshold=2.0,
-       growiterations=75,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
-
-exportfits(imagename=ms+'.'+scmode+str(count-1)+'.image.tt0', fitsimage=ms+'.'+scmode+str(count-1)+'.fits')
-
-print ("Made : " +scmode+str(count-1))
-
-if  dirtyQUV == True or eachQUV == True:
-	dc="data"
-	QUVimg()
-
-#start self-calibration cycles  
-print ("Starting self-calibration, going to phase only calibration Cycle")
-casalog.post("Staring self-calibration, going to phase only calibration Cycle")
-
-for j in range(pcycles):  
-  scmode='p'
-  if(doflag==True and count>=1):
-     print ("Began flagging :"+scmode+str(count))
-     flagdata(vis=ms,mode="clip", spw="",field='', clipminmax=clipresid,
-              datacolumn="RESIDUAL_DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-              action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-     flagdata(vis=ms,mode="rflag",datacolumn="RESIDUAL_DATA",field='', timecutoff=5.0, 
-              freqcutoff=5.0,timefit="line",freqfit="line",flagdimension="freqtime", extendflags=False,
-              timedevscale=4.0,freqdevscale=4.0,spectralmax=500.0,extendpols=False, growaround=False,
-              flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
-     flagdata(vis=ms,mode="summary",datacolumn="RESIDUAL_DATA", extendflags=False, 
-              name=ms+'temp.summary', action="apply", flagbackup=True,overwrite=True, writeflags=True)
-#
-  print ("Began doing self-cal on :"+scmode+str(count))
-  gaincal(vis=ms,caltable=ms+'.'+scmode+str(count),selectdata=False,solint=str(solint/2**count)+'min',refant=refant,refantmode="strict",
-        minblperant=6, spw=gainspw2,minsnr=1.0,solnorm=True,gaintype="G",calmode=scmode,append=False, uvrange=uvrascal, parang=False)
-# 
-  print ("Began processing :"+scmode+str(count))
-  applycal(vis=ms, selectdata=False,gaintable=ms+'.'+scmode+str(count), parang=False,calwt=False,applymode="calflag",flagbackup=True)  
-#
-  tclean(vis=ms, imagename=ms+'.'+scmode+str(count),imsize=imagesize,cell=cellsize, selectdata=True, datacolumn="corrected", 
-       phasecenter="",stokes="I",projection="SIN", specmode="mfs",nchan=-1,gridder="widefield",wprojplanes=wproj,
-       aterm=True,pblimit=-1, deconvolver="mtmfs",nterms=2,smallscalebias=0.6,restoration=True,pbcor=False,
-       weighting="briggs",robust=0.0,uvtaper=[],niter=int(startniter*2**count),gain=0.1,
-       threshold=str(startthreshold/(count))+'mJy',cyclefactor=1.3,
-       minpsffraction=0.05,maxpsffraction=0.8,usemask="auto-multithresh",pbmask=0.0,sidelobethreshold=2.0,
-       growiterations=75,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
-  exportfits(imagename=ms+'.'+scmode+str(count)+'.image.tt0', fitsimage=ms+'.'+scmode+str(count)+'.fits')
-  print ("Made : " +scmode+str(count))
-  if eachQUV == True:
-	dc="corrected"
-  	QUVimg()
-  count = count + 1
-#
-print ("Completed phase only self-calibration, going to A&P calibration Cycle")
-casalog.post("Completed phase only self-calibration, going to A&P calibration Cycle")
-#
-count=1
-for j in range(apcycles):  
-  scmode = 'ap'
-  if count>= 4:
-   sfactor=4
-  else:
-   sfactor=count
-#
-  if(doflag==True):
-     print ("Began flagging :"+scmode+str(count))
-     flagdata(vis=ms,mode="clip", spw="",field='', clipminmax=clipresid,
-              datacolumn="RESIDUAL_DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-              action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-     flagdata(vis=ms,mode="rflag",datacolumn="RESIDUAL_DATA",field='', timecutoff=5.0, 
-              freqcutoff=5.0,timefit="line",freqfit="line",flagdimension="freqtime", extendflags=False,
-              timedevscale=4.0,freqdevscale=4.0,spectralmax=500.0,extendpols=False, growaround=False,
-              flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
-     flagdata(vis=ms,mode="summary",datacolumn="RESIDUAL_DATA", extendflags=False, 
-              name=ms+'temp.summary', action="apply", flagbackup=True,overwrite=True, writeflags=True)
-#
-  print ("Began doing self-cal on :"+scmode+str(count))
-  gaincal(vis=ms,caltable=ms+'.'+scmode+str(count),selectdata=False,solint=str(apsolint/2**sfactor)+'min',refant=refant,
-        refantmode="strict",spw=gainspw2,minblperant=6, minsnr=1.0,solnorm=True,gaintype="G",calmode=scmode,append=False, parang=False)
-#
-  applycal(vis=ms, selectdata=False,gaintable=ms+'.'+scmode+str(count), parang=False,calwt=False,applymode="calflag",flagbackup=True)  
-#
-  print ("Began processing :"+scmode+str(count))
-  tclean(vis=ms, imagename=ms+'.'+scmode+str(count),imsize=imagesize,cell=cellsize, selectdata=True, datacolumn="corrected", 
-       phasecenter="",stokes="I",projection="SIN", specmode="mfs",nchan=-1,gridder="widefield",wprojplanes=wproj,
-       aterm=True,pblimit=-1, deconvolver="mtmfs",nterms=2,smallscalebias=0.6,restoration=True,pbcor=False,
-       weighting="briggs",robust=0.0,uvtaper=[],niter=int(startniter*2*2**count),gain=0.1,
-       threshold=str(startthreshold/(2*count))+'mJy',cyclefactor=1.3,
-       minpsffraction=0.05,maxpsffraction=0.8,usemask="auto-multithresh",pbmask=0.0,sidelobethreshold=2.0,
-       growiterations=75,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
-  exportfits(imagename=ms+'.'+scmode+str(count)+'.image.tt0', fitsimage=ms+'.'+scmode+str(count)+'.fits')
-  print ("Made : " +scmode+str(count))
-  if eachQUV == True:
-	dc="corrected"
-  	QUVimg()
-  count = count + 1
-#
-print ("Completed processing AP self-calibrations\n")
-casalog.post("Completed processing A&P self-calibrations")
+def selfcal_params(extra):
+	# parameters shared by the self-cal stages, plus the per-cycle ones in extra
+	pars = {'imagesize':imagesize, 'cellsize':cellsize, 'wproj':wproj, 'gainspw2':gainspw2, 'refant':refant,
+	        'uvrascal':uvrascal, 'clipresid':clipresid, 'doflag':doflag, 'startniter':startniter,
+	        'startthreshold':startthreshold, 'eachQUV':eachQUV, 'createV':createV, 'flagengine':flagengine.get('selfcal-rflag', 'casa'),
+	        'selfcalmodel':selfcalmodel}
+	pars.update(extra)
+	return pars
+
+def residual_flag(label):
+	# clip and rflag on RESIDUAL_DATA with the summary of the result, all in a single list-mode pass over ms (two more
+	# around a sumthreshold rflag; batchflag=False runs them as three passes, as before), and the flagged fraction found
+	cmds = [flagcmd(mode="clip", spw="", field='', clipminmax=clipresid, datacolumn="RESIDUAL_DATA", clipoutside=True,
+	                clipzeros=True, extendpols=False),
+	        rficmd("selfcal-rflag", mode="rflag", datacolumn="RESIDUAL_DATA", field='', timecutoff=5.0, freqcutoff=5.0, timefit="line",
+	                freqfit="line", flagdimension="freqtime", extendflags=False, timedevscale=4.0, freqdevscale=4.0,
+	                spectralmax=500.0, extendpols=False, growaround=False, flagneartime=False, flagnearfreq=False),
+	        flagcmd(mode="summary", datacolumn="RESIDUAL_DATA", extendflags=False, name=ms+'temp.summary')]
+	t0 = time.time()
+	r0 = io_counters()[0]
+	passes = flag_passes(cmds) if batchflag == True else [[cmd] for cmd in cmds]
+	for p in passes:
+		summary = flag_pass(ms, p)
+	npass = len(passes)
+	# list mode returns the summary itself, or one report per summary command
+	if isinstance(summary, dict) and 'total' not in summary:
+		summary = ([s for s in summary.values() if isinstance(s, dict) and 'total' in s]+[None])[0]
+	flagged = summary['flagged']/summary['total'] if isinstance(summary, dict) and summary.get('total', 0) > 0 else float('nan')
+	msg = ("Residual flagging %s of %s: %.1f%% flagged, %d pass(es), %.1f s, %.3f GB read"
+	       % (label, ms, 100*flagged, npass, time.time()-t0, (io_counters()[0]-r0)/1e9))
+	print (msg)
+	casalog.post(msg)
+	with open(flagreport, 'a') as frep:
+		frep.write(time.strftime('%Y-%m-%d %H:%M:%S')+'  '+('batch' if batchflag == True else 'sequential')+'  '+msg+'\n')
+	return flagged
+
+def selfcal_restore(caltable, imagename):
+	# When resuming inside the self-cal chain, CORRECTED_DATA and MODEL_DATA are put back to what the last good cycle left
+	if caltable != '':
+		print ("Re-applying "+caltable)
+		applycal(vis=ms, selectdata=False,gaintable=caltable, parang=False,calwt=False,applymode="calflag",flagbackup=False)
+	else:
+		clearcal(vis=ms)   # no self-cal table adopted yet
+	if imagename != '':
+		# with niter=0 and calcpsf/calcres off, tclean only predicts the existing model images into MODEL_DATA (or the
+		# virtual model)
+		print ("Predicting model from "+imagename)
+		tclean(vis=ms, imagename=scratch(imagename),imsize=imagesize,cell=cellsize, selectdata=True, datacolumn="corrected", 
+		       phasecenter="",stokes="I",projection="SIN", specmode="mfs",nchan=-1,gridder="widefield",wprojplanes=wproj,
+		       aterm=True,pblimit=-1, deconvolver="mtmfs",nterms=2,weighting="briggs",robust=0.0,niter=0,
+		       restart=True,savemodel=selfcalmodel,calcres=False,calcpsf=False,parallel=False)
+
+def image_metrics(imagename, caltable=''):
+	# residual rms (from the MAD), image peak and dynamic range of a self-cal image, and the flagged fraction of its gain solutions
+	rms = 1.4826*imstat(imagename=scratch(imagename)+'.residual.tt0')['medabsdevmed'][0]
+	peak = imstat(imagename=scratch(imagename)+'.image.tt0')['max'][0]
+	flagged = 0.0
+	if caltable != '':
+		tb.open(caltable)
+		flags = tb.getcol('FLAG')
+		tb.close()
+		flagged = float(flags.mean()) if flags.size > 0 else 1.0
+	return {'rms': rms, 'peak': peak, 'dr': peak/rms if rms > 0 else 0.0, 'flagged': flagged}
+
+def selfcal_verdict(prev, cur):
+	# 'keep' the cycle and go on, 'stop' after it, or 'discard' it and stop
+	print ("Self-cal metrics: rms %.3g Jy, peak %.3g Jy, dynamic range %.0f (was %.0f), %.1f%% of the solutions flagged"
+	       % (cur['rms'], cur['peak'], cur['dr'], prev['dr'], 100*cur['flagged']))
+	if convergetol < 0:
+		return 'keep'
+	ddr = (cur['dr']-prev['dr'])/prev['dr'] if prev['dr'] > 0 else 1.0
+	drms = (prev['rms']-cur['rms'])/prev['rms'] if prev['rms'] > 0 else 1.0
+	if cur['flagged'] > maxsolflag or ddr < -convergetol:
+		return 'discard'
+	if max(ddr, drms) < convergetol:
+		return 'stop'
+	return 'keep'
+
+def selfcal_next(stage, ran, caltable, imagename):
+	# after a self-cal cycle: decides from its recorded metrics whether the loop goes on, and adopts its table and image unless discarded
+	global prevcal, previmg, prevmetrics
+	cur = stages[stage].get('info', {})
+	verdict = selfcal_verdict(prevmetrics, cur) if len(cur) > 0 and len(prevmetrics) > 0 else 'keep'
+	if verdict == 'discard':
+		print ("Discarding "+stage+", going back to "+previmg)
+		casalog.post("Self-cal cycle "+stage+" discarded")
+		if ran == True:
+			selfcal_restore(prevcal, previmg)
+		prune_images(imagename, keepproducts)
+		return False
+	prune_images(previmg, keepproducts)
+	prevcal = caltable
+	previmg = imagename
+	prevmetrics = cur
+	if verdict == 'stop':
+		print ("Self-cal converged at "+stage)
+		casalog.post("Self-cal converged at "+stage)
+		return False
+	return True
+
+stagetag=''             # prefix of the self-cal stage names: the field name of the target when there are several
+
+def target_chain(job):
+	# Self-calibration and Q/U/V imaging of one target from its split MS. The chains of different targets are independent;
+	# run in the process pool, each has its own process, so the globals set here stay private to it.
+	global ms, imagesize, cellsize, wproj, gainspw2, stagetag, count, scmode, prevcal, previmg, prevmetrics, stage_rerun, resumed_at
+	t, geometry = job
+	t0 = time.time()
+	ms = fieldnames[int(t)]+'.ms'
+	imagesize, cellsize, wproj = geometry
+	# gainspw2 is in channels of specave; follow the averaging the split chose
+	gainspw2 = gainspw2_split
+	width = stages['split'].get('info', {}).get(t, {}).get('width', specave)
+	if width != specave:
+		gainspw2 = scale_channels(gainspw2, float(specave)/width)
+		print ("Self-cal channels of "+ms+" after averaging: "+gainspw2)
+	stagetag = '' if len(targets) == 1 else fieldnames[int(t)]+'-'
+	del stage_order[stage_order.index('split')+1:]
+	stage_rerun = split_rerun
+	resumed_at = ''
+	#start self-calibration cycles    
+	count=1
+	scmode='p'
+	prevcal=''             # gain table of the last self-cal cycle ('' before the first one) ---- used when resuming
+	#
+	print ("Prepaing dirty image")
+	stage=stagetag+'selfcal-'+scmode+str(count-1)
+	if stage_start(stage, ms, selfcal_params({'dirtyQUV':dirtyQUV})):
+		if selfcalmodel == 'virtual':
+			drop_columns(ms, ['MODEL_DATA'])   # left by an earlier run; it would hide the virtual model
+		clear_images(ms+'.'+scmode+str(count-1), *quv_products(ms+'.'+scmode+str(count-1)))
+		fingerprint = uv_fingerprint(ms) if reusepsf == True else ''
+		cached_tclean(fingerprint, vis=ms, imagename=scratch(ms+'.'+scmode+str(count-1)),imsize=imagesize,cell=cellsize, selectdata=True, datacolumn="data", 
+		              phasecenter="",stokes="I",projection="SIN", specmode="mfs",nchan=-1,gridder="widefield",wprojplanes=wproj,
+		              aterm=True,pblimit=-1, deconvolver="mtmfs",nterms=2,smallscalebias=0.6,restoration=True,pbcor=False,
+		              weighting="briggs",robust=0.0,uvtaper=[],niter=int(0.5*startniter*2**count),gain=0.1,
+		              threshold=str(startthreshold/(count))+'mJy',cyclefactor=1.3,
+		              minpsffraction=0.05,maxpsffraction=0.8,usemask="auto-multithresh",pbmask=0.0,sidelobethreshold=2.0,
+		              growiterations=75,restart=True,savemodel=selfcalmodel,calcres=True,calcpsf=True,parallel=False)
+
+		exportfits(imagename=scratch(ms+'.'+scmode+str(count-1))+'.image.tt0', fitsimage=ms+'.'+scmode+str(count-1)+'.fits', overwrite=True)
+
+		print ("Made : " +scmode+str(count-1))
+
+		if  dirtyQUV == True or eachQUV == True:
+			QUVimg(ms+'.'+scmode+str(count-1), "data", fingerprint)
+		stage_end(stage, ms, [ms+'.'+scmode+str(count-1)+'.fits'], image_metrics(ms+'.'+scmode+str(count-1)))
+	previmg=ms+'.'+scmode+str(count-1)
+	prevmetrics=stages[stage].get('info', {})
+
+	#start self-calibration cycles  
+	print ("Starting self-calibration, going to phase only calibration Cycle")
+	casalog.post("Staring self-calibration, going to phase only calibration Cycle")
+
+	for j in range(pcycles):  
+		scmode='p'
+		stage=stagetag+'selfcal-'+scmode+str(count)
+		ran = stage_start(stage, ms, selfcal_params({'solint':solint, 'niter':int(startniter*2**count)}))
+		if ran:
+			if resumed_at == stage:
+				selfcal_restore(prevcal, previmg)
+			clear_images(ms+'.'+scmode+str(count), *quv_products(ms+'.'+scmode+str(count)))
+			if(doflag==True and count>=1):
+				print ("Began flagging :"+scmode+str(count))
+				residual_flag(scmode+str(count))
+			#
+			print ("Began doing self-cal on :"+scmode+str(count))
+			gaincal(vis=ms,caltable=ms+'.'+scmode+str(count),selectdata=False,solint=str(solint/2**count)+'min',refant=refant,refantmode="strict",
+			        minblperant=6, spw=gainspw2,minsnr=1.0,solnorm=True,gaintype="G",calmode=scmode,append=False, uvrange=uvrascal, parang=False)
+			# 
+			print ("Began processing :"+scmode+str(count))
+			applycal(vis=ms, selectdata=False,gaintable=ms+'.'+scmode+str(count), parang=False,calwt=False,applymode="calflag",flagbackup=True)  
+			#
+			fingerprint = uv_fingerprint(ms) if reusepsf == True else ''
+			cached_tclean(fingerprint, vis=ms, imagename=scratch(ms+'.'+scmode+str(count)),imsize=imagesize,cell=cellsize, selectdata=True, datacolumn="corrected", 
+			              phasecenter="",stokes="I",projection="SIN", specmode="mfs",nchan=-1,gridder="widefield",wprojplanes=wproj,
+			              aterm=True,pblimit=-1, deconvolver="mtmfs",nterms=2,smallscalebias=0.6,restoration=True,pbcor=False,
+			              weighting="briggs",robust=0.0,uvtaper=[],niter=int(startniter*2**count),gain=0.1,
+			              threshold=str(startthreshold/(count))+'mJy',cyclefactor=1.3,
+			              minpsffraction=0.05,maxpsffraction=0.8,usemask="auto-multithresh",pbmask=0.0,sidelobethreshold=2.0,
+			              growiterations=75,restart=True,savemodel=selfcalmodel,calcres=True,calcpsf=True,parallel=False)
+			exportfits(imagename=scratch(ms+'.'+scmode+str(count))+'.image.tt0', fitsimage=ms+'.'+scmode+str(count)+'.fits', overwrite=True)
+			print ("Made : " +scmode+str(count))
+			if eachQUV == True:
+				QUVimg(ms+'.'+scmode+str(count), "corrected", fingerprint)
+			stage_end(stage, ms, [ms+'.'+scmode+str(count), ms+'.'+scmode+str(count)+'.fits'],
+			          image_metrics(ms+'.'+scmode+str(count), ms+'.'+scmode+str(count)))
+		count = count + 1
+		if not selfcal_next(stage, ran, ms+'.'+scmode+str(count-1), ms+'.'+scmode+str(count-1)):
+			break
+	#
+	print ("Completed phase only self-calibration, going to A&P calibration Cycle")
+	casalog.post("Completed phase only self-calibration, going to A&P calibration Cycle")
+	#
+	count=1
+	for j in range(apcycles):  
+		scmode = 'ap'
+		if count>= 4:
+			sfactor=4
+		else:
+			sfactor=count
+		#
+		stage=stagetag+'selfcal-'+scmode+str(count)
+		ran = stage_start(stage, ms, selfcal_params({'apsolint':apsolint, 'niter':int(startniter*2*2**count)}))
+		if ran:
+			if resumed_at == stage:
+				selfcal_restore(prevcal, previmg)
+			clear_images(ms+'.'+scmode+str(count), *quv_products(ms+'.'+scmode+str(count)))
+			if(doflag==True):
+				print ("Began flagging :"+scmode+str(count))
+				residual_flag(scmode+str(count))
+			#
+			print ("Began doing self-cal on :"+scmode+str(count))
+			gaincal(vis=ms,caltable=ms+'.'+scmode+str(count),selectdata=False,solint=str(apsolint/2**sfactor)+'min',refant=refant,
+			        refantmode="strict",spw=gainspw2,minblperant=6, minsnr=1.0,solnorm=True,gaintype="G",calmode=scmode,append=False, parang=False)
+			#
+			applycal(vis=ms, selectdata=False,gaintable=ms+'.'+scmode+str(count), parang=False,calwt=False,applymode="calflag",flagbackup=True)  
+			#
+			print ("Began processing :"+scmode+str(count))
+			fingerprint = uv_fingerprint(ms) if reusepsf == True else ''
+			cached_tclean(fingerprint, vis=ms, imagename=scratch(ms+'.'+scmode+str(count)),imsize=imagesize,cell=cellsize, selectdata=True, datacolumn="corrected", 
+			              phasecenter="",stokes="I",projection="SIN", specmode="mfs",nchan=-1,gridder="widefield",wprojplanes=wproj,
+			              aterm=True,pblimit=-1, deconvolver="mtmfs",nterms=2,smallscalebias=0.6,restoration=True,pbcor=False,
+			              weighting="briggs",robust=0.0,uvtaper=[],niter=int(startniter*2*2**count),gain=0.1,
+			              threshold=str(startthreshold/(2*count))+'mJy',cyclefactor=1.3,
+			              minpsffraction=0.05,maxpsffraction=0.8,usemask="auto-multithresh",pbmask=0.0,sidelobethreshold=2.0,
+			              growiterations=75,restart=True,savemodel=selfcalmodel,calcres=True,calcpsf=True,parallel=False)
+			exportfits(imagename=scratch(ms+'.'+scmode+str(count))+'.image.tt0', fitsimage=ms+'.'+scmode+str(count)+'.fits', overwrite=True)
+			print ("Made : " +scmode+str(count))
+			if eachQUV == True:
+				QUVimg(ms+'.'+scmode+str(count), "corrected", fingerprint)
+			stage_end(stage, ms, [ms+'.'+scmode+str(count), ms+'.'+scmode+str(count)+'.fits'],
+			          image_metrics(ms+'.'+scmode+str(count), ms+'.'+scmode+str(count)))
+		count = count + 1
+		if not selfcal_next(stage, ran, ms+'.'+scmode+str(count-1), ms+'.'+scmode+str(count-1)):
+			break
+	#
+	print ("Completed processing AP self-calibrations\n")
+	casalog.post("Completed processing A&P self-calibrations")
+
+	if eachQUV == False:
+		stage=stagetag+'QUV'
+		if stage_start(stage, ms, selfcal_params({'image':previmg}), [prevcal] if prevcal != '' else []):
+			if resumed_at == stage:
+				selfcal_restore(prevcal, '')
+			clear_images(*quv_products(previmg))
+			QUVimg(previmg, "corrected")
+			stage_end(stage, ms, [previmg+'_Q.fits', previmg+'_U.fits'])
+
+	if polmaps == True:
+		stage=stagetag+'polmaps'
+		if stage_start(stage, ms, {'image':previmg, 'polsnr':polsnr, 'isnr':isnr}, [previmg+'.fits', previmg+'_Q.fits', previmg+'_U.fits']):
+			stage_end(stage, ms, pol_maps(previmg))
+
+	if rmsynth == True:
+		stage=stagetag+'RM'
+		rmpars = {'image':previmg, 'rmnchan':rmnchan, 'rmphimax':rmphimax, 'rmdphi':rmdphi, 'rmclean':rmclean,
+		          'rmcleancutoff':rmcleancutoff, 'rmcleaniter':rmcleaniter}
+		if stage_start(stage, ms, selfcal_params(rmpars), [prevcal] if prevcal != '' else []):
+			if resumed_at == stage or (scratchcols == 'lean' and resumed_at == stagetag+'polmaps'):
+				selfcal_restore(prevcal, '')   # the scratch columns are gone if the last run finished the chain
+			clear_images(previmg+'_RM')
+			stage_end(stage, ms, rm_synthesis(previmg))
+	export_products(previmg)
+	if scratchcols == 'lean':
+		drop_columns(ms)
+	return fieldnames[int(t)], previmg, time.time()-t0
 
 ####################################################################################################################################
-if eachQUV == False:
-	dc="corrected"
-	QUVimg()
+
+#Targets
+#Every target is imaged with its own geometry. The chains run at the same time, as many as targetworkers and the free memory
+#for their tclean runs allow.
+gainspw2_split = gainspw2
+if selfcalmodel == 'virtual' and flagengine.get('selfcal-rflag', 'casa') == 'sumthreshold':
+	print ("The SumThreshold engine of selfcal-rflag reads MODEL_DATA, keeping the self-cal models there")
+	selfcalmodel = 'modelcolumn'
+if scratchdir != '' and not os.path.exists(scratchdir):
+	os.makedirs(scratchdir)
+geometries = {}
+for t in targets:
+	if autogeometry == True:
+		geometries[t] = image_geometry(fieldnames[int(t)]+'.ms')
+		msg = "Image geometry for "+fieldnames[int(t)]+".ms: imsize %d, cell %s, wprojplanes %d" % (geometries[t][0][0], geometries[t][1], geometries[t][2])
+		print (msg)
+		casalog.post(msg)
+	else:
+		geometries[t] = (imagesize, cellsize, wproj)
+need = max(tclean_memory(g[0], 2, 1, g[2]) for g in geometries.values())
+free = mem_available()
+workers = targetworkers
+if free > 0:
+	workers = max(1, min(workers, int(0.8*free//need)))
+print ("Self-calibrating %d target(s) with %d worker(s), ~%.1f GB each, %.1f GB free" % (len(targets), min(workers, len(targets)), need/1e9, free/1e9))
+for name, image, wall in run_pool(target_chain, [(t, geometries[t]) for t in targets], workers):
+	msg = "Target %s: final image %s, %.1f s" % (name, image, wall)
+	print (msg)
+	casalog.post(msg)
+
 ####################################################################################################################################
 
+print ("Run report: "+profreport+".json, "+profreport+".csv")
+prof_report()
+
 print ("Done")
 
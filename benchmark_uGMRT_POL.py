@@ -0,0 +1,387 @@
+# Benchmark for the Improved uGMRT polarization pipeline on synthetic data
+# Run inside CASA: casa --nogui --nologger -c benchmark_uGMRT_POL.py
+#
+# For every case below a synthetic uGMRT band-4 multi-source data set is simulated with the CASA simulator:
+# an unpolarized calibrator (3C84), the target, a phase calibrator and the polarized calibrators 3C286, 3C138 and 3C48,
+# whose Stokes I/Q/U come from the same pol_*.txt tables the pipeline uses. Antenna gains, leakage, thermal noise and RFI
+# (narrow-band lines, broad-band bursts and impulsive spikes) are added on top.
+# Improved_uGMRT_POL.py then runs on a fresh copy of it in its own CASA session, with the case parameters passed through
+# pipeline_params.json. The wall time of every pipeline stage (import, flag0, cal0, flag1, cal1, polcal, split, the self-cal
+# cycles and QUV) and the per-task summary of the run report are appended to resultsfile under the pipeline version,
+# and compared with the last run of the same case by another version.
+#
+# Before the pipeline run, rflag and the pipeline's SumThreshold engine flag the target of the simulated data set in turn,
+# starting from the same flags, and their wall times, flagged fractions and agreement are kept with the results.
+#
+# With columncompare the pipeline runs a second time with the other setting of its scratch columns (scratchcols='full' with
+# MODEL_DATA self-cal models against scratchcols='lean' with virtual ones), and the peak and final disk use of the run
+# directory, the bytes the runs read and wrote and their wall times are compared.
+#
+# The simulated data sets are kept in benchdir and reused as long as the case does not change.
+# The field numbers match the defaults of the pipeline: 0 3C84, 1 TARGET, 2 PHASECAL, 3 3C286, 4 3C138, 5 3C48.
+
+####################################################################################################################################
+
+#Benchmark parameters
+import os, json, shutil, subprocess, time, socket, resource
+import numpy as np
+
+srcdir=os.getcwd()                # directory with the pipeline and the pol_*.txt tables
+pipeline='Improved_uGMRT_POL.py'  # pipeline script in srcdir
+casacmd=['casa', '--nogui', '--nologger', '--log2term', '-c']  # how a pipeline run is started
+benchdir='benchmark'              # simulated data sets and pipeline runs, one directory per case
+resultsfile='benchmark_results.json'  # results of all benchmark runs
+version=''                        # label of the pipeline version under test; '' uses git describe
+#
+reffreq=550.0          # MHz, first channel
+bandwidth=200.0        # MHz
+inttime='8s'           # integration time
+scantime=600.0         # s, target scan; calibrator scans are half of it (3C286 is observed at start and end)
+scangap=30.0           # s, slew between scans
+noise='0.5Jy'          # thermal noise per visibility
+gainamp=0.05           # fractional amplitude of the simulated antenna gain drifts
+leakamp=0.03           # amplitude of the simulated instrumental leakage
+rfiamp=500.0           # Jy, amplitude of injected RFI
+seed=42
+#
+# nchan: channels, nant: antennas (at most 30), nscans: target scans, rfifrac: fraction of channels, integrations and
+# visibilities hit by persistent, broad-band and impulsive RFI; params: further pipeline parameters for this case
+cases=[{'name':'2048ch', 'nchan':2048, 'nant':30, 'nscans':4, 'rfifrac':0.02, 'params':{}},
+       {'name':'4096ch', 'nchan':4096, 'nant':30, 'nscans':4, 'rfifrac':0.02, 'params':{}}]
+pipeparams={'resume':False}  # pipeline parameters for every case
+#
+flagcompare=True       # time rflag against the SumThreshold engine of the pipeline on every data set
+flagfield='1'          # field they flag
+flagcutoff=5.0         # rflag timedevscale/freqdevscale and SumThreshold cutoff, as in the target steps of the pipeline
+columncompare=True     # run every case again with the other scratch column setting of the pipeline and compare the two
+diskpoll=10.0          # s between two readings of the disk use of a run
+columnmodes={'full':{'scratchcols':'full', 'selfcalmodel':'modelcolumn'}, 'lean':{'scratchcols':'lean', 'selfcalmodel':'virtual'}}
+
+####################################################################################################################################
+
+#Synthetic data
+antnames=['C00', 'C01', 'C02', 'C03', 'C04', 'C05', 'C06', 'C08', 'C09', 'C10', 'C11', 'C12', 'C13', 'C14',
+          'E02', 'E03', 'E04', 'E05', 'E06', 'S01', 'S02', 'S03', 'S04', 'S06', 'W01', 'W02', 'W03', 'W04', 'W05', 'W06']
+armangle={'E':80.0, 'S':190.0, 'W':290.0}   # degrees east of north
+fields=[['3C84', '03h19m48.160', '+41d30m42.10'],
+        ['TARGET', '14h00m00.000', '+30d00m00.00'],
+        ['PHASECAL', '14h07m00.394', '+28d27m14.69'],
+        ['3C286', '13h31m08.288', '+30d30m32.96'],
+        ['3C138', '05h21m09.886', '+16d38m22.05'],
+        ['3C48', '01h37m41.299', '+33d09m35.13']]
+target_sources=[[0.0, 0.0, 0.5, 0.05], [90.0, -60.0, 0.2, 0.10], [-300.0, 240.0, 0.1, 0.0], [600.0, 420.0, 0.05, 0.2]]  # dRA, dDec (arcsec), Jy, pol. fraction
+
+def gmrt_layout(nant, rs):
+	# GMRT-like Y: 14 antennas within 1 km and the arm antennas every ~2.2 km out to ~14 km
+	x, y = [], []
+	for name in antnames[:nant]:
+		if name[0] == 'C':
+			r = rs.uniform(50.0, 1000.0)
+			th = rs.uniform(0.0, 2*np.pi)
+		else:
+			r = 2200.0*int(name[1:])+rs.uniform(-300.0, 300.0)
+			th = np.radians(armangle[name[0]])+rs.normal(0.0, 0.05)
+		x.append(r*np.sin(th))
+		y.append(r*np.cos(th))
+	return x, y
+
+def calibrator_stokes(name, f0):
+	# Stokes I, Q, U and spectral index at f0 (GHz) from the Perley-Butler coefficients and PF/PA of pol_<name>.txt
+	table = np.loadtxt(os.path.join(srcdir, "pol_"+name+".txt"), skiprows=1, ndmin=2)
+	logs = np.polynomial.polynomial.polyval(np.log10(f0), table[:,3])
+	dlogs = np.polynomial.polynomial.polyval(np.log10(f0), np.polynomial.polynomial.polyder(table[:,3]))
+	x = (table[:,0]-f0)/f0
+	pf = max(np.polyfit(x, table[:,1]/100, min(2, len(table)-1))[-1], 0.0)
+	pa = np.radians(np.polyfit(x, table[:,2], min(2, len(table)-1))[-1])
+	i0 = 10**logs
+	return [i0, i0*pf*np.cos(2*pa), i0*pf*np.sin(2*pa), 0.0], dlogs
+
+def write_complist(clfile, components, f0):
+	# components: [direction, [I,Q,U,V], spectral index]
+	cl.done()
+	for direction, flux, index in components:
+		cl.addcomponent(flux=flux, fluxunit='Jy', polarization='Stokes', dir=direction, shape='point',
+		                freq=str(f0)+'GHz', spectrumtype='spectral index', index=index)
+	cl.rename(clfile)
+	cl.done()
+
+def inject_rfi(vis, rfifrac, rs, chunk=100000):
+	# persistent narrow-band lines in rfifrac of the channels, broad-band bursts in rfifrac of the integrations
+	# and impulsive spikes in rfifrac of the visibilities, all at rfiamp with random phase
+	tb.open(vis, nomodify=False)
+	nrow = tb.nrows()
+	ncorr, nchan = tb.getcell('DATA', 0).shape
+	times = np.unique(tb.getcol('TIME'))
+	lines = rs.rand(nchan) < rfifrac
+	bursts = set(times[rs.rand(len(times)) < rfifrac])
+	for start in range(0, nrow, chunk):
+		n = min(chunk, nrow-start)
+		data = tb.getcol('DATA', startrow=start, nrow=n)
+		hit = np.zeros(data.shape, bool)
+		hit[:,lines,:] = True
+		hit[:,:,np.array([t in bursts for t in tb.getcol('TIME', startrow=start, nrow=n)])] = True
+		hit |= rs.rand(*data.shape) < rfifrac
+		data[hit] += rfiamp*np.exp(2j*np.pi*rs.rand(hit.sum()))
+		tb.putcol('DATA', data, startrow=start, nrow=n)
+	tb.close()
+
+def simulate(vis, case):
+	rs = np.random.RandomState(seed)
+	nchan = case['nchan']
+	f0 = reffreq/1000.0
+	x, y = gmrt_layout(case['nant'], rs)
+	sm.open(vis)
+	sm.setconfig(telescopename='GMRT', x=x, y=y, z=[0.0]*len(x), dishdiameter=[45.0]*len(x), mount=['alt-az']*len(x),
+	             antname=antnames[:len(x)], padname=antnames[:len(x)], coordsystem='local', referencelocation=me.observatory('GMRT'))
+	sm.setspwindow(spwname='band4', freq=str(reffreq)+'MHz', deltafreq=str(bandwidth/nchan)+'MHz',
+	               freqresolution=str(bandwidth/nchan)+'MHz', stokes='RR RL LR LL', nchannels=nchan)
+	sm.setfeed(mode='perfect R L', pol=[''])
+	for name, ra, dec in fields:
+		sm.setfield(sourcename=name, sourcedirection=me.direction('J2000', ra, dec))
+	# the calibrators are far apart on the sky, so the elevation limit is lifted to observe them all in one short run
+	sm.setlimits(shadowlimit=0.001, elevationlimit='-90deg')
+	sm.setauto(autocorrwt=0.0)
+	sm.settimes(integrationtime=inttime, usehourangle=False, referencetime=me.epoch('UTC', '2021/01/01/12:00:00'))
+	schedule = [['3C286', scantime/2], ['3C84', scantime/2], ['3C138', scantime/2], ['3C48', scantime/2], ['PHASECAL', scantime/2]]
+	for i in range(case['nscans']):
+		schedule += [['TARGET', scantime], ['PHASECAL', scantime/2]]
+	schedule += [['3C286', scantime/2]]
+	t = 0.0
+	for name, duration in schedule:
+		sm.observe(sourcename=name, spwname='band4', starttime=str(t)+'s', stoptime=str(t+duration)+'s')
+		t += duration+scangap
+
+	print ("Predicting the sky models")
+	for fid in range(len(fields)):
+		name, ra, dec = fields[fid]
+		direction = 'J2000 '+ra+' '+dec
+		if name in ['3C286', '3C138', '3C48']:
+			stokes, index = calibrator_stokes(name, f0)
+			components = [[direction, stokes, index]]
+		elif name == '3C84':
+			components = [[direction, [20.0, 0.0, 0.0, 0.0], -0.7]]
+		elif name == 'PHASECAL':
+			components = [[direction, [3.0, 0.0, 0.0, 0.0], -0.5]]
+		else:
+			components = []
+			for dra, ddec, flux, pf in target_sources:
+				pa = rs.uniform(0.0, np.pi)
+				d = me.direction('J2000', ra, dec)
+				d = me.shift(d, offset=qa.quantity(np.hypot(dra, ddec), 'arcsec'), pa=qa.quantity(np.arctan2(dra, ddec), 'rad'))
+				components.append([d, [flux, flux*pf*np.cos(2*pa), flux*pf*np.sin(2*pa), 0.0], -0.8])
+		clfile = vis+'.'+name+'.cl'
+		write_complist(clfile, components, f0)
+		sm.setdata(fieldid=[fid])
+		sm.predict(complist=clfile, incremental=False)
+		shutil.rmtree(clfile)
+
+	print ("Corrupting: gains, leakage and noise")
+	sm.setdata(fieldid=list(range(len(fields))))
+	sm.setseed(seed)
+	sm.setgain(mode='fbm', amplitude=[gainamp, gainamp])
+	sm.setleakage(mode='constant', amplitude=leakamp)
+	sm.setnoise(mode='simplenoise', simplenoise=noise)
+	sm.corrupt()
+	sm.done()
+
+	print ("Injecting RFI")
+	inject_rfi(vis, case['rfifrac'], rs)
+
+def case_params(case):
+	# channel ranges of the pipeline defaults (2048 channels, specave=7) scaled to the channels of the case
+	scale = case['nchan']/2048.0
+	params = {'fitsfile':'', 'gainspw':'0:%d~%d' % (int(255*scale), int(1791*scale)),
+	          'gainspw2':'0:%d~%d' % (int(36*scale), int(256*scale)), 'refant':str(min(18, case['nant']-1))}
+	params.update(pipeparams)
+	params.update(case['params'])
+	return params
+
+####################################################################################################################################
+
+#Flagging engines
+#The engine and the process pool of the pipeline are loaded into this script, with their default parameters. They are
+#defined at the top level, like in the pipeline, so that the pool workers can find them; the workers load the functions from the
+#pipeline script, whose name the compiled sections carry.
+bitcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:,None], axis=1).sum(axis=1)
+prof_records = []
+
+def apply_overrides():
+	pass
+
+def pipeline_section(title):
+	# source of one section of the pipeline, from its '#title' line to the next separator
+	with open(os.path.join(srcdir, pipeline)) as fpi:
+		src = fpi.read()
+	start = src.index('\n#'+title)
+	return src[start:src.index('\n'+'#'*132, start)]
+
+def flag_bits(vis, chunk=100000):
+	# FLAG of vis as packed bits, chunk by chunk
+	tb.open(vis)
+	nrow = tb.nrows()
+	bits = [np.packbits(tb.getcol('FLAG', startrow=start, nrow=min(chunk, nrow-start))) for start in range(0, nrow, chunk)]
+	tb.close()
+	return bits
+
+def compare_flagging(simvis, casedir):
+	# rflag and the SumThreshold engine on the DATA of flagfield, each from the simulated flags: wall time, fraction of
+	# the visibilities each one flagged, and the fraction of their union both flagged
+	exec(compile(pipeline_section('Local process pool')+pipeline_section('SumThreshold flagging engine'),
+	             os.path.join(srcdir, pipeline), 'exec'), globals())   # the spawned pool workers load the functions from there
+	vis = os.path.join(casedir, 'flagtest.ms')
+	if os.path.exists(vis):
+		shutil.rmtree(vis)
+	shutil.copytree(simvis, vis)
+	flagmanager(vis=vis, mode='save', versionname='simulated')
+	base = flag_bits(vis)
+	nvis = sum(8*len(b) for b in base)
+	out = {}
+	for name in ['rflag', 'sumthreshold']:
+		flagmanager(vis=vis, mode='restore', versionname='simulated')
+		t0 = time.time()
+		if name == 'rflag':
+			flagdata(vis=vis, mode='rflag', datacolumn='data', field=flagfield, timecutoff=4.0, freqcutoff=4.0, timefit='poly',
+			         freqfit='poly', flagdimension='freqtime', extendflags=False, timedevscale=flagcutoff, freqdevscale=flagcutoff,
+			         spectralmax=500.0, extendpols=False, growaround=False, flagneartime=False, flagnearfreq=False,
+			         action='apply', flagbackup=False)
+		else:
+			sumthreshold_flag(vis, "mode='sumthreshold' field='%s' spw='' datacolumn='DATA' cutoff=%r" % (flagfield, flagcutoff),
+			                  flagbackup=False)
+		wall = time.time()-t0
+		out[name] = {'wall': wall, 'new': [f & ~b for f, b in zip(flag_bits(vis), base)]}
+	both = sum(bitcount[r & s].sum() for r, s in zip(out['rflag']['new'], out['sumthreshold']['new']))
+	either = sum(bitcount[r | s].sum() for r, s in zip(out['rflag']['new'], out['sumthreshold']['new']))
+	shutil.rmtree(vis)
+	result = dict((name, {'wall': out[name]['wall'], 'flagged': sum(bitcount[n].sum() for n in out[name]['new'])/float(nvis)})
+	              for name in out)
+	result['agreement'] = both/float(max(1, either))
+	print ("Flagging field %s: rflag %.1f s, %.2f%% flagged; SumThreshold %.1f s, %.2f%% flagged; %.1f%% of the flags in common"
+	       % (flagfield, result['rflag']['wall'], 100*result['rflag']['flagged'], result['sumthreshold']['wall'],
+	          100*result['sumthreshold']['flagged'], 100*result['agreement']))
+	return result
+
+####################################################################################################################################
+
+#Pipeline runs
+
+def dir_size(path):
+	# bytes used by the files below path
+	total = 0
+	for root, dirs, fns in os.walk(path):
+		for fn in fns:
+			try:
+				total += os.path.getsize(os.path.join(root, fn))
+			except OSError:   # removed by the pipeline in the meantime
+				pass
+	return total
+
+def run_pipeline(rundir, simvis, params):
+	# Run the pipeline on a fresh copy of simvis in rundir: return code, wall time, bytes read and written by the CASA
+	# session and its workers, and the peak and final disk use of rundir (read every diskpoll seconds)
+	if os.path.exists(rundir):
+		shutil.rmtree(rundir)
+	os.makedirs(rundir)
+	shutil.copytree(simvis, os.path.join(rundir, 'multi.ms'))
+	for fn in [pipeline, 'pol_3C286.txt', 'pol_3C48.txt', 'pol_3C138.txt']:
+		shutil.copy(os.path.join(srcdir, fn), rundir)
+	with open(os.path.join(rundir, 'pipeline_params.json'), 'w') as fpa:
+		json.dump(params, fpa, indent=1)
+	r0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+	t0 = time.time()
+	peak = dir_size(rundir)
+	with open(os.path.join(rundir, 'pipeline.log'), 'w') as flog:
+		proc = subprocess.Popen(casacmd+[pipeline], cwd=rundir, stdout=flog, stderr=subprocess.STDOUT)
+		while proc.poll() is None:
+			time.sleep(diskpoll)
+			peak = max(peak, dir_size(rundir))
+	wall = time.time()-t0
+	r1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+	disk = dir_size(rundir)
+	return {'returncode': proc.returncode, 'wall': wall, 'read': 512*(r1.ru_inblock-r0.ru_inblock),
+	        'written': 512*(r1.ru_oublock-r0.ru_oublock), 'peakdisk': max(peak, disk), 'disk': disk}
+
+def compare_columns(case, casedir, simvis, params, run):
+	# run, the pipeline run with params, next to a run with the other scratch column setting
+	mode = 'lean' if params.get('scratchcols', 'full') == 'lean' else 'full'
+	other = 'full' if mode == 'lean' else 'lean'
+	pars = dict(params)
+	pars.update(columnmodes[other])
+	print ("Running "+pipeline+" on "+case['name']+" with scratchcols='"+other+"'")
+	runs = {mode: run, other: run_pipeline(os.path.join(casedir, 'run-'+other), simvis, pars)}
+	print ("Columns   wall(s)   read(GB)  written(GB)  peak disk(GB)  final disk(GB)")
+	for m in ['full', 'lean']:
+		r = runs[m]
+		print ("%-6s %10.1f %10.2f %12.2f %14.2f %15.2f%s" % (m, r['wall'], r['read']/1e9, r['written']/1e9, r['peakdisk']/1e9,
+		       r['disk']/1e9, '' if r['returncode'] == 0 else '   (returned %d)' % r['returncode']))
+	return runs
+
+####################################################################################################################################
+
+#Benchmark runs
+if version == '':
+	try:
+		version = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=srcdir).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		version = 'unknown'
+
+results = []
+if os.path.exists(resultsfile):
+	with open(resultsfile) as fre:
+		results = json.load(fre)
+
+for case in cases:
+	casedir = os.path.abspath(os.path.join(benchdir, case['name']))
+	simvis = os.path.join(casedir, 'sim.ms')
+	simcase = os.path.join(casedir, 'sim.json')
+	simpars = {'case':dict((k, v) for k, v in case.items() if k != 'params'), 'reffreq':reffreq, 'bandwidth':bandwidth, 'inttime':inttime, 'scantime':scantime, 'noise':noise,
+	           'gainamp':gainamp, 'leakamp':leakamp, 'rfiamp':rfiamp, 'seed':seed}
+	if not (os.path.exists(simvis) and os.path.exists(simcase) and json.load(open(simcase)) == simpars):
+		print ("Simulating "+case['name'])
+		if os.path.exists(casedir):
+			shutil.rmtree(casedir)
+		os.makedirs(casedir)
+		t0 = time.time()
+		simulate(simvis, case)
+		with open(simcase, 'w') as fsc:
+			json.dump(simpars, fsc, indent=1)
+		print ("Simulated "+case['name']+" in %.1f s" % (time.time()-t0))
+
+	flagging = compare_flagging(simvis, casedir) if flagcompare == True else {}
+
+	rundir = os.path.join(casedir, 'run')
+	params = case_params(case)
+	print ("Running "+pipeline+" on "+case['name'])
+	run = run_pipeline(rundir, simvis, params)
+	returncode, wall = run['returncode'], run['wall']
+
+	stages = {}
+	if os.path.exists(os.path.join(rundir, 'pipeline_stages.json')):
+		with open(os.path.join(rundir, 'pipeline_stages.json')) as fst:
+			stages = json.load(fst)
+	tasks = []
+	if os.path.exists(os.path.join(rundir, 'pipeline_profile.json')):
+		with open(os.path.join(rundir, 'pipeline_profile.json')) as fpr:
+			tasks = json.load(fpr)['summary']
+	order = sorted(stages, key=lambda s: stages[s]['date'])
+	result = {'version':version, 'case':case['name'], 'date':time.strftime('%Y-%m-%d %H:%M:%S'), 'host':socket.gethostname(),
+	          'simulation':simpars, 'params':params, 'returncode':returncode, 'wall':wall,
+	          'stages':[[s, stages[s]['wall']] for s in order], 'tasks':tasks, 'flagging':flagging, 'io':run}
+	print (case['name']+": pipeline returned %d after %.1f s" % (returncode, wall))
+	if columncompare == True:
+		result['columns'] = compare_columns(case, casedir, simvis, params, run)
+
+	previous = [r for r in results if r['case'] == case['name'] and r['version'] != version]
+	results.append(result)
+	with open(resultsfile, 'w') as fre:
+		json.dump(results, fre, indent=1)
+
+	print ("Stage             wall(s)  "+("previous(s)  ratio   ("+previous[-1]['version']+")" if len(previous) > 0 else ""))
+	before = dict(previous[-1]['stages']) if len(previous) > 0 else {}
+	for s, w in result['stages']+[['total', wall]]:
+		old = previous[-1]['wall'] if s == 'total' and len(previous) > 0 else before.get(s)
+		if old is None:
+			print ("%-14s %10.1f" % (s, w))
+		else:
+			print ("%-14s %10.1f %12.1f %7.2f" % (s, w, old, w/old if old > 0 else float('inf')))
+
+print ("Benchmark results in "+resultsfile)